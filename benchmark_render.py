@@ -0,0 +1,84 @@
+"""Benchmark da renderização de tickets: thread única vs. pool de processos
+
+Uso:
+    python benchmark_render.py                 # 400 tickets, 1..N núcleos
+    python benchmark_render.py --tickets 1000 --qrcode
+    python benchmark_render.py --workers 1 2 4 8
+    python benchmark_render.py --mode 1 --dpi 203 --paper-width 80 --encoder pbm
+
+Para cada quantidade de workers, dispara os tickets a partir de várias threads
+(como o Flask faz em um pico) e mede tickets por segundo.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flet_app import RenderExecutor, render_ticket_bytes, ImageGenerator, PrinterProfile
+
+
+def sample_fields(i, with_qrcode):
+    """Campos de um ticket de exemplo"""
+    fields = dict(
+        created_date="2025-01-01",
+        code=f"A{i:03d}",
+        services="Atendimento Geral",
+        header="Bem-vindo",
+        footer="Obrigado",
+    )
+    if with_qrcode:
+        fields["qrcode"] = f"https://exemplo.com/senha/A{i:03d}"
+    return fields
+
+
+def run(render, tickets, threads, with_qrcode, profile):
+    """Renderiza os tickets em paralelo e devolve (segundos, tickets/s, bytes por ticket)"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        sizes = list(pool.map(lambda i: len(render(sample_fields(i, with_qrcode), profile)), range(tickets)))
+    elapsed = time.perf_counter() - start
+    return elapsed, tickets / elapsed, sum(sizes) / len(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de renderização de tickets")
+    parser.add_argument("--tickets", type=int, default=400)
+    parser.add_argument("--threads", type=int, default=16, help="threads simulando requisições simultâneas")
+    parser.add_argument("--workers", type=int, nargs="*", help="quantidades de workers a testar")
+    parser.add_argument("--qrcode", action="store_true", help="renderiza tickets com QR Code")
+    parser.add_argument("--mode", default="RGB", choices=["RGB", "L", "1"], help="modo de cor do perfil")
+    parser.add_argument("--encoder", default="png", choices=["png", "pbm", "raw"])
+    parser.add_argument("--compress-level", type=int, default=6)
+    parser.add_argument("--dpi", type=int)
+    parser.add_argument("--paper-width", type=int, help="largura do papel em mm (58 ou 80)")
+    args = parser.parse_args()
+
+    profile = PrinterProfile(name="benchmark", mode=args.mode, dpi=args.dpi, paper_width_mm=args.paper_width,
+                             encoder=args.encoder, compress_level=args.compress_level)
+
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+
+    ImageGenerator.load_fonts(profile.scale)
+    render_ticket_bytes(sample_fields(0, args.qrcode), profile)  # aquece
+
+    print(f"Núcleos: {cores} | tickets: {args.tickets} | threads: {args.threads} | QR: {args.qrcode}")
+    print(f"Perfil: {profile.mode} {profile.width} px | codificador: {profile.encoder}")
+    print(f"{'modo':<22} {'tempo (s)':>10} {'tickets/s':>10} {'ganho':>7} {'bytes':>8}")
+
+    elapsed, rate, size = run(render_ticket_bytes, args.tickets, args.threads, args.qrcode, profile)
+    baseline = rate
+    print(f"{'thread (sem pool)':<22} {elapsed:>10.2f} {rate:>10.1f} {1.0:>6.2f}x {size:>8.0f}")
+
+    for workers in worker_counts:
+        executor = RenderExecutor(workers)
+        executor.start()
+        try:
+            elapsed, rate, size = run(executor.render, args.tickets, args.threads, args.qrcode, profile)
+        finally:
+            executor.shutdown()
+        print(f"{f'pool {workers} worker(s)':<22} {elapsed:>10.2f} {rate:>10.1f} {rate / baseline:>6.2f}x {size:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,21 @@
-import flet as ft
 import subprocess
 import threading
 import sys
 import os
 import signal
 import time
-import requests
 import json
-from flask import Flask, request as flask_request
-import pystray
-from PIL import Image
 import webbrowser
 import atexit
 import logging
 import queue
+import argparse
+import contextlib
+import collections
+import struct
+
+# Módulos pesados (flet, flask, requests, pystray, PIL, qrcode) são importados
+# apenas quando cada componente é iniciado, para acelerar o startup
 
 # Arquivo de configurações
 CONFIG_FILE = "printer_config.json"
@@ -23,6 +25,381 @@ app_instance = None
 server_running = False
 backend_thread = None
 
+
+class StartupReport:
+    """Mede tempo de importação e inicialização de cada fase do startup (opcional)"""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.t0 = time.perf_counter()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Mede a duração de uma fase (não faz nada se o relatório estiver desativado)"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.phases.append((name, start - self.t0, end - start))
+
+    def mark(self, name):
+        """Registra um evento instantâneo (ex.: backend pronto)"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.phases.append((name, time.perf_counter() - self.t0, 0.0))
+
+    def render(self):
+        """Formata o relatório em texto"""
+        with self.lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        lines = ["=== Relatório de inicialização ===",
+                 f"{'fase':<40} {'início (ms)':>12} {'duração (ms)':>13}"]
+        for name, start, duration in phases:
+            lines.append(f"{name:<40} {start * 1000:>12.1f} {duration * 1000:>13.1f}")
+        return "\n".join(lines)
+
+    def report(self, path="startup_report.txt"):
+        """Imprime o relatório e salva em arquivo (o executável não tem console)"""
+        if not self.enabled:
+            return
+        text = self.render()
+        print(text)
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text + "\n")
+        except Exception as e:
+            print(f"⚠️ Erro ao salvar relatório de inicialização: {e}")
+
+
+# Relatório de inicialização global (ativado por --startup-report ou IMPRESSAO_STARTUP_REPORT=1)
+startup_report = StartupReport(enabled=os.environ.get("IMPRESSAO_STARTUP_REPORT") == "1")
+
+
+class _Span:
+    """Trecho medido de um trace"""
+    __slots__ = ("tracer", "trace_id", "name", "attrs", "start")
+
+    def __init__(self, tracer, trace_id, name, attrs):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["erro"] = repr(exc)
+        self.tracer.record(self.trace_id, self.name, self.start, time.time() - self.start, self.attrs)
+        return False
+
+
+class Tracer:
+    """Rastreamento leve das requisições de impressão, exportado para arquivo local
+
+    Cada requisição amostrada recebe um trace id (ou usa o do cabeçalho X-Trace-Id)
+    e cada etapa vira um span. Os spans são gravados por uma thread própria em
+    JSON lines ("jsonl") ou no formato do chrome://tracing / Perfetto ("chrome").
+    Desativado, span() devolve um contexto vazio compartilhado e não mede nada.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.format = "jsonl"
+        self.path = None
+        self.local = threading.local()
+        self.events = None
+        self.writer = None
+
+    def configure(self, config):
+        """Aplica a seção "tracing" da configuração"""
+        options = config.get("tracing") or {}
+        self.sample_rate = float(options.get("sample_rate", 1.0))
+        self.format = options.get("format", "jsonl")
+        self.path = options.get("path") or os.path.join(
+            "traces", "trace.json" if self.format == "chrome" else "trace.jsonl")
+        if options.get("enabled") and self.writer is None:
+            self.events = queue.Queue()
+            self.writer = threading.Thread(target=self._write_loop, name="trace-writer", daemon=True)
+            self.writer.start()
+        self.enabled = bool(options.get("enabled"))
+
+    def start_trace(self, trace_id=None):
+        """Inicia o trace da requisição na thread atual; devolve o id ou None se não amostrada"""
+        import random
+        import uuid
+
+        self.local.trace_id = None
+        if not self.enabled:
+            return None
+        if trace_id is None and random.random() >= self.sample_rate:
+            return None
+        self.local.trace_id = trace_id or uuid.uuid4().hex[:16]
+        return self.local.trace_id
+
+    def end_trace(self):
+        self.local.trace_id = None
+
+    def current(self):
+        """Trace id da thread atual (para propagar a outras threads)"""
+        return getattr(self.local, "trace_id", None) if self.enabled else None
+
+    def span(self, name, trace_id=None, **attrs):
+        """Mede um trecho do trace atual (ou do trace_id informado)"""
+        if not self.enabled:
+            return _NULL_SPAN
+        trace_id = trace_id or getattr(self.local, "trace_id", None)
+        if trace_id is None:
+            return _NULL_SPAN
+        return _Span(self, trace_id, name, attrs)
+
+    def record(self, trace_id, name, start, duration, attrs):
+        """Enfileira um span para gravação (sem I/O no caminho da requisição)"""
+        if self.events is not None:
+            self.events.put((trace_id, name, start, duration, threading.current_thread().name, attrs))
+
+    def flush(self, timeout=2.0):
+        """Aguarda a gravação dos spans pendentes"""
+        if self.events is None:
+            return
+        deadline = time.monotonic() + timeout
+        while not self.events.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _write_loop(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        new_file = not os.path.exists(self.path)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            if self.format == "chrome" and new_file:
+                f.write("[\n")  # O formato aceita o array sem o colchete final
+            while True:
+                trace_id, name, start, duration, thread, attrs = self.events.get()
+                if self.format == "chrome":
+                    event = {"name": name, "ph": "X", "ts": int(start * 1e6), "dur": int(duration * 1e6),
+                             "pid": os.getpid(), "tid": thread, "args": dict(attrs, trace_id=trace_id)}
+                    f.write(json.dumps(event, ensure_ascii=False) + ",\n")
+                else:
+                    event = {"trace_id": trace_id, "span": name, "start": round(start, 6),
+                             "ms": round(duration * 1000, 3), "thread": thread}
+                    if attrs:
+                        event["attrs"] = attrs
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                if self.events.empty():
+                    f.flush()
+
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class RuntimeProfiler:
+    """Profiling sob demanda do backend em execução (sem reiniciar o serviço)
+
+    - Amostragem por N segundos: uma thread lê as pilhas de todas as threads a cada
+      poucos milissegundos e grava em formato "folded" (flamegraph.pl, speedscope).
+    - Próximas N requisições de impressão: cProfile de uma requisição por vez
+      (requisições simultâneas seguem sem profiling), agregado em um arquivo .pstats.
+      No Python 3.12+ o cProfile é global ao processo e registra também as outras
+      threads durante a requisição.
+    """
+    def __init__(self, directory="profiles"):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.sampling = False
+        self.remaining_requests = 0
+        self.request_lock = threading.Lock()  # Uma requisição com cProfile ativo por vez
+        self.stats = None
+        self.results = {}  # Último resultado por tipo ("amostragem" / "requisicoes")
+
+    def _output_path(self, prefix, extension):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        return os.path.join(self.directory, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+    def start_sampling(self, seconds, interval_ms=5):
+        """Inicia a amostragem em background; devolve o caminho do arquivo de saída"""
+        with self.lock:
+            if self.sampling:
+                raise RuntimeError("já existe uma amostragem em andamento")
+            self.sampling = True
+        path = self._output_path("amostragem", "folded")
+        threading.Thread(target=self._sample, args=(seconds, interval_ms / 1000.0, path),
+                         name="profiler", daemon=True).start()
+        return path
+
+    def _sample(self, seconds, interval, path):
+        counts = collections.Counter()
+        own_id = threading.get_ident()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    counts[";".join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(interval)
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in counts.most_common():
+                    f.write(f"{stack} {count}\n")
+            self.results["amostragem"] = {"arquivo": path, "amostras": samples, "pilhas": len(counts)}
+            print(f"🔬 Amostragem concluída: {path} ({samples} amostras)")
+        except Exception as e:
+            self.results["amostragem"] = {"erro": str(e)}
+        finally:
+            self.sampling = False
+
+    def profile_requests(self, count):
+        """Ativa o cProfile para as próximas `count` requisições de impressão"""
+        with self.lock:
+            self.remaining_requests = int(count)
+            self.stats = None
+
+    def request(self):
+        """Contexto da requisição: faz profiling se ainda houver requisições pedidas"""
+        if self.remaining_requests <= 0:
+            return _NULL_SPAN
+        return self._profile_request()
+
+    @contextlib.contextmanager
+    def _profile_request(self):
+        import cProfile
+        import pstats
+
+        # Dois cProfile ativos ao mesmo tempo falham (ValueError) no Python 3.12+
+        if not self.request_lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                print(f"⚠️ Profiling da requisição ignorado: {e}")
+                yield
+                return
+            try:
+                yield
+            finally:
+                profile.disable()
+                with self.lock:
+                    if self.remaining_requests > 0:
+                        if self.stats is None:
+                            self.stats = pstats.Stats(profile)
+                        else:
+                            self.stats.add(profile)
+                        self.remaining_requests -= 1
+                        if self.remaining_requests == 0:
+                            self._dump_requests()
+        finally:
+            self.request_lock.release()
+
+    def _dump_requests(self):
+        """Grava o .pstats agregado e um resumo em texto (chamado com self.lock)"""
+        import io
+
+        path = self._output_path("requisicoes", "pstats")
+        self.stats.dump_stats(path)
+        summary = io.StringIO()
+        self.stats.stream = summary
+        self.stats.sort_stats("cumulative").print_stats(25)
+        with open(path[:-len("pstats")] + "txt", 'w', encoding='utf-8') as f:
+            f.write(summary.getvalue())
+        self.results["requisicoes"] = {"arquivo": path, "resumo": summary.getvalue()}
+        self.stats = None
+        print(f"🔬 Profiling de requisições concluído: {path}")
+
+    def status(self):
+        return {
+            "amostragem_em_andamento": self.sampling,
+            "requisicoes_restantes": self.remaining_requests,
+            "resultados": self.results,
+        }
+
+# Tracer global (configurado pela seção "tracing" do printer_config.json)
+tracer = Tracer()
+
+class TrafficRecorder:
+    """Gravação das requisições de impressão para reproduzir a carga real depois
+
+    Cada requisição a /imprimir e /imprimir/qrcode vira uma linha compacta em
+    gravacoes/trafego-AAAA-MM-DD.jsonl: instante, endpoint, parâmetros, cliente
+    (hash da chave ou do IP), status e latência. A gravação é feita por uma thread
+    própria; reproduza com `python flet_app.py --replay <arquivos>` (as requisições
+    reproduzidas trazem X-Replay e não são gravadas de novo).
+    """
+    PATHS = ("/imprimir", "/imprimir/qrcode")
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = "gravacoes"
+        self.events = None
+        self.writer = None
+
+    def configure(self, config):
+        """Aplica a seção "traffic_recording" da configuração"""
+        options = config.get("traffic_recording") or {}
+        self.directory = options.get("directory", "gravacoes")
+        if options.get("enabled") and self.writer is None:
+            self.events = queue.Queue()
+            self.writer = threading.Thread(target=self._write_loop, name="traffic-recorder", daemon=True)
+            self.writer.start()
+        self.enabled = bool(options.get("enabled"))
+
+    def record(self, started, path, params, client, status, duration):
+        """Enfileira uma requisição para gravação (sem I/O no caminho da requisição)"""
+        import hashlib
+
+        client_hash = hashlib.sha1(client.encode("utf-8")).hexdigest()[:10] if client else None
+        self.events.put({"t": round(started, 3), "e": path, "p": params, "c": client_hash,
+                         "s": status, "ms": round(duration * 1000, 1)})
+
+    def flush(self, timeout=2.0):
+        """Aguarda a gravação das requisições pendentes"""
+        if self.events is None:
+            return
+        deadline = time.monotonic() + timeout
+        while not self.events.empty() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _write_loop(self):
+        os.makedirs(self.directory, exist_ok=True)
+        current_day, fd = None, None
+        while True:
+            event = self.events.get()
+            day = time.strftime("%Y-%m-%d", time.localtime(event["t"]))
+            if day != current_day:
+                if fd is not None:
+                    os.close(fd)
+                path = os.path.join(self.directory, f"trafego-{day}.jsonl")
+                # O_APPEND com uma escrita por linha: os workers podem gravar no mesmo arquivo
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                current_day = day
+            try:
+                os.write(fd, (json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8"))
+            except OSError as e:
+                print(f"⚠️ Erro ao gravar tráfego: {e}")
+
+
+traffic_recorder = TrafficRecorder()
+
+
 def load_config():
     """Carrega configurações salvas"""
     if os.path.exists(CONFIG_FILE):
@@ -52,163 +429,3164 @@ def save_config(config):
         return False
 
 
-class ImageGenerator:
-    def __init__(self, IMAGE_SIZE):
-        self.image = None
-        self.image_path = None
-        self.IMAGE_SIZE = IMAGE_SIZE
-        self.FONT_SIZE = 20
-        self.CODE_FONT_SIZE = 32
+def hidden_process_kwargs():
+    """Argumentos do subprocess para ocultar a janela de console (apenas Windows)"""
+    if os.name != 'nt':
+        return {}
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    startupinfo.wShowWindow = subprocess.SW_HIDE
+    return {"startupinfo": startupinfo, "creationflags": subprocess.CREATE_NO_WINDOW}
 
-    def create_image(self, created_date, code, services, header, footer):
-        from datetime import datetime
-        from PIL import Image, ImageDraw, ImageFont
 
-        self.image = Image.new("RGB", self.IMAGE_SIZE, color=(255, 255, 255))
-        draw = ImageDraw.Draw(self.image)
-        
-        # Cache de fontes para melhor performance
-        if not hasattr(self, '_font_cache'):
+def build_print_command(image_path, impressora, template=None):
+    """Monta o comando de impressão da plataforma (mspaint no Windows, CUPS no Linux)
+
+    Um comando personalizado pode ser definido em "print_command" no arquivo de
+    configuração, usando {path} e {printer} como marcadores.
+    """
+    if template:
+        return [part.format(path=image_path, printer=impressora) for part in template]
+    if os.name == 'nt':
+        return ['mspaint', '/pt', image_path, impressora]
+    return ['lp', '-d', impressora, image_path]
+
+
+class CommandSink:
+    """Destino de impressão que entrega o arquivo ao spooler via comando do sistema"""
+    needs_file = True  # O comando recebe o caminho de um arquivo
+
+    def __init__(self, command_template=None):
+        self.command_template = command_template
+
+    def send(self, image_path, impressora):
+        """Inicia o processo de impressão de forma assíncrona"""
+        command = build_print_command(image_path, impressora, self.command_template)
+        return subprocess.Popen(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            **hidden_process_kwargs()
+        )
+
+
+class SimulatedPrintJob:
+    """Ticket entregue à impressora simulada; imita um Popen (poll/wait/kill) para o supervisor"""
+    def __init__(self, simulator, record):
+        self.simulator = simulator
+        self.record = record
+        self.returncode = None
+        self.done = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.returncode
+
+    def kill(self):
+        self.simulator.cancel(self)
+
+    def _finish(self, returncode, result):
+        if self.done.is_set():
+            return
+        self.returncode = returncode
+        self.record["resultado"] = result
+        self.record["concluido"] = time.time()
+        self.done.set()
+
+
+class PrinterSimulator:
+    """Impressora simulada para testes de carga e benchmarks sem impressora real
+
+    Modela o tempo de impressão de cada ticket, um buffer limitado no aparelho
+    (quem envia espera quando ele enche), janelas offline (tickets recusados),
+    falta de papel (impressão parada por alguns segundos) e falhas aleatórias
+    com semente fixa. As janelas são definidas pelo número de sequência do ticket,
+    então a mesma carga produz sempre o mesmo resultado. Tudo que chega fica
+    registrado em `received` (e opcionalmente num arquivo .jsonl) para conferência.
+    """
+    MAX_RECORDS = 10000
+
+    def __init__(self, name="simulador", print_ms=300, ms_per_kb=0.0, buffer_tickets=4, failure_rate=0.0,
+                 seed=0, offline=(), paper_out=(), send_timeout=30, record_path=None):
+        import random
+
+        self.name = name
+        self.print_ms = print_ms
+        self.ms_per_kb = ms_per_kb
+        self.buffer_tickets = max(1, int(buffer_tickets))
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.offline = [tuple(window) for window in offline]  # [(primeiro, último)] tickets recusados
+        self.paper_out = {int(seq): seconds for seq, seconds in paper_out}  # {ticket: segundos parada}
+        self.send_timeout = send_timeout
+        self.record_path = record_path
+        self.received = collections.deque(maxlen=self.MAX_RECORDS)
+        self.buffer = collections.deque()
+        self.sequence = 0
+        self.counters = collections.Counter()
+        self.paper_out_until = 0.0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._print_loop, name=f"simulador-{name}", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_settings(cls, settings):
+        keys = ("name", "print_ms", "ms_per_kb", "buffer_tickets", "failure_rate", "seed",
+                "offline", "paper_out", "send_timeout", "record_path")
+        return cls(**{key: settings[key] for key in keys if key in settings})
+
+    def _is_offline(self, seq):
+        return any(first <= seq <= last for first, last in self.offline)
+
+    def submit(self, data, impressora=""):
+        """Recebe um ticket; espera vaga no buffer e devolve o trabalho simulado
+
+        Levanta ConnectionRefusedError se o ticket cai numa janela offline e
+        TimeoutError se o buffer não libera espaço em `send_timeout` segundos.
+        """
+        import hashlib
+
+        with self.condition:
+            self.sequence += 1
+            seq = self.sequence
+            record = {"seq": seq, "impressora": impressora, "bytes": len(data),
+                      "sha1": hashlib.sha1(data).hexdigest(), "recebido": time.time(),
+                      "concluido": None, "resultado": None}
+            self.received.append(record)
+            self.counters["recebidos"] += 1
+            if self._is_offline(seq):
+                record["resultado"] = "offline"
+                self.counters["offline"] += 1
+                self._write_record(record)
+                raise ConnectionRefusedError(f"impressora simulada {self.name} offline (ticket {seq})")
+            fails = self.random.random() < self.failure_rate  # Sorteado na ordem de chegada: repetível
+            deadline = time.monotonic() + self.send_timeout
+            while len(self.buffer) >= self.buffer_tickets:
+                self.counters["esperas_buffer"] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    record["resultado"] = "buffer cheio"
+                    self.counters["buffer_cheio"] += 1
+                    self._write_record(record)
+                    raise TimeoutError(f"buffer da impressora simulada {self.name} cheio")
+                self.condition.wait(remaining)
+            job = SimulatedPrintJob(self, record)
+            job.fails = fails
+            self.buffer.append(job)
+            self.condition.notify_all()
+        return job
+
+    def cancel(self, job):
+        """Cancela um ticket (processo encerrado pelo supervisor por tempo limite)"""
+        with self.condition:
+            if job in self.buffer:
+                self.buffer.remove(job)
+            if not job.done.is_set():
+                job._finish(-9, "cancelado")
+                self.counters["cancelados"] += 1
+                self._write_record(job.record)
+            self.condition.notify_all()
+
+    def _print_loop(self):
+        while True:
+            with self.condition:
+                while not self.buffer:
+                    self.condition.wait()
+                job = self.buffer[0]
+            seq = job.record["seq"]
+            stop = self.paper_out.pop(seq, 0)
+            if stop:
+                self.paper_out_until = time.monotonic() + stop
+                time.sleep(stop)  # Sem papel: o buffer continua enchendo
+                self.paper_out_until = 0.0
+            time.sleep((self.print_ms + self.ms_per_kb * job.record["bytes"] / 1024) / 1000)
+            with self.condition:
+                if self.buffer and self.buffer[0] is job:
+                    self.buffer.popleft()
+                if not job.done.is_set():
+                    if job.fails:
+                        job._finish(1, "falha")
+                        self.counters["falhas"] += 1
+                    else:
+                        job._finish(0, "impresso")
+                        self.counters["impressos"] += 1
+                    self._write_record(job.record)
+                self.condition.notify_all()
+
+    def _write_record(self, record):
+        if not self.record_path:
+            return
+        try:
+            with open(self.record_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"⚠️ Erro ao gravar registro do simulador: {e}")
+
+    def wait_idle(self, timeout=None):
+        """Aguarda o buffer esvaziar (útil ao final de um teste de carga)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.buffer:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats["no_buffer"] = len(self.buffer)
+        stats["sem_papel"] = self.paper_out_until > time.monotonic()
+        return stats
+
+
+class SimulatorSink:
+    """Destino de impressão que entrega o ticket à impressora simulada"""
+    needs_file = False  # Recebe os bytes do ticket (send_bytes)
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def send(self, image_path, impressora):
+        with open(image_path, "rb") as f:
+            return self.send_bytes(f.read(), impressora)
+
+    def send_bytes(self, data, impressora):
+        return self.simulator.submit(data, impressora)
+
+
+class PrinterSimulatorServer:
+    """Impressora simulada escutando TCP como uma impressora de rede (porta 9100, RAW)
+
+    Cada conexão é um ticket: os bytes são lidos até o cliente fechar o envio. A
+    conexão só termina quando o ticket sai da impressora simulada; em caso de falha
+    ela é encerrada com RST, que o RawTcpSink reporta como erro.
+    """
+    def __init__(self, simulator, host="127.0.0.1", port=9100):
+        import socket
+        import socketserver
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                chunks = []
+                while True:
+                    chunk = self.request.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                try:
+                    ok = simulator.submit(b"".join(chunks), self.client_address[0]).wait() == 0
+                except (ConnectionRefusedError, TimeoutError):
+                    ok = False
+                if not ok:  # Fecha já com RST, antes do encerramento normal do socketserver
+                    self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                    self.request.close()
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.simulator = simulator
+        self.server = Server((host, port), Handler)
+        self.address = self.server.server_address
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="simulador-tcp", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SocketTransfer:
+    """Envio de um ticket por TCP em segundo plano; imita um Popen para o supervisor"""
+    def __init__(self, sock, data):
+        self.sock = sock
+        self.returncode = None
+        self.done = threading.Event()
+        threading.Thread(target=self._run, args=(data,), name="envio-tcp", daemon=True).start()
+
+    def _run(self, data):
+        import socket
+
+        try:
+            self.sock.sendall(data)
+            self.sock.shutdown(socket.SHUT_WR)
+            while self.sock.recv(4096):  # A impressora fecha a conexão quando termina
+                pass
+            code = 0
+        except OSError:
+            code = 1
+        finally:
+            self.sock.close()
+        if self.returncode is None:
+            self.returncode = code
+        self.done.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.returncode
+
+    def kill(self):
+        import socket
+
+        self.returncode = -9
+        try:
+            # No Linux só o close() não acorda o recv() bloqueado na thread de envio
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class RawTcpSink:
+    """Destino de impressão RAW/JetDirect: envia os bytes do ticket direto à porta 9100
+
+    Serve para impressoras de rede (use encoder "raw") e para o PrinterSimulatorServer.
+    Sem "host" na configuração, o nome da impressora é usado como endereço.
+    """
+    needs_file = False  # Recebe os bytes do ticket (send_bytes)
+
+    def __init__(self, host=None, port=9100, connect_timeout=5):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+
+    def send(self, image_path, impressora):
+        with open(image_path, "rb") as f:
+            return self.send_bytes(f.read(), impressora)
+
+    def send_bytes(self, data, impressora):
+        import socket
+
+        sock = socket.create_connection((self.host or impressora, self.port), timeout=self.connect_timeout)
+        sock.settimeout(None)  # O tempo limite do envio é controlado pelo supervisor
+        return SocketTransfer(sock, data)
+
+
+_printer_simulators = {}
+_printer_simulators_lock = threading.Lock()
+
+
+def get_printer_simulator(settings):
+    """Impressora simulada compartilhada entre os envios com as mesmas configurações"""
+    key = json.dumps(settings, sort_keys=True)
+    with _printer_simulators_lock:
+        simulator = _printer_simulators.get(key)
+        if simulator is None:
+            simulator = _printer_simulators[key] = PrinterSimulator.from_settings(settings)
+        return simulator
+
+
+def printer_simulator_stats():
+    with _printer_simulators_lock:
+        simulators = list(_printer_simulators.values())
+    return {simulator.name: simulator.stats() for simulator in simulators}
+
+
+def create_print_sink(config):
+    """Cria o destino de impressão conforme a configuração
+
+    "print_sink" escolhe o destino: "command" (padrão, spooler do sistema),
+    "tcp" (RAW na porta 9100) ou "simulator" (impressora simulada para testes).
+    """
+    settings = config.get("print_sink") or {}
+    sink_type = settings.get("type", "command")
+    if sink_type == "simulator":
+        return SimulatorSink(get_printer_simulator(settings))
+    if sink_type == "tcp":
+        return RawTcpSink(settings.get("host"), int(settings.get("port", 9100)),
+                          settings.get("connect_timeout", 5))
+    return CommandSink(command_template=config.get("print_command"))
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5000
+
+
+def server_address(config=None):
+    """Endereço (host, porta) do servidor de impressão conforme a configuração"""
+    if config is None:
+        config = load_config()
+    return config.get("server_host") or DEFAULT_HOST, int(config.get("server_port") or DEFAULT_PORT)
+
+
+# Endereços de origem tratados como a própria máquina (endpoints administrativos)
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
+
+def backend_url(path="", config=None):
+    """URL local para falar com o servidor (status, testes da interface, bandeja)"""
+    host, port = server_address(config)
+    if host in ("0.0.0.0", "::"):
+        host = "127.0.0.1"  # Escutando em todas as interfaces: acessa pela loopback
+    if ":" in host:
+        host = f"[{host}]"
+    return f"http://{host}:{port}{path}"
+
+
+def open_shared_socket(host, port):
+    """Socket de escuta com SO_REUSEPORT: vários processos aceitam conexões na mesma porta"""
+    import socket
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    return sock
+
+
+def supports_shared_port():
+    import socket
+
+    return hasattr(socket, "SO_REUSEPORT") and sys.platform.startswith("linux")
+
+
+class PrinterProfile:
+    """Perfil de saída de uma impressora: modo de cor, resolução, largura do papel e codificador
+
+    Modos: "RGB" (padrão legado), "L" (tons de cinza) e "1" (1 bit, térmicas monocromáticas).
+    Codificadores: "png" (compress_level ajustável), "pbm" (1 bit sem compressão) e
+    "raw" (raster ESC/POS pronto para envio direto à impressora, com corte no final).
+    """
+    # Área imprimível em mm para as larguras de papel térmico mais comuns
+    PRINTABLE_WIDTH_MM = {58: 48, 80: 72}
+    BASE_WIDTH = 300  # Largura de referência do layout original
+    EXTENSIONS = {"png": "png", "pbm": "pbm", "raw": "bin"}
+
+    def __init__(self, name="padrao", mode="RGB", dpi=None, paper_width_mm=None,
+                 width_px=None, encoder="png", compress_level=6, auto_height=None,
+                 margin_mm=0, top_mm=0, bottom_mm=0, font_scale=1.0):
+        if mode not in ("RGB", "L", "1"):
+            raise ValueError(f"Modo de cor inválido: {mode}")
+        if encoder not in self.EXTENSIONS:
+            raise ValueError(f"Codificador inválido: {encoder}")
+        self.name = name
+        self.mode = mode
+        self.dpi = dpi
+        self.paper_width_mm = paper_width_mm
+        self.encoder = encoder
+        self.compress_level = compress_level
+        self.auto_height = auto_height  # Bobina contínua: altura pelo conteúdo (None = segue o template)
+        # Margens da impressora somadas às do template, e escala das fontes do template
+        self.margin_mm = margin_mm
+        self.top_mm = top_mm
+        self.bottom_mm = bottom_mm
+        self.font_scale = float(font_scale)
+        self.width = self._resolve_width(width_px)
+
+    def _resolve_width(self, width_px):
+        """Largura em pixels: explícita, ou calculada pela área imprimível do papel e DPI"""
+        if width_px:
+            width = int(width_px)
+        elif self.paper_width_mm and self.dpi:
+            printable = self.PRINTABLE_WIDTH_MM.get(int(self.paper_width_mm), self.paper_width_mm - 8)
+            width = int(round(printable / 25.4 * self.dpi))
+        else:
+            return self.BASE_WIDTH
+        # Raster 1 bit é enviado em bytes inteiros por linha
+        return width - width % 8 if self.mode == "1" or self.encoder == "raw" else width
+
+    @property
+    def scale(self):
+        """Fator de escala do layout em relação à largura de referência"""
+        return self.width / self.BASE_WIDTH
+
+    @property
+    def key(self):
+        """Tudo que muda o layout: identifica os layouts pré-calculados deste perfil"""
+        return (self.mode, self.width, self.dpi, self.margin_mm, self.top_mm, self.bottom_mm,
+                self.font_scale, self.auto_height)
+
+    def mm(self, value):
+        """Milímetros em pixels na resolução do perfil (sem DPI informado, 203 dpi das térmicas)"""
+        return int(round(value / 25.4 * (self.dpi or 203)))
+
+    @property
+    def extension(self):
+        return self.EXTENSIONS[self.encoder]
+
+    @property
+    def paper_color(self):
+        return (255, 255, 255) if self.mode == "RGB" else (1 if self.mode == "1" else 255)
+
+    @property
+    def ink_color(self):
+        return (0, 0, 0) if self.mode == "RGB" else 0
+
+    @classmethod
+    def from_dict(cls, name, data):
+        """Cria o perfil a partir de uma entrada de "printer_profiles" na configuração"""
+        return cls(
+            name=name,
+            mode=data.get("mode", "RGB"),
+            dpi=data.get("dpi"),
+            paper_width_mm=data.get("paper_width_mm"),
+            width_px=data.get("width_px"),
+            encoder=data.get("encoder", "png"),
+            compress_level=data.get("compress_level", 6),
+            auto_height=data.get("auto_height"),
+            margin_mm=data.get("margin_mm", 0),
+            top_mm=data.get("top_mm", 0),
+            bottom_mm=data.get("bottom_mm", 0),
+            font_scale=data.get("font_scale", 1.0),
+        )
+
+
+def resolve_printer_profile(config, impressora):
+    """Escolhe o perfil da impressora: pelo nome, depois "padrao", senão o legado (RGB 300 px)"""
+    profiles = config.get("printer_profiles") or {}
+    for name in (impressora, "padrao"):
+        if name and name in profiles:
             try:
-                self._font_cache = {
-                    'font': ImageFont.truetype("arial.ttf", size=self.FONT_SIZE),
-                    'code_font': ImageFont.truetype("arial.ttf", size=self.CODE_FONT_SIZE)
-                }
-            except:
-                self._font_cache = {
-                    'font': ImageFont.load_default(),
-                    'code_font': ImageFont.load_default()
-                }
-        
-        font = self._font_cache['font']
-        code_font = self._font_cache['code_font']
-
-        header_block = header
-        code_block = f"Código: {code}"
-        services_block = f"Serviços: {services}"
-        date_block = f"Data: {created_date}"
-        footer_block = footer
-
-        y_positions = [
-            10,
-            self.CODE_FONT_SIZE + 30,
-            self.FONT_SIZE * 2 + 90,
-            self.FONT_SIZE * 3 + 120,
-            self.FONT_SIZE * 3 + 170,
-        ]
+                return PrinterProfile.from_dict(name, profiles[name])
+            except Exception as e:
+                print(f"⚠️ Perfil de impressora '{name}' inválido: {e}")
+    return PrinterProfile()
 
-        for block, y in zip([header_block, code_block, services_block, date_block, footer_block], y_positions):
-            bbox = draw.textbbox((0, 0), block, font=code_font if "Código:" in block else font)
-            w = bbox[2] - bbox[0]
-            x = (self.IMAGE_SIZE[0] - w) // 2
-            draw.text((x, y), block, font=code_font if "Código:" in block else font, fill=(0, 0, 0))
 
-        date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        if not os.path.exists('ticket'):
-            os.makedirs('ticket')
-        self.image_path = os.path.join(os.getcwd(), "ticket", f"{date}.png")
+class TextMetricsCache:
+    """Cache limitado (LRU) das medidas de texto por (fonte, texto)
 
-        self.image.save(self.image_path)
-        return self.image_path
+    Os mesmos textos se repetem entre tickets (cabeçalho, rodapé, serviços, prefixos),
+    então cada combinação é medida pelo FreeType uma única vez.
+    """
+    def __init__(self, maxsize=4096):
+        from collections import OrderedDict
 
-    def create_qrcode(self, code):
-        import qrcode
-        from datetime import datetime
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.line_heights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-        qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=4, border=4)
-        qr.add_data(code)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        if not os.path.exists('ticket'):
-            os.makedirs('ticket')
-        self.qr_path = os.path.join(os.getcwd(), "ticket", f"{date}QR.png")
-        img.save(self.qr_path)
-        return self.qr_path
+    def width(self, font, text):
+        """Largura do texto renderizado com a fonte"""
+        key = (font, text)
+        with self.lock:
+            width = self.entries.get(key)
+            if width is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return width
+        atlas = GlyphAtlas.for_font(font)
+        width = atlas.measure(text) if atlas is not None and atlas.covers(text) else None
+        if width is None:
+            bbox = font.getbbox(text)
+            width = bbox[2] - bbox[0]
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = width
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return width
 
-    def combine(self):
-        from PIL import Image
+    def line_height(self, font):
+        """Altura de uma linha (ascendente + descendente) da fonte"""
+        height = self.line_heights.get(font)
+        if height is None:
+            ascent, descent = font.getmetrics()
+            height = self.line_heights[font] = ascent + descent
+        return height
 
-        img = Image.open(self.image_path)
-        img2 = Image.open(self.qr_path)
-        img2 = img2.resize((100, 100))
-        img_width, img_height = img.size
-        spacer = Image.new('RGB', (img_width, 5), color='white')
-        img_with_spacer = Image.new('RGB', (img_width, img_height + 100), color='white')
-        img_with_spacer.paste(spacer, (0, img_height))
-        img_with_spacer.paste(img, (0, 0))
-        img_with_spacer.paste(img2, (100, img_height - 50))
-        img_with_spacer.save(self.image_path)
-        return self.image_path
 
+# Cache global de medidas de texto (compartilhado por todas as renderizações do processo)
+text_metrics = TextMetricsCache()
+
+
+# Caracteres dos códigos de senha, pré-rasterizados no atlas de glifos
+CODE_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-"
+
+
+class GlyphAtlas:
+    """Glifos pré-rasterizados de uma fonte (arquivo e tamanho) em um modo de imagem
+
+    A linha grande do código ("Código: A001") muda a cada ticket, então o cache de
+    medidas não ajuda e o FreeType rasterizaria a linha inteira de novo. Com o atlas
+    a linha é montada colando os bitmaps prontos nas posições que o FreeType usaria
+    (avanço de cada glifo + kerning do par), com o mesmo resultado do draw.text.
+    Textos com caracteres fora do atlas são desenhados do jeito normal.
+    """
+    _atlases = {}  # {(fonte, modo): atlas}
+    _lock = threading.Lock()
+
+    def __init__(self, font, mode, alphabet):
+        from PIL import Image, ImageDraw
+
+        self.font = font
+        self.mode = mode
+        alphabet = set(alphabet)
+        # Sem antialiasing (modo "1") o hinting muda avanços e caixas: o desenho usa as
+        # métricas do modo e a medida usa as padrão, como draw.text e font.getbbox
+        render_mode = "1" if mode == "1" else ""
+        self.layout = self._metrics(font, alphabet, render_mode)
+        self.metrics = self.layout if render_mode == "" else self._metrics(font, alphabet, "")
+        self.glyphs = {}  # {caractere: (máscara ou None, esquerda, topo)}
+        for char in alphabet:
+            left, top, right, bottom = font.getbbox(char, mode=render_mode)
+            mask = None
+            if right > left and bottom > top:
+                mask = Image.new(render_mode or "L", (right - left, bottom - top), 0)
+                ImageDraw.Draw(mask).text((-left, -top), char, font=font, fill=255)
+            self.glyphs[char] = (mask, left, top)
+
+    @staticmethod
+    def _metrics(font, alphabet, mode):
+        """Avanços, kerning de cada par e extensão horizontal de cada glifo em um modo"""
+        advances = {char: font.getlength(char, mode=mode) for char in alphabet}
+        # Kerning: diferença entre o par medido junto e a soma dos avanços
+        kerning = {}
+        for first in alphabet:
+            for second in alphabet:
+                adjust = font.getlength(first + second, mode=mode) - advances[first] - advances[second]
+                if adjust:
+                    kerning[first, second] = adjust
+        extents = {}
+        for char in alphabet:
+            left, top, right, bottom = font.getbbox(char, mode=mode)
+            extents[char] = (left, right) if right > left else None  # Espaço: sem altura, mas ocupa largura
+        return advances, kerning, extents
+
+    @classmethod
+    def get(cls, font, mode, alphabet=CODE_ALPHABET):
+        """Atlas da fonte no modo, montado uma única vez por processo"""
+        key = (font, mode)
+        atlas = cls._atlases.get(key)
+        if atlas is not None and all(char in atlas.glyphs for char in alphabet):
+            return atlas
+        with cls._lock:
+            atlas = cls._atlases.get(key)
+            if atlas is None or not all(char in atlas.glyphs for char in alphabet):
+                if atlas is not None:
+                    alphabet = "".join(atlas.glyphs) + alphabet
+                atlas = cls._atlases[key] = GlyphAtlas(font, mode, alphabet)
+        return atlas
+
+    @classmethod
+    def for_font(cls, font):
+        """Algum atlas da fonte (as medidas não dependem do modo), ou None"""
+        for (atlas_font, _), atlas in list(cls._atlases.items()):
+            if atlas_font is font:
+                return atlas
+        return None
+
+    def covers(self, text):
+        return all(char in self.glyphs for char in text)
+
+    def _positions(self, text, metrics):
+        """Posição horizontal de cada caractere, arredondada como no FreeType"""
+        advances, kerning, _ = metrics
+        pen = 0.0
+        previous = None
+        for char in text:
+            if previous is not None:
+                pen += advances[previous] + kerning.get((previous, char), 0)
+            yield round(pen), char
+            previous = char
+
+    def measure(self, text):
+        """Largura do texto (como font.getbbox), ou None se não há glifo visível"""
+        extents = self.metrics[2]
+        left = right = None
+        for x, char in self._positions(text, self.metrics):
+            extent = extents[char]
+            if extent is not None:
+                left = x + extent[0] if left is None else min(left, x + extent[0])
+                right = x + extent[1] if right is None else max(right, x + extent[1])
+        return None if left is None else right - left
+
+    def draw(self, image, xy, text, fill):
+        """Desenha o texto na imagem colando os glifos prontos"""
+        x0, y0 = xy
+        for x, char in self._positions(text, self.layout):
+            mask, left, top = self.glyphs[char]
+            if mask is not None:
+                image.paste(fill, (x0 + x + left, y0 + top), mask)
+
+
+class LayoutBlock:
+    """Bloco de texto do ticket: fonte desejada, máximo de linhas e alinhamento"""
+    __slots__ = ("text", "font_size", "max_lines", "min_font_size", "align", "font_name")
+
+    def __init__(self, text, font_size, max_lines=1, min_font_size=None, align="center", font_name="arial.ttf"):
+        self.text = text
+        self.font_size = font_size
+        self.max_lines = max_lines
+        self.min_font_size = min_font_size or max(8, int(font_size * 0.6))
+        self.align = align
+        self.font_name = font_name
+
+
+class LayoutImage:
+    """Bloco de imagem do ticket (logo) já no tamanho e no modo da impressora"""
+    __slots__ = ("image", "align")
+
+    def __init__(self, image, align="center"):
+        self.image = image
+        self.align = align
+
+
+def wrap_text(text, font, max_width):
+    """Quebra o texto em linhas que cabem em max_width (palavras longas são cortadas)"""
+    words = text.split()
+    if not words:
+        return [text]
+    lines = []
+    current = ""
+    for word in words:
+        candidate = f"{current} {word}" if current else word
+        if text_metrics.width(font, candidate) <= max_width:
+            current = candidate
+            continue
+        if current:
+            lines.append(current)
+        # Palavra maior que a linha: corta em pedaços que cabem
+        while text_metrics.width(font, word) > max_width and len(word) > 1:
+            cut = len(word) - 1
+            while cut > 1 and text_metrics.width(font, word[:cut]) > max_width:
+                cut -= 1
+            lines.append(word[:cut])
+            word = word[cut:]
+        current = word
+    lines.append(current)
+    return lines
+
+
+def fit_block(block, max_width, load_font):
+    """Escolhe a maior fonte em que o bloco cabe em max_lines; devolve (fonte, linhas)"""
+    size = block.font_size
+    while True:
+        font = load_font(size, block.font_name)
+        if text_metrics.width(font, block.text) <= max_width:
+            return font, [block.text]
+        lines = wrap_text(block.text, font, max_width)
+        if len(lines) <= block.max_lines or size <= block.min_font_size:
+            return font, lines[:block.max_lines]
+        size = max(block.min_font_size, size - max(1, size // 10))
+
+
+def layout_blocks(blocks, width, load_font, top=10, gap=28, margin=8):
+    """Posiciona os blocos centralizados e empilhados; devolve ([(x, y, texto, fonte)], altura usada)
+
+    Blocos de imagem entram como (x, y, imagem, None).
+    """
+    max_width = width - 2 * margin
+    placed = []
+    y = top
+    for index, block in enumerate(blocks):
+        if index:
+            y += gap
+        if isinstance(block, LayoutImage):
+            image_width = block.image.size[0]
+            if block.align == "left":
+                x = margin
+            elif block.align == "right":
+                x = width - margin - image_width
+            else:
+                x = (width - image_width) // 2
+            placed.append((x, y, block.image, None))
+            y += block.image.size[1]
+            continue
+        font, lines = fit_block(block, max_width, load_font)
+        line_height = text_metrics.line_height(font)
+        for line_index, line in enumerate(lines):
+            if line_index:
+                y += line_height
+            line_width = text_metrics.width(font, line)
+            if block.align == "left":
+                x = margin
+            elif block.align == "right":
+                x = width - margin - line_width
+            else:
+                x = (width - line_width) // 2
+            placed.append((x, y, line, font))
+        y += line_height
+    return placed, y + top
+
+
+# Plano de renderização: forma compilada e imutável de um template de ticket
+RenderPlan = collections.namedtuple("RenderPlan", "name height top gap margin blocks qrcode auto_height bottom")
+PlanBlock = collections.namedtuple("PlanBlock", "text font font_size min_font_size max_lines align")
+PlanLogo = collections.namedtuple("PlanLogo", "path width align")
+QrPlacement = collections.namedtuple("QrPlacement", "size align overlap")
+
+# Campos da requisição que podem ser usados nos textos dos templates
+TEMPLATE_FIELDS = ("created_date", "code", "services", "header", "footer", "qrcode")
+
+# Layout original do ticket, descrito como template
+DEFAULT_TEMPLATE = {
+    "height": 300,
+    "auto_height": False,
+    "top": 10,
+    "gap": 28,
+    "margin": 8,
+    "blocks": [
+        {"text": "{header}", "font_size": 20, "max_lines": 2},
+        {"text": "Código: {code}", "font_size": 32},
+        {"text": "Serviços: {services}", "font_size": 20, "max_lines": 3},
+        {"text": "Data: {created_date}", "font_size": 20},
+        {"text": "{footer}", "font_size": 20, "max_lines": 2},
+    ],
+    "qrcode": {"size": 100, "align": "center", "overlap": 50},
+}
+
+
+def compile_template(data, name):
+    """Valida um template (dict) e compila em um RenderPlan imutável
+
+    Medidas em pixels na largura de referência (300 px); o perfil da impressora
+    aplica a escala. Levanta ValueError se o template for inválido.
+    """
+    import string
+
+    if not isinstance(data, dict) or not isinstance(data.get("blocks"), list) or not data["blocks"]:
+        raise ValueError("o template precisa de uma lista 'blocks' não vazia")
+    blocks = []
+    for index, block in enumerate(data["blocks"]):
+        if "logo" in block:
+            align = block.get("align", "center")
+            if align not in ("left", "center", "right"):
+                raise ValueError(f"bloco {index}: alinhamento inválido '{align}'")
+            if not os.path.exists(block["logo"]):
+                raise ValueError(f"bloco {index}: logo não encontrado '{block['logo']}'")
+            blocks.append(PlanLogo(path=block["logo"], width=int(block.get("width", 120)), align=align))
+            continue
+        text = block.get("text", "")
+        for _, field, _, _ in string.Formatter().parse(text):
+            if field is not None and field not in TEMPLATE_FIELDS:
+                raise ValueError(f"bloco {index}: campo desconhecido '{{{field}}}'")
+        align = block.get("align", "center")
+        if align not in ("left", "center", "right"):
+            raise ValueError(f"bloco {index}: alinhamento inválido '{align}'")
+        font_size = int(block.get("font_size", 20))
+        blocks.append(PlanBlock(
+            text=text,
+            font=block.get("font", "arial.ttf"),
+            font_size=font_size,
+            min_font_size=int(block.get("min_font_size", max(8, int(font_size * 0.6)))),
+            max_lines=int(block.get("max_lines", 1)),
+            align=align,
+        ))
+    qrcode = None
+    qr_data = data.get("qrcode", DEFAULT_TEMPLATE["qrcode"])
+    if qr_data:
+        size = int(qr_data.get("size", 100))
+        qrcode = QrPlacement(size=size, align=qr_data.get("align", "center"),
+                             overlap=int(qr_data.get("overlap", size // 2)))
+    top = int(data.get("top", 10))
+    return RenderPlan(
+        name=name,
+        height=int(data.get("height", 300)),
+        top=top,
+        gap=int(data.get("gap", 28)),
+        margin=int(data.get("margin", 8)),
+        blocks=tuple(blocks),
+        qrcode=qrcode,
+        auto_height=bool(data.get("auto_height", False)),
+        bottom=int(data.get("bottom", top)),
+    )
+
+
+DEFAULT_PLAN = compile_template(DEFAULT_TEMPLATE, "padrao")
+
+
+class TemplateRegistry:
+    """Templates de ticket em templates/<nome>.json (ou .yaml, se o PyYAML estiver instalado)
+
+    Cada template é compilado uma vez em um RenderPlan e mantido em cache; o arquivo
+    só é relido quando sua data de modificação muda (verificada no máximo uma vez
+    por segundo). A escolha é feita pelo parâmetro "template" da requisição, pelo
+    mapa "service_templates" da configuração ou por "default_template".
+    """
+    CHECK_INTERVAL = 1.0
+    EXTENSIONS = (".json", ".yaml", ".yml")
+
+    def __init__(self, directory="templates"):
+        self.directory = directory
+        self.entries = {}  # nome -> [caminho, mtime, plano, última verificação]
+        self.lock = threading.Lock()
+
+    def _find_file(self, name):
+        for extension in self.EXTENSIONS:
+            path = os.path.join(self.directory, name + extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _load(self, path, name):
+        with open(path, 'r', encoding='utf-8') as f:
+            if path.endswith(".json"):
+                data = json.load(f)
+            else:
+                import yaml  # Opcional: apenas para templates .yaml
+                data = yaml.safe_load(f)
+        return compile_template(data, name)
+
+    def get(self, name):
+        """Plano do template pelo nome (None se não existir ou for inválido)"""
+        if not name or not all(ch.isalnum() or ch in "-_" for ch in name):
+            return None
+        now = time.monotonic()
+        entry = self.entries.get(name)
+        if entry and now - entry[3] < self.CHECK_INTERVAL:
+            return entry[2]
+        with self.lock:
+            entry = self.entries.get(name)
+            path = self._find_file(name)
+            if path is None:
+                self.entries.pop(name, None)
+                return None
+            mtime = os.path.getmtime(path)
+            if entry and entry[0] == path and entry[1] == mtime:
+                entry[3] = now
+                return entry[2]
+            try:
+                plan = self._load(path, name)
+                print(f"📐 Template '{name}' compilado de {path}")
+            except Exception as e:
+                print(f"⚠️ Template '{name}' inválido ({path}): {e}")
+                plan = entry[2] if entry else None  # Mantém a última versão válida
+            self.entries[name] = [path, mtime, plan, now]
+            return plan
+
+    def names(self):
+        """Nomes dos templates presentes no diretório (para o aquecimento)"""
+        try:
+            files = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted({os.path.splitext(f)[0] for f in files if f.endswith(self.EXTENSIONS)})
+
+    def resolve(self, config, requested=None, services=None):
+        """Escolhe o plano: template pedido, template do serviço, padrão da configuração ou embutido"""
+        candidates = [requested]
+        service_templates = config.get("service_templates") or {}
+        if services:
+            candidates.append(service_templates.get(services))
+            lowered = services.strip().lower()
+            candidates.extend(template for service, template in service_templates.items()
+                              if service.strip().lower() == lowered)
+        candidates.append(config.get("default_template"))
+        for name in candidates:
+            plan = self.get(name) if name else None
+            if plan:
+                return plan
+        return DEFAULT_PLAN
+
+
+_logo_cache = {}
+_logo_lock = threading.Lock()
+
+
+def load_logo(path, width, mode):
+    """Logo decodificado, sem transparência, na largura e no modo da impressora
+
+    Preparado uma única vez por (arquivo, largura, modo): os tickets só colam a
+    imagem pronta, sem decodificar nem redimensionar de novo.
+    """
+    key = (path, width, mode)
+    logo = _logo_cache.get(key)
+    if logo is not None:
+        return logo
+    with _logo_lock:
+        logo = _logo_cache.get(key)
+        if logo is None:
+            from PIL import Image
+
+            with Image.open(path) as source:
+                # Transparência sobre o branco do papel, antes de reduzir as cores
+                flat = Image.new("RGBA", source.size, (255, 255, 255, 255))
+                flat.alpha_composite(source.convert("RGBA"))
+            height = max(1, round(flat.size[1] * width / flat.size[0]))
+            # Redimensiona em tons contínuos; o modo "1" aplica dithering só no final
+            logo = flat.convert("L" if mode in ("L", "1") else "RGB").resize((width, height), Image.Resampling.LANCZOS)
+            if mode == "1":
+                logo = logo.convert("1")
+            _logo_cache[key] = logo
+    return logo
+
+
+class PreparedLayout:
+    """Plano de renderização já resolvido para um perfil de impressora
+
+    Medidas em pixels (escala do perfil + margens da impressora), fontes de cada
+    bloco em todos os tamanhos que o ajuste pode usar, atlas de glifos do código,
+    logos e blocos sem campos são calculados uma vez por (plano, perfil), no
+    aquecimento. Cada ticket só formata os campos e mede o texto variável.
+    """
+    MAX_ENTRIES = 64
+    _cache = collections.OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, plan, profile):
+        import string
+
+        scaled = lambda value: int(round(value * profile.scale))
+        font_size = lambda value: max(8, int(round(value * profile.scale * profile.font_scale)))
+        self.width = profile.width
+        self.height = scaled(plan.height)
+        self.margin = scaled(plan.margin) + profile.mm(profile.margin_mm)
+        self.top = scaled(plan.top) + profile.mm(profile.top_mm)
+        self.bottom = scaled(plan.bottom) + profile.mm(profile.bottom_mm)
+        self.gap = scaled(plan.gap)
+        self.auto_height = plan.auto_height if profile.auto_height is None else profile.auto_height
+        placement = plan.qrcode or DEFAULT_PLAN.qrcode
+        self.qr_size = scaled(placement.size)
+        self.qr_overlap = scaled(placement.overlap)
+        if placement.align == "left":
+            self.qr_x = self.margin
+        elif placement.align == "right":
+            self.qr_x = self.width - self.margin - self.qr_size
+        else:
+            self.qr_x = (self.width - self.qr_size) // 2
+
+        # Blocos: LayoutImage (logo), LayoutBlock pronto (texto fixo) ou PlanBlock com os tamanhos já escalados
+        self.blocks = []
+        self.atlases = {}
+        for block in plan.blocks:
+            if isinstance(block, PlanLogo):
+                logo_width = min(scaled(block.width), self.width - 2 * self.margin)
+                self.blocks.append(LayoutImage(load_logo(block.path, logo_width, profile.mode), block.align))
+                continue
+            size, min_size = font_size(block.font_size), font_size(block.min_font_size)
+            # Pré-carrega as fontes de todos os tamanhos que o ajuste (fit_block) pode tentar
+            current = size
+            while True:
+                ImageGenerator.load_font(current, block.font)
+                if current <= min_size:
+                    break
+                current = max(min_size, current - max(1, current // 10))
+            fields = [field for _, field, _, _ in string.Formatter().parse(block.text) if field is not None]
+            if not fields:
+                self.blocks.append(LayoutBlock(block.text, size, max_lines=block.max_lines, min_font_size=min_size,
+                                               align=block.align, font_name=block.font))
+                continue
+            self.blocks.append(block._replace(font_size=size, min_font_size=min_size))
+            if "code" in fields:
+                literal = "".join(text for text, _, _, _ in string.Formatter().parse(block.text))
+                font = ImageGenerator.load_font(size, block.font)
+                self.atlases[font] = GlyphAtlas.get(font, profile.mode, CODE_ALPHABET + literal)
+
+    @classmethod
+    def get(cls, plan=None, profile=None):
+        """Layout do plano no perfil, calculado uma única vez por processo"""
+        plan = plan or DEFAULT_PLAN
+        profile = profile or PrinterProfile()
+        key = (plan, profile.key)
+        with cls._lock:
+            layout = cls._cache.get(key)
+            if layout is not None:
+                cls._cache.move_to_end(key)
+                return layout
+        layout = PreparedLayout(plan, profile)
+        with cls._lock:
+            cls._cache[key] = layout
+            while len(cls._cache) > cls.MAX_ENTRIES:
+                cls._cache.popitem(last=False)  # Planos antigos de templates recarregados
+        return layout
+
+
+class ImageGenerator:
+    # Cache de fontes por (arquivo, tamanho), compartilhado entre instâncias (uma instância é criada por requisição)
+    _font_cache = {}
+    _font_lock = threading.Lock()
+
+    def __init__(self, profile=None, plan=None):
+        self.image = None
+        self.qr_image = None
+        self.qr_position = None  # Posição do QR reservada pelo layout (altura automática)
+        self.content_bottom = 0
+        self.profile = profile or PrinterProfile()
+        self.plan = plan or DEFAULT_PLAN
+        self.layout = PreparedLayout.get(self.plan, self.profile)
+        self.auto_height = self.layout.auto_height
+        self.IMAGE_SIZE = (self.layout.width, self.layout.height)
+
+    @classmethod
+    def load_font(cls, size, name="arial.ttf"):
+        """Carrega uma fonte uma única vez por processo, arquivo e tamanho"""
+        key = (name, size)
+        font = cls._font_cache.get(key)
+        if font is not None:
+            return font
+        with cls._font_lock:
+            font = cls._font_cache.get(key)
+            if font is None:
+                from PIL import ImageFont
+                try:
+                    font = ImageFont.truetype(name, size=size)
+                except:
+                    try:
+                        font = ImageFont.load_default(size=size)
+                    except TypeError:
+                        font = ImageFont.load_default()
+                cls._font_cache[key] = font
+        return font
+
+    @classmethod
+    def load_fonts(cls, scale=1.0, plan=None):
+        """Pré-carrega as fontes de um plano de renderização em uma escala"""
+        return [cls.load_font(max(8, int(round(block.font_size * scale))), block.font)
+                for block in (plan or DEFAULT_PLAN).blocks if isinstance(block, PlanBlock)]
+
+    def create_image(self, created_date, code, services, header, footer, qrcode=None):
+        """Desenha o ticket em memória seguindo o plano de renderização"""
+        from PIL import Image, ImageDraw
+
+        profile = self.profile
+        layout = self.layout
+        width = layout.width
+        values = {"created_date": created_date, "code": code, "services": services,
+                  "header": header, "footer": footer, "qrcode": qrcode or ""}
+
+        # Blocos empilhados pela altura medida; textos longos quebram linha e/ou diminuem a fonte
+        blocks = []
+        for block in layout.blocks:
+            if not isinstance(block, PlanBlock):
+                blocks.append(block)  # Logo ou texto fixo, prontos no layout do perfil
+                continue
+            text = block.text.format_map(values)
+            if self.auto_height and not text.strip():
+                continue  # Campo vazio (ex.: sem rodapé) não gasta papel
+            blocks.append(LayoutBlock(
+                text,
+                block.font_size,
+                max_lines=block.max_lines,
+                min_font_size=block.min_font_size,
+                align=block.align,
+                font_name=block.font,
+            ))
+        lines, bottom = layout_blocks(
+            blocks, width, self.load_font,
+            top=layout.top,
+            gap=layout.gap,
+            margin=layout.margin,
+        )
+
+        # Desenha direto no modo da impressora (sem conversão ou dithering posterior)
+        self.content_bottom = bottom - layout.top
+        self.qr_position = None
+        if self.auto_height:
+            # Bobina contínua: a altura vem do conteúdo medido e o QR entra no mesmo canvas
+            height = self.content_bottom + layout.bottom
+            if qrcode is not None:
+                qr_y = self.content_bottom + layout.gap // 2  # A borda branca do QR completa o espaço
+                self.qr_position = (layout.qr_x, qr_y)
+                height = qr_y + layout.qr_size + layout.bottom
+        else:
+            height = max(self.IMAGE_SIZE[1], bottom + profile.mm(profile.bottom_mm))
+        self.image = Image.new(profile.mode, (width, height), color=profile.paper_color)
+        draw = ImageDraw.Draw(self.image)
+        atlases = layout.atlases
+        for x, y, text, font in lines:
+            if font is None:
+                self.image.paste(text, (x, y))  # Logo: uma única colagem da camada pronta
+                continue
+            atlas = atlases.get(font)
+            if atlas is not None and atlas.covers(text):
+                atlas.draw(self.image, (x, y), text, profile.ink_color)  # Código: glifos prontos
+            else:
+                draw.text((x, y), text, font=font, fill=profile.ink_color)
+
+        return self.image
+
+    def create_qrcode(self, code):
+        """Gera a imagem do QR Code em memória"""
+        import qrcode
+
+        qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=4, border=4)
+        qr.add_data(code)
+        qr.make(fit=True)
+        self.qr_image = qr.make_image(fill_color="black", back_color="white").get_image()
+        return self.qr_image
+
+    def combine(self):
+        """Junta o ticket e o QR Code em uma única imagem (sem reabrir arquivos)"""
+        from PIL import Image
+
+        layout = self.layout
+        qr_size = layout.qr_size
+        img2 = self.qr_image.resize((qr_size, qr_size), Image.Resampling.NEAREST)
+        if self.qr_position is not None:
+            # Altura automática: o espaço já foi reservado no canvas do texto
+            self.image.paste(img2, self.qr_position)
+            return self.image
+        img = self.image
+        img_width, img_height = img.size
+        # Sobreposto à margem inferior conforme o template, mas nunca sobre o texto medido
+        qr_y = max(img_height - layout.qr_overlap, self.content_bottom)
+        qr_x = layout.qr_x
+        img_with_spacer = Image.new(self.profile.mode, (img_width, qr_y + qr_size + qr_size // 2), color=self.profile.paper_color)
+        img_with_spacer.paste(img, (0, 0))
+        img_with_spacer.paste(img2, (qr_x, qr_y))
+        self.image = img_with_spacer
+        return self.image
+
+    def render(self, created_date, code, services, header, footer, qrcode=None):
+        """Renderiza o ticket completo (com QR Code se informado)"""
+        with tracer.span("desenhar texto"):
+            self.create_image(created_date, code, services, header, footer, qrcode)
+        if qrcode is not None:
+            with tracer.span("gerar QR Code"):
+                self.create_qrcode(qrcode)
+            with tracer.span("combinar imagens"):
+                self.combine()
+        return self.image
+
+    def encode(self):
+        """Codifica a imagem atual conforme o codificador do perfil"""
+        return encode_image(self.image, self.profile)
+
+
+def encode_image(image, profile):
+    """Codifica uma imagem com o codificador do perfil (png, pbm ou raw)"""
+    import io
+
+    if profile.encoder == "raw":
+        return encode_escpos_raster(image)
+    buffer = io.BytesIO()
+    if profile.encoder == "pbm":
+        image = image if image.mode == "1" else image.convert("1")
+        image.save(buffer, format="PPM")  # Modo "1" é gravado como PBM binário (P4)
+    else:
+        options = {"compress_level": profile.compress_level}
+        if profile.dpi:
+            options["dpi"] = (profile.dpi, profile.dpi)
+        image.save(buffer, format="PNG", **options)
+    return buffer.getvalue()
+
+
+# Inverte os bits do raster do PIL (1 = branco) para o ESC/POS (1 = ponto preto)
+_INVERT_BITS = bytes(255 - i for i in range(256))
+
+
+def encode_escpos_raster(image, cut=True):
+    """Converte a imagem em comandos ESC/POS de raster (GS v 0), com avanço e corte no final"""
+    if image.mode != "1":
+        image = image.convert("1")
+    width, height = image.size
+    if width % 8:
+        from PIL import Image
+        padded = Image.new("1", (width + 8 - width % 8, height), color=1)
+        padded.paste(image, (0, 0))
+        image = padded
+        width = image.size[0]
+    bytes_per_row = width // 8
+    data = image.tobytes().translate(_INVERT_BITS)
+    header = b"\x1b@" + b"\x1dv0\x00" + bytes((bytes_per_row & 0xFF, bytes_per_row >> 8,
+                                                 height & 0xFF, height >> 8))
+    footer = b"\x1bd\x03" + (b"\x1dV\x01" if cut else b"")  # Avança 3 linhas e corte parcial
+    return header + data + footer
+
+
+def render_ticket_bytes(fields, profile=None, plan=None):
+    """Renderiza um ticket e devolve os bytes codificados (executado na thread ou em um worker)"""
+    generator = ImageGenerator(profile, plan)
+    generator.render(**fields)
+    with tracer.span("codificar", encoder=generator.profile.encoder):
+        return generator.encode()
+
+
+# Arquivos temporários entregues ao spooler quando o arquivo em pacotes está ativo
+SPOOL_DIR = os.path.join("ticket", "spool")
+
+
+def save_ticket(payload, extension="png", suffix="", directory="ticket"):
+    """Grava o ticket renderizado na pasta ticket/ (ou `directory`) e devolve o caminho"""
+    from datetime import datetime
+
+    # Microssegundos no nome: vários tickets no mesmo segundo não se sobrescrevem
+    date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    image_path = os.path.join(os.getcwd(), directory, f"{date}{suffix}.{extension}")
+    with open(image_path, 'wb') as f:
+        f.write(payload)
+    return image_path
+
+
+def guess_ticket_extension(payload):
+    """Extensão de um ticket já renderizado, pelo conteúdo"""
+    if payload.startswith(b"\x89PNG"):
+        return "png"
+    if payload.startswith(b"P4"):
+        return "pbm"
+    return PrinterProfile.EXTENSIONS["raw"]
+
+
+def spool_copy(payload, extension, config):
+    """Cópia temporária em ticket/spool/ de um ticket arquivado em pacote
+
+    Só os destinos que imprimem a partir de um arquivo (comando do sistema) precisam
+    dela; os que recebem os bytes (tcp, simulator) imprimem direto do payload (None).
+    """
+    if not create_print_sink(config).needs_file:
+        return None
+    return save_ticket(payload, extension, directory=SPOOL_DIR)
+
+
+def remove_files(paths):
+    """Apaga arquivos temporários, ignorando os que já não existem"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class TicketArchive:
+    """Arquivo append-only dos tickets renderizados, em segmentos diários
+
+    Cada dia vira um par ticket/arquivo/AAAA-MM-DD.pack (bytes dos tickets, um após
+    o outro) + .idx (registros fixos: dia, sequência, posição, tamanho), em vez de
+    um arquivo por ticket. A leitura usa mmap. Segmentos de meses anteriores são
+    compactados em um único AAAA-MM.pack, e a retenção apaga segmentos inteiros.
+
+    Localizador de um ticket: "arquivo:AAAA-MM-DD:sequência".
+    """
+    PREFIX = "arquivo:"
+    RECORD = struct.Struct("<IIQI")  # dia (ordinal), sequência, posição no .pack, tamanho
+
+    def __init__(self, directory=os.path.join("ticket", "arquivo")):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.day = None
+        self.pack = None
+        self.index = None
+        self.next_seq = 0
+        self.offset = 0
+        self.maps = {}  # segmento -> (tamanho, arquivo .pack, mmap .pack, arquivo .idx, mmap .idx)
+
+    def _paths(self, segment):
+        base = os.path.join(self.directory, segment)
+        return base + ".pack", base + ".idx"
+
+    def segments(self):
+        """Nomes dos segmentos existentes (AAAA-MM-DD diários e AAAA-MM compactados)"""
+        return sorted(name[:-5] for name in os.listdir(self.directory) if name.endswith(".pack"))
+
+    def _open_day(self, day):
+        """Abre (ou retoma) o segmento do dia, descartando uma escrita interrompida no final"""
+        if self.pack:
+            self.pack.close()
+            self.index.close()
+        segment = day.isoformat()
+        self._unmap(segment)
+        pack_path, index_path = self._paths(segment)
+        size = self.RECORD.size
+        pack = open(pack_path, "a+b")
+        index = open(index_path, "a+b")
+        pack_size = pack.seek(0, os.SEEK_END)
+        count = index.seek(0, os.SEEK_END) // size
+        end = 0
+        while count:
+            index.seek((count - 1) * size)
+            _, _, offset, length = self.RECORD.unpack(index.read(size))
+            if offset + length <= pack_size:
+                end = offset + length
+                break
+            count -= 1  # Índice gravado sem os bytes do ticket: descarta
+        index.truncate(count * size)
+        pack.truncate(end)
+        self.day, self.pack, self.index = day, pack, index
+        self.next_seq, self.offset = count, end
+
+    def append(self, payload):
+        """Acrescenta um ticket ao segmento do dia e devolve o localizador"""
+        from datetime import date
+
+        today = date.today()
+        with self.lock:
+            if self.day != today:
+                self._open_day(today)
+            seq = self.next_seq
+            # Bytes antes do índice: um registro de índice sempre aponta para dados completos
+            self.pack.write(payload)
+            self.pack.flush()
+            self.index.write(self.RECORD.pack(today.toordinal(), seq, self.offset, len(payload)))
+            self.index.flush()
+            self.offset += len(payload)
+            self.next_seq += 1
+        return f"{self.PREFIX}{today.isoformat()}:{seq}"
+
+    def _map(self, segment):
+        """mmap do segmento (refeito se o arquivo cresceu); None se não existe ou está vazio"""
+        import mmap
+
+        pack_path, index_path = self._paths(segment)
+        try:
+            size = os.path.getsize(index_path)
+        except OSError:
+            return None
+        cached = self.maps.get(segment)
+        if cached and cached[0] == size:
+            return cached
+        self._unmap(segment)
+        if size == 0 or os.path.getsize(pack_path) == 0:
+            return None
+        pack = open(pack_path, "rb")
+        index = open(index_path, "rb")
+        entry = (size, pack, mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ),
+                 index, mmap.mmap(index.fileno(), size, access=mmap.ACCESS_READ))
+        self.maps[segment] = entry
+        return entry
+
+    def _unmap(self, segment):
+        entry = self.maps.pop(segment, None)
+        if entry:
+            _, pack, pack_map, index, index_map = entry
+            pack_map.close()
+            index_map.close()
+            pack.close()
+            index.close()
+
+    def _find(self, index_map, key):
+        """Busca binária de (dia, sequência) no índice; devolve (posição, tamanho) ou None"""
+        size = self.RECORD.size
+        low, high = 0, len(index_map) // size
+        while low < high:
+            middle = (low + high) // 2
+            day, seq, offset, length = self.RECORD.unpack_from(index_map, middle * size)
+            if (day, seq) == key:
+                return offset, length
+            if (day, seq) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def read(self, locator):
+        """Lê os bytes de um ticket arquivado; KeyError se não existe (ou já foi apagado)"""
+        from datetime import date
+
+        if not locator.startswith(self.PREFIX):
+            raise ValueError(f"localizador inválido: {locator}")
+        day_text, seq = locator[len(self.PREFIX):].rsplit(":", 1)
+        key = (date.fromisoformat(day_text).toordinal(), int(seq))
+        with self.lock:
+            for segment in (day_text, day_text[:7]):
+                entry = self._map(segment)
+                record = entry and self._find(entry[4], key)
+                if record:
+                    offset, length = record
+                    return entry[2][offset:offset + length]
+        raise KeyError(locator)
+
+    def _records(self, segment):
+        """Lê todos os registros de um segmento fechado: [(dia, sequência, bytes)]"""
+        pack_path, index_path = self._paths(segment)
+        with open(index_path, "rb") as f:
+            index = f.read()
+        with open(pack_path, "rb") as f:
+            pack = f.read()
+        records = []
+        for position in range(0, len(index) - len(index) % self.RECORD.size, self.RECORD.size):
+            day, seq, offset, length = self.RECORD.unpack_from(index, position)
+            records.append((day, seq, pack[offset:offset + length]))
+        return records
+
+    def compact(self):
+        """Junta os segmentos diários de meses anteriores em um segmento por mês"""
+        from datetime import date
+
+        current_month = date.today().isoformat()[:7]
+        months = sorted({name[:7] for name in self.segments() if len(name) == 10 and name[:7] < current_month})
+        for month in months:
+            daily = [name for name in self.segments() if len(name) == 10 and name.startswith(month)]
+            # Registros de uma compactação anterior interrompida entram uma única vez
+            records = self._records(month) if month in self.segments() else []
+            seen = {(day, seq) for day, seq, _ in records}
+            for name in daily:
+                records.extend(r for r in self._records(name) if (r[0], r[1]) not in seen)
+            records.sort(key=lambda r: (r[0], r[1]))
+            pack_path, index_path = self._paths(month)
+            offset = 0
+            with open(pack_path + ".tmp", "wb") as pack, open(index_path + ".tmp", "wb") as index:
+                for day, seq, payload in records:
+                    pack.write(payload)
+                    index.write(self.RECORD.pack(day, seq, offset, len(payload)))
+                    offset += len(payload)
+            with self.lock:
+                self._unmap(month)
+                os.replace(pack_path + ".tmp", pack_path)
+                os.replace(index_path + ".tmp", index_path)
+                for name in daily:
+                    self._unmap(name)
+                    remove_files(self._paths(name))
+            print(f"🗜️ Arquivo de tickets {month} compactado: {len(daily)} segmentos, {len(records)} tickets")
+
+    def delete_older_than(self, days):
+        """Apaga os segmentos cujo último dia é anterior a `days` dias atrás"""
+        import calendar
+        from datetime import date, timedelta
+
+        cutoff = date.today() - timedelta(days=days)
+        removed = []
+        for name in self.segments():
+            if len(name) == 10:
+                last_day = date.fromisoformat(name)
+            else:
+                year, month = map(int, name.split("-"))
+                last_day = date(year, month, calendar.monthrange(year, month)[1])
+            if last_day < cutoff and last_day != self.day:
+                with self.lock:
+                    self._unmap(name)
+                    remove_files(self._paths(name))
+                removed.append(name)
+        if removed:
+            print(f"🗑️ Segmentos de tickets apagados (mais de {days} dias): {', '.join(removed)}")
+        return removed
+
+    def maintenance(self, retention_days=0):
+        """Compactação e retenção (executada em background na inicialização)"""
+        try:
+            self.compact()
+            if retention_days:
+                self.delete_older_than(retention_days)
+        except Exception as e:
+            print(f"⚠️ Erro na manutenção do arquivo de tickets: {e}")
+
+
+def current_rss_bytes():
+    """Memória residente (RSS) do processo atual em bytes, ou None se indisponível"""
+    try:
+        if os.name == 'nt':
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                            ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                            ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return counters.WorkingSetSize
+            return None
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return None
+
+
+def _render_worker_init(layouts=()):
+    """Inicializa um worker de renderização: importa PIL/qrcode e prepara os layouts (plano, perfil)"""
+    import qrcode
+    from PIL import Image, ImageDraw
+    ImageGenerator.load_fonts()
+    PreparedLayout.get()
+    for plan, profile in layouts:
+        try:
+            PreparedLayout.get(plan, profile)
+        except Exception as e:
+            print(f"⚠️ Erro ao preparar layout '{plan.name}' ({profile.name}): {e}")
+
+
+def _render_worker_job(fields, profile, plan):
+    """Executa uma renderização no worker e informa a memória residente atual"""
+    return render_ticket_bytes(fields, profile, plan), current_rss_bytes()
+
+
+class RenderExecutor:
+    """Renderização em pool de processos, com reciclagem dos workers
+
+    O pool inteiro é substituído após max_jobs_per_worker * workers renderizações ou
+    quando algum worker ultrapassa max_worker_memory_mb, contendo o crescimento de
+    memória do Pillow. O novo pool é criado em outra thread enquanto o atual continua
+    atendendo; o antigo termina os trabalhos em andamento antes de sair. Cada worker
+    novo já prepara os `layouts` (pares plano, perfil) configurados.
+    """
+    def __init__(self, workers, max_jobs_per_worker=500, max_worker_memory_mb=300, timeout=30, layouts=()):
+        self.workers = max(1, int(workers))
+        self.max_jobs = max(1, int(max_jobs_per_worker)) * self.workers
+        self.max_memory = int(max_worker_memory_mb) * 1024 * 1024 if max_worker_memory_mb else None
+        self.timeout = timeout
+        self.layouts = list(layouts)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.jobs_in_pool = 0
+        self.recycling = False  # Um pool novo está sendo criado em segundo plano
+        self.recycled = 0
+
+    def start(self):
+        """Cria o pool e aguarda os workers carregarem fontes e módulos"""
+        with self.lock:
+            if self.pool is None:
+                self.pool = self._new_pool()
+                self.jobs_in_pool = 0
+
+    def _new_pool(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # "spawn" em todas as plataformas: fork com as threads do Flask ativas é inseguro
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_render_worker_init,
+                                   initargs=(self.layouts,), mp_context=multiprocessing.get_context("spawn"))
+        # Força a criação dos workers agora, fora do caminho da requisição
+        for future in [pool.submit(current_rss_bytes) for _ in range(self.workers)]:
+            future.result()
+        return pool
+
+    def _recycle(self, reason):
+        """Inicia a troca do pool em segundo plano (chamado com self.lock adquirido)"""
+        if self.recycling:
+            return
+        self.recycling = True
+        print(f"♻️ Reciclando workers de renderização ({reason})")
+        threading.Thread(target=self._replace_pool, name="render-recycle", daemon=True).start()
+
+    def _replace_pool(self):
+        try:
+            new_pool = self._new_pool()
+        except Exception as e:
+            print(f"⚠️ Erro ao criar novo pool de renderização: {e}")
+            with self.lock:
+                self.recycling = False
+            return
+        with self.lock:
+            old_pool, self.pool = self.pool, new_pool
+            self.jobs_in_pool = 0
+            self.recycling = False
+            self.recycled += 1
+        if old_pool is not None:
+            old_pool.shutdown(wait=True)
+
+    def render(self, fields, profile=None, plan=None):
+        """Renderiza um ticket em um worker e devolve os bytes"""
+        with self.lock:
+            if self.pool is None:
+                self.pool = self._new_pool()
+                self.jobs_in_pool = 0
+            if self.jobs_in_pool >= self.max_jobs:
+                self._recycle(f"{self.jobs_in_pool} renderizações")
+            pool = self.pool
+            self.jobs_in_pool += 1
+
+        try:
+            future = pool.submit(_render_worker_job, fields, profile, plan)
+        except RuntimeError:
+            # O pool foi trocado e encerrado entre a leitura acima e o envio: usa o novo
+            with self.lock:
+                pool = self.pool
+            future = pool.submit(_render_worker_job, fields, profile, plan)
+        payload, rss = future.result(timeout=self.timeout)
+
+        if self.max_memory and rss and rss > self.max_memory:
+            with self.lock:
+                if self.pool is pool:
+                    self._recycle(f"worker com {rss // (1024 * 1024)} MB")
+        return payload
+
+    def ping(self, timeout=2):
+        """Workers respondem (tarefa trivial, sem renderizar)"""
+        for _ in range(2):  # Segunda tentativa se o pool foi trocado durante a chamada
+            with self.lock:
+                pool = self.pool
+            if pool is None:
+                return False
+            try:
+                pool.submit(current_rss_bytes).result(timeout=timeout)
+                return True
+            except RuntimeError:
+                continue
+            except Exception:
+                return False
+        return False
+
+    def shutdown(self):
+        """Encerra o pool de workers"""
+        with self.lock:
+            if self.pool:
+                self.pool.shutdown(wait=False)
+                self.pool = None
+
+
+def merge_payloads(payloads, profile):
+    """Junta vários tickets em um único documento de impressão
+
+    Raster ESC/POS: concatena os comandos (cada ticket já termina com corte).
+    Imagens: empilha os tickets em uma única imagem contínua com uma linha de
+    corte tracejada entre eles (o mspaint imprime só a primeira página de
+    documentos com várias páginas).
+    """
+    if profile.encoder == "raw":
+        return b"".join(payloads)
+
+    import io
+    from PIL import Image, ImageDraw
+
+    images = [Image.open(io.BytesIO(payload)) for payload in payloads]
+    try:
+        gap = max(8, int(round(20 * profile.scale)))
+        width = max(image.size[0] for image in images)
+        height = sum(image.size[1] for image in images) + gap * (len(images) - 1)
+        merged = Image.new(profile.mode, (width, height), color=profile.paper_color)
+        draw = ImageDraw.Draw(merged)
+        y = 0
+        for index, image in enumerate(images):
+            merged.paste(image, (0, y))
+            y += image.size[1]
+            if index < len(images) - 1:
+                line_y = y + gap // 2
+                for x in range(0, width, 12):
+                    draw.line([(x, line_y), (min(x + 6, width), line_y)], fill=profile.ink_color)
+                y += gap
+        return encode_image(merged, profile)
+    finally:
+        for image in images:
+            image.close()
+
+
+# Faixas de prioridade da fila da impressora, da mais urgente para a menos urgente
+PRIORITY_LANES = ("alta", "normal", "baixa")
+PRIORITY_ALIASES = {"preferencial": "alta", "prioritario": "alta", "prioritário": "alta"}
+
+
+def resolve_priority(config, requested, services):
+    """Escolhe a faixa do ticket: parâmetro `priority`, depois `service_priorities`, senão "normal"
+
+    Levanta ValueError para uma prioridade desconhecida.
+    """
+    if not requested:
+        mapping = config.get("service_priorities") or {}
+        requested = mapping.get(services)
+        if requested is None and services:
+            lowered = services.strip().lower()
+            requested = next((lane for name, lane in mapping.items() if name.lower() == lowered), None)
+    if not requested:
+        return "normal"
+    lane = requested.strip().lower()
+    lane = PRIORITY_ALIASES.get(lane, lane)
+    if lane not in PRIORITY_LANES:
+        raise ValueError(f"prioridade inválida: {requested} (use {', '.join(PRIORITY_LANES)} ou preferencial)")
+    return lane
+
+
+class PrintJob:
+    """Um ticket a caminho da impressora, com o status acompanhado pela requisição"""
+    def __init__(self, code, payload, image_path, impressora, profile, config, priority="normal",
+                 fields=None, template=None, on_complete=None, locator=None):
+        import uuid
+
+        self.id = uuid.uuid4().hex[:12]
+        self.code = code
+        self.payload = payload
+        self.image_path = image_path
+        self.locator = locator  # Posição no arquivo em pacotes; image_path é então temporário (ou None)
+        self.impressora = impressora
+        self.profile = profile
+        self.config = config
+        self.priority = priority
+        self.fields = fields or {"code": code}
+        self.template = template
+        self.on_complete = on_complete  # Chamado uma vez com o resultado final (ex.: histórico)
+        self.promoted = False  # Passou à frente por envelhecimento (aging)
+        self.created = time.time()
+        self.status = "na fila"
+        self.error = None
+        self.done = threading.Event()
+        self.trace_id = tracer.current()  # Propaga o trace da requisição para a thread da fila
+
+    def batch_key(self):
+        """Tickets só são agrupados se vão para a mesma impressora com o mesmo formato"""
+        profile = self.profile
+        return (self.impressora, profile.mode, profile.width, profile.encoder, repr(self.config.get("print_command")),
+                repr(self.config.get("print_sink")))
+
+    def finish(self, ok, error=None):
+        """Registra o resultado e libera quem está aguardando"""
+        self.status = "enviado" if ok else "erro"
+        self.error = error
+        self.done.set()
+        if not ok:
+            self._notify()
+
+    def complete(self, ok, error=None):
+        """Resultado final do processo de impressão (coletado pelo supervisor)"""
+        self.status = "impresso" if ok else "erro"
+        self.error = error
+        self.done.set()
+        self._notify()
+
+    def _notify(self):
+        callback, self.on_complete = self.on_complete, None
+        if callback:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"⚠️ Erro ao registrar resultado do ticket {self.code}: {e}")
+
+    def cancel(self, reason):
+        """Retirado da fila antes de chegar à impressora (ex.: encaminhado a outra instância)"""
+        self.on_complete = None  # Não imprimiu aqui: o histórico fica com quem imprimir
+        self.status = "cancelado"
+        self.error = RuntimeError(reason)
+        self.done.set()
+
+    def persisted(self):
+        """Ticket guardado no diário de pendentes durante o encerramento (impresso ao reiniciar)"""
+        self.status = "pendente"
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """Aguarda o envio ao spooler; retorna True se foi enviado (ou guardado) com sucesso"""
+        return self.done.wait(timeout) and self.status != "erro"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "code": self.code,
+            "impressora": self.impressora,
+            "prioridade": self.priority,
+            "status": self.status,
+            "erro": str(self.error) if self.error else None,
+            "criado": self.created,
+        }
+
+
+class PipelineClosed(Exception):
+    """A fila foi fechada pelo encerramento: o ticket deve ir para o diário de pendentes"""
+
+
+class PendingJournal:
+    """Diário dos tickets que não chegaram à impressora antes do encerramento
+
+    Cada ticket vira uma linha JSON com os campos e onde está o arquivo já
+    renderizado; no próximo início eles são reenviados antes de qualquer ticket novo.
+    """
+    def __init__(self, path=os.path.join("ticket", "pendentes.jsonl")):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def save(self, job):
+        record = {
+            "id": job.id, "code": job.code, "fields": job.fields, "impressora": job.impressora,
+            "priority": job.priority, "template": job.template, "locator": job.locator,
+            "path": job.image_path, "created": job.created,
+        }
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def take(self):
+        """Lê e remove o diário; devolve a lista de tickets pendentes"""
+        with self.lock:
+            if not os.path.exists(self.path):
+                return []
+            records = []
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        pass  # Linha incompleta (encerramento abrupto durante a escrita)
+            os.remove(self.path)
+            return records
+
+
+class ProcessSupervisor:
+    """Controla os processos de impressão (mspaint, lp...) disparados pela fila
+
+    Limita quantos processos rodam ao mesmo tempo (os demais tickets aguardam na
+    fila), encerra processos que passam do tempo limite e coleta o código de saída,
+    repassando sucesso ou falha ao status do ticket e ao log.
+    """
+    POLL_INTERVAL = 0.1
+    KILL_WAIT = 5  # Segundos aguardando um processo encerrado terminar antes de abandoná-lo
+
+    def __init__(self, send_log, max_processes=2, timeout=60):
+        self.send_log = send_log
+        self.max_processes = max(1, int(max_processes))
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(self.max_processes)
+        self.running = []  # [(processo, tickets, início, prazo, arquivos temporários)]
+        self.closing = False  # Encerramento: não inicia novos processos
+        self.consecutive_failures = 0  # Saúde da impressora local (usada pela federação)
+        self.last_failure = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._reap_loop, name="print-supervisor", daemon=True)
+        self.thread.start()
+
+    def launch(self, spawn, jobs, cleanup=()):
+        """Inicia um processo de impressão, aguardando uma vaga se o limite foi atingido
+
+        `spawn` devolve o Popen; destinos sem processo (None) são considerados concluídos.
+        Os arquivos em `cleanup` são apagados quando o processo termina.
+        """
+        while not self.slots.acquire(timeout=self.POLL_INTERVAL):
+            if self.closing:
+                raise PipelineClosed()
+        if self.closing:
+            self.slots.release()
+            raise PipelineClosed()
+        try:
+            process = spawn()
+        except Exception:
+            self.slots.release()
+            remove_files(cleanup)
+            self._record_result(False)
+            raise
+        if process is None:
+            self.slots.release()
+            remove_files(cleanup)
+            for job in jobs:
+                job.complete(True)
+            return
+        started = time.time()
+        with self.condition:
+            self.running.append((process, jobs, started, time.monotonic() + self.timeout, cleanup))
+            self.condition.notify()
+        for job in jobs:
+            job.finish(True)
+
+    def active(self):
+        with self.condition:
+            return len(self.running)
+
+    def _reap_loop(self):
+        while True:
+            with self.condition:
+                while not self.running:
+                    self.condition.wait()
+                entries = list(self.running)
+            for entry in entries:
+                if self._check(entry):
+                    with self.condition:
+                        self.running.remove(entry)
+                    self.slots.release()
+            time.sleep(self.POLL_INTERVAL)
+
+    def _check(self, entry):
+        """Verifica um processo; retorna True quando ele terminou (ou foi encerrado)"""
+        process, jobs, started, deadline, cleanup = entry
+        codes = ", ".join(job.code for job in jobs)
+        returncode = process.poll()
+        if returncode is None:
+            if time.monotonic() < deadline:
+                return False
+            process.kill()
+            try:
+                process.wait(timeout=self.KILL_WAIT)
+            except subprocess.TimeoutExpired:
+                pass  # Não terminou nem após kill(): o handle é abandonado e a vaga liberada
+            error = TimeoutError(f"processo de impressão encerrado após {self.timeout}s")
+            self.send_log(f"Processo de impressão excedeu {self.timeout}s e foi encerrado: {codes}", "ERROR",
+                          "❌ Impressora não respondeu", "error")
+        elif returncode != 0:
+            error = RuntimeError(f"processo de impressão terminou com código {returncode}")
+            self.send_log(f"Processo de impressão falhou (código {returncode}): {codes}", "ERROR",
+                          "❌ Falha ao imprimir", "error")
+        else:
+            error = None
+        remove_files(cleanup)
+        self._record_result(error is None)
+        for job in jobs:
+            job.complete(error is None, error)
+            if job.trace_id:
+                tracer.record(job.trace_id, "processo de impressão", started, time.time() - started,
+                              {"codigo_saida": returncode})
+        return True
+
+    def _record_result(self, ok):
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures += 1
+            self.last_failure = time.monotonic()
+
+    def health(self):
+        """Falhas seguidas da impressora local e há quantos segundos foi a última"""
+        since = time.monotonic() - self.last_failure if self.last_failure is not None else None
+        return {"falhas_seguidas": self.consecutive_failures,
+                "ultima_falha_ha_s": round(since, 1) if since is not None else None}
+
+    def shutdown(self, timeout=5):
+        """Aguarda os processos em andamento terminarem (até `timeout` segundos)"""
+        deadline = time.monotonic() + timeout
+        while self.active() and time.monotonic() < deadline:
+            time.sleep(self.POLL_INTERVAL)
+        return self.active() == 0
+
+
+class PrintPipeline:
+    """Fila com prioridades à frente da impressora, com agrupamento opcional de tickets (micro-lotes)
+
+    Uma única thread envia os tickets: primeiro a faixa "alta" (atendimento
+    preferencial), depois "normal" e "baixa", em ordem de chegada dentro de cada
+    faixa. Um ticket passa à frente dos tickets de faixas mais altas que chegaram
+    mais de aging_ms depois dele, então nenhuma faixa fica parada durante um pico
+    das outras.
+
+    Com batch_window_ms > 0, tickets que chegam próximos são juntados em um único
+    trabalho de impressão (até batch_max). A janela só é aguardada durante picos
+    (quando o envio anterior foi há menos de uma janela): em baixa carga o
+    ticket segue imediatamente.
+    """
+    MAX_TRACKED_JOBS = 500  # Tickets recentes consultáveis por id
+
+    def __init__(self, send_log, batch_window_ms=0, batch_max=10, supervisor=None, aging_ms=10000):
+        self.send_log = send_log
+        self.batch_window = max(0, batch_window_ms) / 1000.0
+        self.batch_max = max(1, int(batch_max))
+        self.aging = max(0, aging_ms) / 1000.0
+        self.supervisor = supervisor or ProcessSupervisor(send_log)
+        self.jobs = collections.OrderedDict()
+        self.jobs_lock = threading.Lock()
+        self.lanes = {lane: collections.deque() for lane in PRIORITY_LANES}
+        self.condition = threading.Condition()
+        self.lane_stats = {lane: {"enviados": 0, "promovidos": 0, "espera_total": 0.0, "espera_max": 0.0}
+                           for lane in PRIORITY_LANES}
+        self.last_dispatch = 0.0
+        self.dispatching = False  # Há um lote retirado da fila e ainda não entregue
+        self.journal = None  # Definido em close(): tickets passam a ir para o diário
+        self.thread = threading.Thread(target=self._run, name="print-pipeline", daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        """Coloca o ticket na faixa da sua prioridade"""
+        with self.jobs_lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.MAX_TRACKED_JOBS:
+                self.jobs.popitem(last=False)
+        with self.condition:
+            if self.journal is None:
+                self.lanes[job.priority].append(job)
+                self.condition.notify()
+                return job
+        self._persist(job)
+        return job
+
+    def _persist(self, job):
+        try:
+            self.journal.save(job)
+            job.persisted()
+        except Exception as e:
+            job.finish(False, e)
+
+    def idle(self):
+        """Nenhum ticket na fila nem sendo entregue"""
+        with self.condition:
+            return not self.dispatching and not any(self.lanes.values())
+
+    def close(self, journal):
+        """Encerramento: tickets ainda na fila (e os que chegarem) vão para o diário"""
+        with self.condition:
+            self.journal = journal
+            self.supervisor.closing = True
+            pending = [job for lane in PRIORITY_LANES for job in self.lanes[lane]]
+            for lane in self.lanes.values():
+                lane.clear()
+        for job in pending:
+            self._persist(job)
+        return len(pending)
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id, reason):
+        """Retira um ticket que ainda aguarda na fila; False se já foi entregue ou está sendo"""
+        with self.condition:
+            for lane in self.lanes.values():
+                job = next((queued for queued in lane if queued.id == job_id), None)
+                if job is not None:
+                    lane.remove(job)
+                    break
+            else:
+                return False
+        if job.locator and job.image_path:
+            remove_files([job.image_path])  # Cópia temporária do spool (o ticket está no arquivo)
+        job.cancel(reason)
+        return True
+
+    def depth(self):
+        """Tickets aguardando em todas as faixas"""
+        with self.condition:
+            return sum(len(lane) for lane in self.lanes.values())
+
+    def metrics(self):
+        """Profundidade e tempos de espera por faixa"""
+        with self.condition:
+            result = {}
+            for lane in PRIORITY_LANES:
+                stats = self.lane_stats[lane]
+                sent = stats["enviados"]
+                result[lane] = {
+                    "na_fila": len(self.lanes[lane]),
+                    "enviados": sent,
+                    "promovidos": stats["promovidos"],
+                    "espera_media_ms": round(stats["espera_total"] / sent * 1000, 1) if sent else 0.0,
+                    "espera_max_ms": round(stats["espera_max"] * 1000, 1),
+                }
+            return result
+
+    def _pick_lane(self):
+        """Faixa do próximo ticket (chamado com self.condition adquirido)
+
+        Compara só o primeiro ticket de cada faixa pela prioridade efetiva: chegada
+        mais um aging por nível abaixo de "alta". Um "normal" passa à frente apenas
+        dos "alta" que chegaram mais de um aging depois dele, então uma fila normal
+        longa não bloqueia os preferenciais que chegam durante o pico.
+        """
+        waiting = [lane for lane in PRIORITY_LANES if self.lanes[lane]]
+        if not waiting:
+            return None
+        lane = min(waiting, key=lambda name: self.lanes[name][0].created + PRIORITY_LANES.index(name) * self.aging)
+        if lane != waiting[0]:
+            self.lanes[lane][0].promoted = True
+        return lane
+
+    def _take(self, timeout=None):
+        """Retira o próximo ticket; None se nada chegar dentro de `timeout`"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: any(self.lanes.values()), timeout):
+                return None
+            self.dispatching = True
+            return self.lanes[self._pick_lane()].popleft()
+
+    def _put_back(self, job):
+        """Devolve um ticket ao início da sua faixa (não coube no lote atual)"""
+        with self.condition:
+            self.lanes[job.priority].appendleft(job)
+
+    def _next_batch(self):
+        """Lê o próximo lote respeitando as prioridades"""
+        first = self._take()
+        batch = [first]
+        if self.batch_window <= 0 or self.batch_max <= 1:
+            return batch
+        
+        # Em pico, aguarda a janela; em baixa carga, pega só o que já está na fila
+        in_burst = time.monotonic() - self.last_dispatch < self.batch_window
+        deadline = time.monotonic() + (self.batch_window if in_burst else 0)
+        while len(batch) < self.batch_max:
+            job = self._take(max(0.0, deadline - time.monotonic()))
+            if job is None:
+                break
+            if job.batch_key() != first.batch_key():
+                self._put_back(job)  # Formato diferente: vai no próximo lote
+                break
+            batch.append(job)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._dispatch(batch)
+            except PipelineClosed:
+                for job in batch:
+                    self._persist(job)
+            except Exception as e:
+                for job in batch:
+                    if not job.done.is_set():
+                        job.finish(False, e)
+            self.last_dispatch = time.monotonic()
+            with self.condition:
+                self.dispatching = False
+
+    def _dispatch(self, batch):
+        """Envia um lote (ou um único ticket) ao destino de impressão"""
+        first = batch[0]
+        started = time.time()
+        with self.condition:
+            for job in batch:
+                stats = self.lane_stats[job.priority]
+                waited = started - job.created
+                stats["enviados"] += 1
+                stats["promovidos"] += job.promoted
+                stats["espera_total"] += waited
+                stats["espera_max"] = max(stats["espera_max"], waited)
+        for job in batch:
+            if job.trace_id:
+                tracer.record(job.trace_id, "fila da impressora", job.created, started - job.created, {"lote": len(batch)})
+        sink = create_print_sink(first.config)
+        if len(batch) == 1:
+            payload, path = first.payload, first.image_path
+        else:
+            with tracer.span("agrupar lote", trace_id=first.trace_id, tickets=len(batch)):
+                payload = merge_payloads([job.payload for job in batch], first.profile)
+                # Tickets arquivados só precisam do lote em disco se o destino imprime a partir de um arquivo
+                path = None
+                if sink.needs_file or not first.locator:
+                    path = save_ticket(payload, first.profile.extension, suffix="-lote",
+                                       directory=SPOOL_DIR if first.locator else "ticket")
+            self.send_log(f"Lote com {len(batch)} tickets agrupado: {', '.join(job.code for job in batch)}", "INFO")
+        try:
+            with tracer.span("enviar ao spooler", trace_id=first.trace_id, impressora=first.impressora):
+                # Tickets arquivados em pacotes: os arquivos do spool são temporários
+                spool = {job.image_path for job in batch if job.locator and job.image_path}
+                if first.locator and path:
+                    spool.add(path)
+                self.supervisor.launch(
+                    lambda: sink.send(path, first.impressora) if sink.needs_file
+                    else sink.send_bytes(payload, first.impressora),
+                    batch, cleanup=spool)
+        except PipelineClosed:
+            if len(batch) > 1 and path:
+                remove_files([path])  # Os tickets do lote são guardados um a um; o arquivo agrupado sobraria
+            raise
+        except Exception as e:
+            for job in batch:
+                job.finish(False, e)
+
+
+class AdmissionController:
+    """Controle de admissão dos endpoints de impressão
+
+    Rejeita cedo (429 + Retry-After), antes de qualquer renderização:
+    - limite de taxa por cliente (token bucket por IP, ou pelo cabeçalho X-Api-Key
+      quando ele é uma das chaves configuradas em api_keys);
+    - limite global de requisições em andamento e de tickets na fila da impressora;
+    - tamanho máximo de cada campo do ticket.
+    """
+    FIELD_LIMITS = {"created_date": 64, "code": 32, "services": 200, "header": 200, "footer": 200, "qrcode": 1000}
+    MAX_CLIENTS = 1000  # Buckets guardados: acima disso descarta os ociosos e, se preciso, os mais antigos
+
+    def __init__(self, enabled=True, rate=10.0, burst=30, max_in_flight=20, max_queue=100, field_limits=None,
+                 api_keys=None):
+        self.enabled = enabled
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_in_flight = int(max_in_flight)
+        self.max_queue = int(max_queue)
+        self.field_limits = dict(self.FIELD_LIMITS, **(field_limits or {}))
+        self.api_keys = frozenset(api_keys or ())
+        self.buckets = collections.OrderedDict()  # cliente -> [fichas, último abastecimento], do mais antigo
+        self.in_flight = 0
+        self.rejected = 0
+        self.last_warning = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Limites da configuração (com server_workers > 1, aplicados só no coordenador)"""
+        data = config.get("admission") or {}
+        return cls(
+            enabled=data.get("enabled", True),
+            rate=data.get("rate_per_client", 10.0),
+            burst=data.get("burst", 30),
+            max_in_flight=data.get("max_in_flight", 20),
+            max_queue=data.get("max_queue", 100),
+            field_limits=data.get("field_limits"),
+            api_keys=data.get("api_keys"),
+        )
+
+    def client_key(self, api_key, remote_addr):
+        """Cliente da requisição: a chave, se for uma das configuradas, senão o IP
+
+        Chaves desconhecidas são ignoradas: trocar de chave a cada requisição não
+        cria um bucket novo nem escapa do limite do IP.
+        """
+        if api_key and api_key in self.api_keys:
+            return "chave:" + api_key
+        return remote_addr
+
+    def check_fields(self, fields):
+        """Retorna o motivo se algum campo passar do limite, ou None"""
+        for name, value in fields.items():
+            limit = self.field_limits.get(name)
+            if limit is not None and len(value) > limit:
+                return f"campo '{name}' excede {limit} caracteres"
+        return None
+
+    def admit(self, client, queue_depth):
+        """Tenta admitir a requisição; retorna None ou (motivo, segundos para tentar de novo)"""
+        if not self.enabled:
+            with self.lock:
+                self.in_flight += 1
+            return None
+        now = time.monotonic()
+        with self.lock:
+            if self.in_flight >= self.max_in_flight or queue_depth >= self.max_queue:
+                self.rejected += 1
+                return "servidor sobrecarregado", 1
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                if len(self.buckets) >= self.MAX_CLIENTS:
+                    self._drop_idle(now)
+                while len(self.buckets) >= self.MAX_CLIENTS:
+                    self.buckets.popitem(last=False)  # Teto rígido: descarta o usado há mais tempo
+                bucket = self.buckets[client] = [self.burst, now]
+            else:
+                self.buckets.move_to_end(client)
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.rejected += 1
+                return "limite de requisições excedido", max(1, int((1 - tokens) / self.rate + 0.999))
+            bucket[0] = tokens - 1
+            self.in_flight += 1
+            return None
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def _drop_idle(self, now):
+        """Descarta os buckets que já estariam cheios (clientes ociosos)"""
+        refill = self.burst / self.rate if self.rate > 0 else float("inf")
+        for client in [c for c, (_, updated) in self.buckets.items() if now - updated >= refill]:
+            del self.buckets[client]
+
+    def should_warn(self):
+        """Limita o log de rejeições a uma linha por segundo durante uma enxurrada"""
+        now = time.monotonic()
+        if now - self.last_warning >= 1.0:
+            self.last_warning = now
+            return True
+        return False
+
+
+class TicketHistory:
+    """Histórico de tickets impressos em SQLite, indexado por código, data, serviço e horário
+
+    As gravações são feitas em lotes por uma thread própria (fora do caminho da
+    requisição). As consultas usam paginação por cursor (id), que continua rápida
+    com milhões de linhas. Cada linha guarda onde está o ticket já renderizado,
+    para reimprimir sem renderizar de novo.
+    """
+    COLUMNS = ("job_id", "code", "created_date", "services", "header", "footer", "qrcode",
+               "priority", "template", "impressora", "profile", "path", "status", "erro",
+               "printed_at", "reprint_of")
+    BATCH_SIZE = 500
+
+    def __init__(self, path="historico.db"):
+        self.path = path
+        self.pending = queue.Queue()
+        self._create_schema()
+        self.thread = threading.Thread(target=self._write_loop, name="ticket-history", daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _create_schema(self):
+        with contextlib.closing(self._connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS tickets (
+                id INTEGER PRIMARY KEY,
+                job_id TEXT, code TEXT, created_date TEXT, services TEXT, header TEXT,
+                footer TEXT, qrcode TEXT, priority TEXT, template TEXT, impressora TEXT,
+                profile TEXT, path TEXT, status TEXT, erro TEXT, printed_at REAL,
+                reprint_of INTEGER)""")
+            for column in ("code", "created_date", "services", "printed_at"):
+                db.execute(f"CREATE INDEX IF NOT EXISTS idx_tickets_{column} ON tickets ({column})")
+            db.commit()
+
+    def record(self, job, reprint_of=None):
+        """Enfileira o resultado final de um ticket para gravação"""
+        fields = job.fields
+        self.pending.put((
+            job.id, job.code, fields.get("created_date", ""), fields.get("services", ""),
+            fields.get("header", ""), fields.get("footer", ""), fields.get("qrcode"),
+            job.priority, job.template, job.impressora, job.profile.name, job.locator or job.image_path,
+            job.status, str(job.error) if job.error else None, time.time(), reprint_of,
+        ))
+
+    def _write_loop(self):
+        import sqlite3
+
+        db = self._connect()
+        db.execute("PRAGMA synchronous=NORMAL")
+        insert = f"INSERT INTO tickets ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})"
+        while True:
+            rows = [self.pending.get()]
+            while len(rows) < self.BATCH_SIZE:
+                try:
+                    rows.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with db:
+                    db.executemany(insert, rows)
+            except sqlite3.Error as e:
+                print(f"⚠️ Erro ao gravar histórico ({len(rows)} tickets): {e}")
+            for _ in rows:
+                self.pending.task_done()
+
+    def flush(self, timeout=5.0):
+        """Aguarda a gravação dos registros pendentes"""
+        deadline = time.monotonic() + timeout
+        while self.pending.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def query(self, code=None, services=None, created_date=None, since=None, until=None,
+              cursor=None, limit=50):
+        """Consulta paginada, mais recentes primeiro; retorna (linhas, próximo cursor)
+
+        Com intervalo de tempo (since/until) a ordem e o cursor seguem (printed_at, id),
+        a ordem do índice de printed_at: o SQLite percorre só o intervalo pedido em vez
+        da tabela inteira. Sem intervalo, o cursor é o id.
+        """
+        by_time = since is not None or until is not None
+        conditions, params = [], []
+        for column, value in (("code", code), ("services", services), ("created_date", created_date)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("printed_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("printed_at < ?")
+            params.append(until)
+        if cursor and by_time:
+            printed_at, _, last_id = str(cursor).partition(":")
+            conditions.append("(printed_at, id) < (?, ?)")
+            params.extend([float(printed_at), int(last_id)])
+        elif cursor:
+            conditions.append("id < ?")
+            params.append(int(cursor))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "printed_at DESC, id DESC" if by_time else "id DESC"
+        with contextlib.closing(self._connect()) as db:
+            rows = [dict(row) for row in db.execute(
+                f"SELECT * FROM tickets {where} ORDER BY {order} LIMIT ?", params + [limit + 1])]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = f"{last['printed_at']!r}:{last['id']}" if by_time else last["id"]
+        return rows[:limit], next_cursor
+
+    def get(self, ticket_id):
+        with contextlib.closing(self._connect()) as db:
+            row = db.execute("SELECT * FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
+        return dict(row) if row else None
+
+
+class PeerFederation:
+    """Encaminha tickets para outra instância quando a impressora local não está imprimindo
+
+    Os pares ("peers") são verificados em segundo plano pelo /metricas: um par é
+    saudável se responde e a impressora dele não está falhando; entre os saudáveis
+    é escolhido o de menor fila. A requisição original é reenviada por uma sessão
+    HTTP com conexões reaproveitadas (keep-alive). Os cabeçalhos X-Peer-Hops e
+    X-Peer-Via impedem que um ticket circule entre as instâncias.
+    """
+    HOPS_HEADER = "X-Peer-Hops"
+    VIA_HEADER = "X-Peer-Via"
+
+    def __init__(self, peers, instance_id, max_hops=2, failover_after=3, retry_local_s=30,
+                 health_interval=5, timeout=35):
+        self.peers = [peer.rstrip("/") for peer in peers]
+        self.instance_id = instance_id
+        self.max_hops = max_hops
+        self.failover_after = failover_after
+        self.retry_local_s = retry_local_s
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.state = {peer: {"saudavel": False, "carga": 0, "verificado": None} for peer in self.peers}
+        self.lock = threading.Lock()
+        self.session = None
+        self.forwarded = 0
+        threading.Thread(target=self._health_loop, name="peer-health", daemon=True).start()
+
+    @classmethod
+    def from_config(cls, config, instance_id):
+        data = config.get("federation") or {}
+        return cls(
+            config.get("peers") or [],
+            config.get("instance_name") or instance_id,
+            max_hops=data.get("max_hops", 2),
+            failover_after=data.get("failover_after", 3),
+            retry_local_s=data.get("retry_local_s", 30),
+            health_interval=data.get("health_interval", 5),
+            timeout=data.get("timeout", 35),
+        )
+
+    def _get_session(self):
+        if self.session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=max(1, len(self.peers)), pool_maxsize=10)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.session = session
+        return self.session
+
+    def _health_loop(self):
+        while True:
+            for peer in self.peers:
+                self._check(peer)
+            time.sleep(self.health_interval)
+
+    def _check(self, peer):
+        healthy, load = False, 0
+        try:
+            response = self._get_session().get(peer + "/metricas", timeout=2)
+            if response.status_code == 200:
+                data = response.json()
+                load = sum(lane.get("na_fila", 0) for lane in data.get("fila", {}).values())
+                load += data.get("processos_de_impressao", 0)
+                healthy = data.get("pronto", True) and not self.printer_down(data.get("impressora"))
+        except Exception:
+            pass
+        with self.lock:
+            self.state[peer] = {"saudavel": healthy, "carga": load, "verificado": time.time()}
+
+    def printer_down(self, health):
+        """Impressora considerada parada: falhas seguidas recentes (tenta de novo após retry_local_s)"""
+        if not health:
+            return False
+        since = health.get("ultima_falha_ha_s")
+        return (health.get("falhas_seguidas", 0) >= self.failover_after
+                and since is not None and since < self.retry_local_s)
+
+    def can_forward(self, headers):
+        """Proteção contra laços: limite de saltos e instância já percorrida"""
+        if not self.peers:
+            return False
+        hops = int(headers.get(self.HOPS_HEADER, 0) or 0)
+        via = [item.strip() for item in headers.get(self.VIA_HEADER, "").split(",") if item.strip()]
+        return hops < self.max_hops and self.instance_id not in via
+
+    def forward(self, path, params, headers):
+        """Reenvia a requisição ao par saudável menos carregado; devolve (par, resposta) ou None"""
+        import requests
+
+        hops = int(headers.get(self.HOPS_HEADER, 0) or 0) + 1
+        via = ",".join(filter(None, [headers.get(self.VIA_HEADER, ""), self.instance_id]))
+        with self.lock:
+            candidates = sorted((peer for peer, state in self.state.items() if state["saudavel"]),
+                                key=lambda peer: self.state[peer]["carga"])
+        for peer in candidates:
+            try:
+                response = self._get_session().get(
+                    peer + path, params=params, timeout=self.timeout,
+                    headers={self.HOPS_HEADER: str(hops), self.VIA_HEADER: via})
+            except requests.RequestException:
+                with self.lock:
+                    self.state[peer]["saudavel"] = False
+                continue
+            with self.lock:
+                self.state[peer]["carga"] += 1  # Espalha um pico até a próxima verificação
+                if response.status_code >= 500:
+                    self.state[peer]["saudavel"] = False
+            if response.status_code < 500:
+                self.forwarded += 1
+                return peer, response
+        return None
+
+    def status(self):
+        with self.lock:
+            return {"instancia": self.instance_id, "encaminhados": self.forwarded,
+                    "pares": {peer: dict(state) for peer, state in self.state.items()}}
+
+
+class HealthMonitor:
+    """Estado dos componentes para /health (vivacidade) e /ready (prontidão)
+
+    Configuração, impressora, renderização, disco e fila são verificados numa
+    thread a cada `interval` segundos e o resultado fica em cache: as sondas do
+    balanceador e da bandeja só leem a última rodada, sem abrir arquivos,
+    renderizar nem chamar o PowerShell. A impressora é avaliada pelo resultado
+    dos processos de impressão (falhas seguidas), não pelo spooler do Windows.
+    """
+    CHECKS = ("configuracao", "impressora", "renderizacao", "disco", "fila")
+
+    def __init__(self, backend, interval=5, min_free_mb=100, printer_failures=3, retry_printer_s=30,
+                 queue_stall_s=60):
+        self.backend = backend
+        self.interval = max(0.5, float(interval))
+        self.min_free_mb = min_free_mb
+        self.printer_failures = printer_failures
+        self.retry_printer_s = retry_printer_s
+        self.queue_stall_s = queue_stall_s
+        self.stale_after = max(3 * self.interval, 30)  # Sem rodada concluída nesse tempo: travado
+        self.results = {}  # Substituído inteiro a cada rodada (leitura sem cópia)
+        self.checked = None
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.config = {}
+        self.metrics = None
+        self.progress = (None, time.monotonic())  # (tickets enviados, quando o número mudou)
+        threading.Thread(target=self._loop, name="health-check", daemon=True).start()
+
+    @classmethod
+    def from_config(cls, backend, config):
+        data = config.get("health") or {}
+        return cls(
+            backend,
+            interval=data.get("interval", 5),
+            min_free_mb=data.get("min_free_mb", 100),
+            printer_failures=data.get("printer_failures", 3),
+            retry_printer_s=data.get("retry_printer_s", 30),
+            queue_stall_s=data.get("queue_stall_s", 60),
+        )
+
+    def _loop(self):
+        while True:
+            self.refresh()
+            time.sleep(self.interval)
+
+    def refresh(self):
+        """Executa todas as verificações e publica o resultado"""
+        try:
+            self.metrics = self.backend.queue_metrics()
+        except Exception:
+            self.metrics = None
+        results = {}
+        for name in self.CHECKS:
+            started = time.perf_counter()
+            try:
+                ok, detail = getattr(self, "_check_" + name)()
+            except Exception as e:
+                ok, detail = False, {"erro": str(e)}
+            results[name] = dict(detail, ok=ok, ms=round((time.perf_counter() - started) * 1000, 1))
+        with self.lock:
+            self.results = results
+            self.checked = time.monotonic()
+
+    def _check_configuracao(self):
+        # Leitura direta: load_config() registra no log e recria o arquivo se faltar
+        if not os.path.exists(CONFIG_FILE):
+            return False, {"erro": f"{CONFIG_FILE} não encontrado"}
+        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            return False, {"erro": f"{CONFIG_FILE} inválido"}
+        self.config = config
+        return True, {}
+
+    def _check_impressora(self):
+        printer = self.config.get("selected_printer")
+        if not printer or printer == "null" or not str(printer).strip():
+            return False, {"erro": "nenhuma impressora configurada"}
+        health = (self.metrics or {}).get("impressora") or {}
+        detail = dict(health, nome=printer)
+        since = health.get("ultima_falha_ha_s")
+        # Depois de retry_printer_s sem novas falhas volta a receber tickets para tentar de novo
+        if (health.get("falhas_seguidas", 0) >= self.printer_failures
+                and since is not None and since < self.retry_printer_s):
+            detail["erro"] = "impressão falhando seguidamente"
+            return False, detail
+        return True, detail
+
+    def _check_renderizacao(self):
+        # Barato a cada rodada: layout do perfil (em cache após a primeira vez) e um eco no pool
+        profile = resolve_printer_profile(self.config, self.config.get("selected_printer"))
+        PreparedLayout.get(DEFAULT_PLAN, profile)
+        executor = self.backend.render_executor
+        detail = {"perfil": profile.name, "pool": bool(executor)}
+        if executor and not executor.ping():
+            detail["erro"] = "pool de renderização não responde"
+            return False, detail
+        return True, detail
+
+    def _check_disco(self):
+        import shutil
+
+        free_mb = shutil.disk_usage("ticket" if os.path.isdir("ticket") else ".").free // (1024 * 1024)
+        detail = {"livre_mb": free_mb, "minimo_mb": self.min_free_mb}
+        if free_mb < self.min_free_mb:
+            detail["erro"] = "pouco espaço em disco para os tickets"
+            return False, detail
+        return True, detail
+
+    def _check_fila(self):
+        if self.metrics is None:
+            return False, {"erro": "fila de impressão não iniciada"}
+        pipeline = self.backend.pipeline
+        if pipeline is not None and not pipeline.thread.is_alive():
+            return False, {"erro": "thread da fila de impressão encerrada"}
+        lanes = self.metrics["fila"].values()
+        waiting = sum(lane["na_fila"] for lane in lanes)
+        sent = sum(lane["enviados"] for lane in lanes)
+        now = time.monotonic()
+        if sent != self.progress[0] or not waiting:
+            self.progress = (sent, now)
+        detail = {"na_fila": waiting, "processos_de_impressao": self.metrics.get("processos_de_impressao", 0)}
+        stalled = now - self.progress[1]
+        if stalled >= self.queue_stall_s:
+            detail["erro"] = f"nenhum ticket enviado há {int(stalled)}s com {waiting} na fila"
+            return False, detail
+        return True, detail
+
+    def snapshot(self):
+        """Última rodada de verificações (não bloqueia nem executa nenhuma verificação)"""
+        with self.lock:
+            results, checked = self.results, self.checked
+        age = time.monotonic() - (checked if checked is not None else self.started)
+        return {"vivo": age < self.stale_after,
+                "verificado_ha_s": round(age, 1) if checked is not None else None,
+                "componentes": results}
+
+
+class CoordinatorService:
+    """Fila da impressora do processo coordenador, exposta aos workers (server_workers > 1)
+
+    Só o coordenador grava tickets, mantém a fila, o histórico e os processos de
+    impressão: a ordem de impressão e o status dos tickets ficam consistentes
+    entre os workers.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def enqueue_ticket(self, fields, payload, impressora, profile, config, priority, template):
+        job = self.backend.enqueue_ticket(fields, payload, impressora, profile, config, priority, template)
+        return job.id, job.code
+
+    def reprint_ticket(self, ticket_id, requested_priority=None):
+        job = self.backend.reprint_ticket(ticket_id, requested_priority)
+        return job.id, job.code
+
+    def wait_job(self, job_id, timeout=None):
+        """Aguarda o ticket (no coordenador) e devolve o status atual"""
+        job = self.backend.pipeline.get_job(job_id)
+        if job is None:
+            return None
+        job.wait(timeout)
+        return dict(job.to_dict(), done=job.done.is_set())
+
+    def query_history(self, **filters):
+        return self.backend.query_history(**filters)
+
+    def find_job(self, job_id):
+        return self.backend.find_job(job_id)
+
+    def cancel_job(self, job_id, reason):
+        return self.backend.cancel_job(job_id, reason)
+
+    def admit(self, client):
+        return self.backend.admit(client)
+
+    def release_admission(self):
+        self.backend.release_admission()
+
+    def admission_stats(self):
+        return self.backend.admission_stats()
+
+    def queue_depth(self):
+        return self.backend.queue_depth()
+
+    def queue_metrics(self):
+        return self.backend.queue_metrics()
+
+    def request_shutdown(self):
+        threading.Thread(target=self.backend.request_shutdown, name="shutdown", daemon=True).start()
+
+
+class RemoteJob:
+    """Ticket enfileirado no coordenador, visto de um worker"""
+    def __init__(self, service, job_id, code):
+        self.service = service
+        self.id = job_id
+        self.code = code
+        self.status = "na fila"
+        self.error = None
+
+    def wait(self, timeout=None):
+        state = self.service.wait_job(self.id, timeout)
+        if state is None:
+            self.status, self.error = "erro", RuntimeError("trabalho não encontrado no coordenador")
+            return False
+        self.status = state["status"]
+        self.error = RuntimeError(state["erro"]) if state["erro"] else None
+        return state["done"] and self.status != "erro"
+
+
+class CoordinatorClient:
+    """Lado do worker: repassa ao coordenador as operações sobre a fila e o histórico"""
+    def __init__(self, address, authkey):
+        from multiprocessing.managers import BaseManager
+
+        class CoordinatorManager(BaseManager):
+            pass
+
+        CoordinatorManager.register("coordinator")
+        manager = CoordinatorManager(address=address, authkey=authkey)
+        manager.connect()
+        self.service = manager.coordinator()  # Proxy com uma conexão por thread
+
+    def enqueue_ticket(self, *args):
+        return RemoteJob(self.service, *self.service.enqueue_ticket(*args))
+
+    def reprint_ticket(self, ticket_id, requested_priority=None):
+        return RemoteJob(self.service, *self.service.reprint_ticket(ticket_id, requested_priority))
+
+    def query_history(self, **filters):
+        return self.service.query_history(**filters)
+
+    def find_job(self, job_id):
+        return self.service.find_job(job_id)
+
+    def cancel_job(self, job_id, reason):
+        return self.service.cancel_job(job_id, reason)
+
+    def admit(self, client):
+        return self.service.admit(client)
+
+    def release_admission(self):
+        self.service.release_admission()
+
+    def admission_stats(self):
+        return self.service.admission_stats()
+
+    def queue_depth(self):
+        return self.service.queue_depth()
+
+    def queue_metrics(self):
+        return self.service.queue_metrics()
+
+    def request_shutdown(self):
+        self.service.request_shutdown()
+
+
+def start_coordinator(backend):
+    """Publica a fila do backend para os workers; devolve (endereço, chave)"""
+    from multiprocessing.managers import BaseManager
+
+    class CoordinatorManager(BaseManager):
+        pass
+
+    service = CoordinatorService(backend)
+    CoordinatorManager.register("coordinator", callable=lambda: service)
+    authkey = os.urandom(16)
+    server = CoordinatorManager(address=("127.0.0.1", 0), authkey=authkey).get_server()
+    threading.Thread(target=server.serve_forever, name="coordinator", daemon=True).start()
+    return server.address, authkey
+
+
+def _serve_worker(index, workers, address, authkey):
+    """Processo worker: atende HTTP na porta compartilhada e repassa os tickets ao coordenador"""
+    backend = PrintingBackend()
+    backend.coordinator = CoordinatorClient(address, authkey)
+    backend.worker_count = workers
+    backend.worker_index = index
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C é tratado pelo processo principal
+    
+    parent = os.getppid()
+    backend.start()
+    if not backend.wait_ready(timeout=60):
+        print(f"❌ Worker {index} não iniciou: {backend.start_error}")
+        return
+    # Sai também se o coordenador morrer (o worker ficaria com a porta sem ter a fila)
+    while not stop_event.is_set() and backend.running and os.getppid() == parent:
+        stop_event.wait(1)
+    backend.stop()
+
+
+class PrintingBackend:
+    """Classe responsável pelo backend de impressão"""
+    LOG_QUEUE_LIMIT = 1000  # Mensagens de log aguardando a interface
+
+    def __init__(self, log_queue=None):
+        self.app = None
+        self.server = None
+        self.running = False
+        self.thread = None
+        self.log_queue = log_queue  # Fila para enviar logs para a UI
+        self.ready = threading.Event()  # Sinalizado quando o servidor aceita conexões
+        self.start_error = None
+        self.render_executor = None  # Pool de processos de renderização (opcional)
+        self.pipeline = None  # Fila de impressão (criada em start)
+        self.templates = TemplateRegistry()  # Templates de ticket compilados
+        self.profiler = RuntimeProfiler()  # Profiling sob demanda (endpoint /admin/profile)
+        self.admission = AdmissionController()  # Limites de taxa, de carga e de tamanho (ajustado em start)
+        self.history = None  # Histórico de tickets em SQLite (criado em start)
+        self.archive = None  # Arquivo de tickets em pacotes diários (opcional)
+        self.journal = PendingJournal()  # Tickets guardados no encerramento, reenviados no início
+        self.accepting = True  # False durante o encerramento: novos tickets recebem 503
+        self.on_shutdown_request = None  # Chamado por /shutdown (ex.: encerrar o aplicativo inteiro)
+        self.coordinator = None  # Cliente do processo coordenador (apenas nos workers)
+        self.workers = []  # Processos worker que compartilham a porta (apenas no coordenador)
+        self.worker_count = 1  # Processos atendendo a porta (server_workers)
+        self.worker_index = 0  # Posição deste processo entre eles (0 = coordenador)
+        self.federation = None  # Encaminhamento para outras instâncias (peers), se configurado
+        self.health = None  # Verificações em cache para /health e /ready (criado em start)
+
+    def send_log(self, message, level="INFO", simple_message=None, simple_status="info"):
+        """Envia log para a UI através da fila"""
+        # Com a janela fechada a fila só é esvaziada aos poucos pelo loop da bandeja:
+        # acima do limite o log vai apenas para o console
+        if self.log_queue and self.log_queue.qsize() < self.LOG_QUEUE_LIMIT:
+            self.log_queue.put({
+                "type": "log",
+                "message": message,
+                "level": level,
+                "simple_message": simple_message,
+                "simple_status": simple_status
+            })
+        # Também imprime no console
+        print(f"[{level}] {message}")
+
+    def wait_ready(self, timeout=None):
+        """Aguarda o servidor começar a aceitar conexões; retorna True se está online"""
+        self.ready.wait(timeout)
+        return self.ready.is_set() and self.start_error is None
+        
+    def render_ticket(self, fields, profile=None, plan=None):
+        """Renderiza o ticket no pool de processos, se configurado, ou na própria thread"""
+        if self.render_executor:
+            try:
+                return self.render_executor.render(fields, profile, plan)
+            except Exception as e:
+                print(f"⚠️ Falha no pool de renderização, renderizando localmente: {e}")
+        return render_ticket_bytes(fields, profile, plan)
+
+    # Operações sobre a fila e o histórico. Num worker (server_workers > 1) elas são
+    # repassadas ao processo coordenador, dono da fila da impressora.
+
+    def enqueue_ticket(self, fields, payload, impressora, profile, config, priority, template):
+        """Grava o ticket renderizado e o coloca na fila da impressora"""
+        if self.coordinator:
+            return self.coordinator.enqueue_ticket(fields, payload, impressora, profile, config, priority, template)
+        with tracer.span("gravar ticket", bytes=len(payload)):
+            locator = None
+            if self.archive:
+                locator = self.archive.append(payload)
+                image_path = spool_copy(payload, profile.extension, config)
+            else:
+                image_path = save_ticket(payload, profile.extension)
+        return self.pipeline.submit(PrintJob(
+            fields["code"], payload, image_path, impressora, profile, config, priority,
+            fields=fields, template=template, locator=locator,
+            on_complete=self.history.record if self.history else None))
+
+    def reprint_ticket(self, ticket_id, requested_priority=None):
+        """Reenvia um ticket do histórico; LookupError se não existe, OSError se o arquivo sumiu"""
+        if self.coordinator:
+            return self.coordinator.reprint_ticket(ticket_id, requested_priority)
+        row = self.history.get(ticket_id) if self.history else None
+        if row is None:
+            raise LookupError(ticket_id)
+        config = load_config()
+        impressora = config.get("selected_printer") or row["impressora"]
+        priority = resolve_priority(config, requested_priority, row["services"])
+        locator = None
+        try:
+            if row["path"] and row["path"].startswith(TicketArchive.PREFIX):
+                locator = row["path"]
+                payload = (self.archive or TicketArchive()).read(locator)
+                image_path = spool_copy(payload, guess_ticket_extension(payload), config)
+            else:
+                image_path = row["path"]
+                with open(image_path, 'rb') as f:
+                    payload = f.read()
+        except (KeyError, TypeError) as e:
+            raise FileNotFoundError(str(e))
+        fields = {name: row[name] for name in ("created_date", "code", "services", "header", "footer")}
+        if row["qrcode"] is not None:
+            fields["qrcode"] = row["qrcode"]
+        return self.pipeline.submit(PrintJob(
+            row["code"], payload, image_path, impressora,
+            resolve_printer_profile(config, row["impressora"]), config, priority,
+            fields=fields, template=row["template"], locator=locator,
+            on_complete=lambda job: self.history.record(job, reprint_of=ticket_id)))
+
+    def query_history(self, **filters):
+        """Consulta paginada do histórico; LookupError se o histórico está desativado"""
+        if self.coordinator:
+            return self.coordinator.query_history(**filters)
+        if not self.history:
+            raise LookupError("histórico desativado")
+        return self.history.query(**filters)
+
+    def find_job(self, job_id):
+        """Status de um ticket recente (dicionário) ou None"""
+        if self.coordinator:
+            return self.coordinator.find_job(job_id)
+        job = self.pipeline.get_job(job_id) if self.pipeline else None
+        return job.to_dict() if job else None
+
+    def admit(self, client):
+        """Controle de admissão; retorna None ou (motivo, segundos para tentar de novo)
+
+        Com server_workers > 1 os buckets por cliente ficam no coordenador: o kernel
+        espalha as conexões entre os workers, então limites locais não valeriam por cliente.
+        """
+        if self.coordinator:
+            rejection = self.coordinator.admit(client)
+            if rejection:
+                return tuple(rejection)
+        return self.admission.admit(client, 0 if self.coordinator else self.queue_depth())
+
+    def release_admission(self):
+        if self.coordinator:
+            self.coordinator.release_admission()
+        self.admission.release()
+
+    def admission_stats(self):
+        if self.coordinator:
+            return self.coordinator.admission_stats()
+        return {"em_andamento": self.admission.in_flight, "rejeitadas": self.admission.rejected}
+
+    def cancel_job(self, job_id, reason):
+        """Retira o ticket da fila local se ele ainda não foi entregue à impressora"""
+        if self.coordinator:
+            return self.coordinator.cancel_job(job_id, reason)
+        return bool(self.pipeline) and self.pipeline.cancel(job_id, reason)
+
+    def queue_depth(self):
+        if self.coordinator:
+            return self.coordinator.queue_depth()
+        return self.pipeline.depth() if self.pipeline else 0
+
+    def queue_metrics(self):
+        """Métricas da fila da impressora, ou None antes de ela existir"""
+        if self.coordinator:
+            return self.coordinator.queue_metrics()
+        if not self.pipeline:
+            return None
+        metrics = {"fila": self.pipeline.metrics(), "processos_de_impressao": self.pipeline.supervisor.active(),
+                   "impressora": self.pipeline.supervisor.health()}
+        simulators = printer_simulator_stats()
+        if simulators:
+            metrics["simulador"] = simulators
+        return metrics
+
+    def readiness(self):
+        """(pronto, motivos, estado dos componentes) a partir do cache do HealthMonitor"""
+        snapshot = self.health.snapshot() if self.health else {"vivo": False, "componentes": {}}
+        reasons = [f"{name}: {result.get('erro', 'falhou')}"
+                   for name, result in snapshot["componentes"].items() if not result["ok"]]
+        if not self.accepting:
+            reasons.insert(0, "servidor encerrando")
+        elif not snapshot["componentes"]:
+            reasons.insert(0, "verificações ainda não concluídas")
+        elif not snapshot["vivo"]:
+            reasons.insert(0, "verificações travadas")
+        return not reasons, reasons, snapshot
+
+    def request_shutdown(self):
+        """Pedido de encerramento (endpoint /shutdown de qualquer worker)"""
+        if self.coordinator:
+            return self.coordinator.request_shutdown()
+        (self.on_shutdown_request or self.stop)()
 
-class PrintingBackend:
-    """Classe responsável pelo backend de impressão"""
-    def __init__(self, log_queue=None):
-        self.app = None
-        self.running = False
-        self.thread = None
-        self.log_queue = log_queue  # Fila para enviar logs para a UI
-        
     def create_flask_app(self):
         """Cria a aplicação Flask"""
+        from flask import Flask, request as flask_request
+
         app = Flask("printing_app")
         
         # Função auxiliar para enviar logs para a UI
-        def send_log(message, level="INFO", simple_message=None, simple_status="info"):
-            """Envia log para a UI através da fila"""
-            if self.log_queue:
-                self.log_queue.put({
-                    "type": "log",
-                    "message": message,
-                    "level": level,
-                    "simple_message": simple_message,
-                    "simple_status": simple_status
-                })
-            # Também imprime no console
-            print(f"[{level}] {message}")
+        send_log = self.send_log
+
+        @app.before_request
+        def begin_trace():
+            """Inicia o trace da requisição (id do cabeçalho X-Trace-Id ou gerado)"""
+            if (traffic_recorder.enabled and flask_request.path in TrafficRecorder.PATHS
+                    and "X-Replay" not in flask_request.headers):
+                flask_request.recording_started = time.time()
+            if tracer.enabled:
+                flask_request.trace_started = time.time()
+                tracer.start_trace(flask_request.headers.get("X-Trace-Id"))
+
+        @app.after_request
+        def finish_trace(response):
+            """Fecha o span raiz da requisição e devolve o trace id ao cliente"""
+            trace_id = tracer.current()
+            if trace_id:
+                started = getattr(flask_request, "trace_started", time.time())
+                tracer.record(trace_id, f"{flask_request.method} {flask_request.path}", started,
+                              time.time() - started, {"status": response.status_code})
+                response.headers["X-Trace-Id"] = trace_id
+                tracer.end_trace()
+            started = getattr(flask_request, "recording_started", None)
+            if started is not None:
+                traffic_recorder.record(started, flask_request.path, flask_request.args.to_dict(),
+                                        self.admission.client_key(flask_request.headers.get("X-Api-Key"),
+                                                                  flask_request.remote_addr),
+                                        response.status_code, time.time() - started)
+            return response
         
-        @app.route('/imprimir')
-        def imprimir():
+        def forward_print(endpoint, code, reason):
+            """Encaminha a requisição a outra instância; devolve a resposta Flask ou None"""
+            federation = self.federation
+            if not federation or not federation.can_forward(flask_request.headers):
+                return None
+            result = federation.forward(endpoint, flask_request.args.to_dict(), flask_request.headers)
+            if result is None:
+                send_log(f"Nenhuma instância par disponível para o ticket {code}", "WARNING")
+                return None
+            peer, response = result
+            send_log(f"Ticket {code} encaminhado para {peer} ({reason}): {response.status_code} {response.text}",
+                     "WARNING", "↪️ Senha enviada para outra unidade", "warning")
+            headers = {"X-Encaminhado-Para": peer}
+            if response.headers.get("X-Job-Id"):
+                headers["X-Job-Id"] = response.headers["X-Job-Id"]
+            return response.text, response.status_code, headers
+
+        def handle_print(with_qr):
+            """Fluxo comum dos endpoints de impressão (simples e com QR Code)"""
+            qr = " QR" if with_qr else ""
+            endpoint = "/imprimir/qrcode" if with_qr else "/imprimir"
             try:
                 # Coleta parâmetros
-                created_date = flask_request.args.get('created_date', '')
-                code = flask_request.args.get('code', '')
-                services = flask_request.args.get('services', '')
-                header = flask_request.args.get('header', '')
-                footer = flask_request.args.get('footer', '')
-                
-                send_log(
-                    f"Nova impressão recebida - Código: {code}", 
-                    "INFO",
-                    "📩 Nova solicitação de impressão recebida",
-                    "info"
-                )
-
-                # Gera imagem do ticket
-                image_generator = ImageGenerator(IMAGE_SIZE=(300, 300))
-                image_path = image_generator.create_image(
-                    created_date=created_date, 
-                    code=code, 
-                    services=services, 
-                    header=header, 
-                    footer=footer
+                fields = dict(
+                    created_date=flask_request.args.get('created_date', ''),
+                    code=flask_request.args.get('code', ''),
+                    services=flask_request.args.get('services', ''),
+                    header=flask_request.args.get('header', ''),
+                    footer=flask_request.args.get('footer', ''),
                 )
+                if with_qr:
+                    fields["qrcode"] = flask_request.args.get('qrcode', '')
+                code = fields["code"]
+                
+                # Campos grandes demais tornam a renderização cara: rejeita antes
+                invalid = self.admission.check_fields(fields)
+                if invalid:
+                    send_log(f"Requisição rejeitada{qr}: {invalid}", "WARNING")
+                    return f"Erro: {invalid}", 400
                 
                 send_log(
-                    f"Ticket gerado: {code}",
+                    f"Nova impressão{' com QR' if with_qr else ''} recebida - Código: {code}",
                     "INFO",
-                    "🖼️ Ticket de senha gerado",
+                    "📩 Nova solicitação de impressão (QR Code)" if with_qr else "📩 Nova solicitação de impressão recebida",
                     "info"
                 )
+                
+                # Impressora local falhando seguidamente: envia direto para outra instância
+                if self.federation:
+                    metrics = self.queue_metrics() or {}
+                    if self.federation.printer_down(metrics.get("impressora")):
+                        forwarded = forward_print(endpoint, code, "impressora local indisponível")
+                        if forwarded:
+                            return forwarded
 
-                # Carrega configuração da impressora
-                config = load_config()
+                # Carrega configuração da impressora (antes de renderizar: o perfil depende dela)
+                with tracer.span("carregar configuração"):
+                    config = load_config()
                 impressora = config.get("selected_printer")
                 
-                send_log(f"Configuração carregada no Flask: {config}", "INFO")
+                send_log(f"Configuração carregada no Flask{qr}: {config}", "INFO")
                 send_log(
-                    f"Impressora selecionada: '{impressora}'",
+                    f"Impressora selecionada{qr}: '{impressora}'",
                     "INFO",
                     f"🖨️ Impressora: {impressora}",
                     "info"
@@ -216,172 +3594,280 @@ class PrintingBackend:
                 
                 if not impressora or impressora == "null" or (isinstance(impressora, str) and impressora.strip() == ""):
                     send_log(
-                        f"Nenhuma impressora configurada! Valor: {repr(impressora)}",
+                        f"Nenhuma impressora configurada! Valor{qr}: {repr(impressora)}",
                         "ERROR",
                         "❌ Impressora não configurada",
                         "error"
                     )
                     return "Erro: Configure uma impressora nas Configurações", 500
+
+                # Gera o ticket já no formato nativo da impressora, com o template escolhido
+                with tracer.span("resolver perfil e template"):
+                    profile = resolve_printer_profile(config, impressora)
+                    plan = self.templates.resolve(config, flask_request.args.get('template'), fields["services"])
+                try:
+                    priority = resolve_priority(config, flask_request.args.get('priority'), fields["services"])
+                except ValueError as e:
+                    send_log(f"Requisição rejeitada{qr}: {e}", "WARNING")
+                    return f"Erro: {e}", 400
+                with tracer.span("renderizar", pool=bool(self.render_executor), template=plan.name):
+                    payload = self.render_ticket(fields, profile, plan)
                 
-                # Prepara comando de impressão
-                command = ['mspaint', '/pt', image_path, impressora]
+                send_log(
+                    f"Ticket{' com QR' if with_qr else ''} gerado: {code} ({profile.name}, template {plan.name}, {len(payload)} bytes)",
+                    "INFO",
+                    "🖼️ Ticket com QR Code gerado" if with_qr else "🖼️ Ticket de senha gerado",
+                    "info"
+                )
                 
-                # Inicia processo assíncrono
+                # Envia para a fila da impressora e aguarda a entrega ao spooler
+                job = None
                 try:
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                    startupinfo.wShowWindow = subprocess.SW_HIDE
-                    
-                    subprocess.Popen(
-                        command, 
-                        stdout=subprocess.DEVNULL, 
-                        stderr=subprocess.DEVNULL,
-                        creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
-                        startupinfo=startupinfo if os.name == 'nt' else None
-                    )
+                    job = self.enqueue_ticket(fields, payload, impressora, profile, config, priority, plan.name)
+                    with tracer.span("aguardar spooler", job=job.id):
+                        sent = job.wait(timeout=config.get("print_job_timeout", 30))
+                    if not sent:
+                        raise job.error or TimeoutError("tempo esgotado aguardando a fila de impressão")
+                    if job.status == "pendente":
+                        send_log(f"Ticket{qr} {code} guardado para impressão após reiniciar", "WARNING",
+                                 "⏳ Senha será impressa ao reiniciar", "warning")
+                        return "Ticket guardado: será impresso quando o servidor reiniciar", 202, {"X-Job-Id": job.id}
                     
                     send_log(
-                        f"Impressão enviada com sucesso - {code}",
+                        f"Impressão{qr} enviada com sucesso - {code}",
                         "INFO",
-                        "✅ Senha impressa com sucesso",
+                        "✅ Senha com QR Code impressa" if with_qr else "✅ Senha impressa com sucesso",
                         "success"
                     )
-                    return "Impressão realizada com sucesso", 200
+                    return ("Impressão com QRCode realizada com sucesso" if with_qr
+                            else "Impressão realizada com sucesso"), 200, {"X-Job-Id": job.id}
                     
                 except Exception as e:
                     send_log(
-                        f"Erro ao enviar para impressão: {e}",
+                        f"Erro ao enviar para impressão{qr}: {e}",
                         "ERROR",
-                        "❌ Falha ao imprimir",
+                        "❌ Falha ao imprimir QR Code" if with_qr else "❌ Falha ao imprimir",
                         "error"
                     )
-                    return f"Erro ao imprimir: {e}", 500
+                    if job is not None and job.status != "erro":
+                        # Ainda na fila local: só encaminha se conseguir retirá-lo antes (senão imprime nos dois)
+                        waiting = f"Ticket{qr} aguardando a impressora local: {e}"
+                        if not (self.federation and self.federation.can_forward(flask_request.headers)
+                                and self.cancel_job(job.id, "encaminhado a outra instância")):
+                            return waiting, 202, {"X-Job-Id": job.id}
+                        forwarded = forward_print(endpoint, code, f"fila local parada: {e}")
+                        if forwarded:
+                            return forwarded
+                        # Nenhum par aceitou: o ticket volta para a fila local
+                        job = self.enqueue_ticket(fields, payload, impressora, profile, config, priority, plan.name)
+                        return waiting, 202, {"X-Job-Id": job.id}
+                    forwarded = forward_print(endpoint, code, f"falha local: {e}")
+                    if forwarded:
+                        return forwarded
+                    return f"Erro ao imprimir{qr}: {e}", 500
 
             except Exception as e:
                 send_log(
-                    f"Erro geral no endpoint /imprimir: {e}",
+                    f"Erro geral no endpoint {endpoint}: {e}",
                     "ERROR",
-                    "⚠️ Erro interno",
+                    "⚠️ Erro interno (QR Code)" if with_qr else "⚠️ Erro interno",
                     "error"
                 )
-                return f"Erro ao imprimir: {e}", 500
+                return f"Erro ao imprimir{qr}: {e}", 500
+
+        def admit_print(handler, *args):
+            """Aplica o controle de admissão antes do fluxo de impressão"""
+            if not self.accepting:
+                return "Erro: servidor encerrando, tente novamente em instantes", 503, {"Retry-After": "10"}
+            client = self.admission.client_key(flask_request.headers.get("X-Api-Key"), flask_request.remote_addr)
+            rejection = self.admit(client)
+            if rejection:
+                reason, retry_after = rejection
+                if self.admission.should_warn():
+                    send_log(f"Requisição rejeitada ({reason}) - cliente {client}, "
+                             f"{self.admission_stats()['rejeitadas']} rejeições até agora", "WARNING",
+                             "⚠️ Muitas solicitações de impressão", "warning")
+                return f"Erro: {reason}, tente novamente em {retry_after}s", 429, {"Retry-After": str(retry_after)}
+            try:
+                with self.profiler.request():
+                    return handler(*args)
+            finally:
+                self.release_admission()
+
+        @app.route('/imprimir')
+        def imprimir():
+            return admit_print(handle_print, False)
 
         @app.route('/imprimir/qrcode')
         def imprimir_qrcode():
+            return admit_print(handle_print, True)
+
+        def parse_history_time(value):
+            """Aceita timestamp Unix ou data/hora ISO (ex.: 2024-05-01 ou 2024-05-01T08:00)"""
+            from datetime import datetime
+
+            if not value:
+                return None
             try:
-                # Coleta parâmetros
-                created_date = flask_request.args.get('created_date', '')
-                code = flask_request.args.get('code', '')
-                services = flask_request.args.get('services', '')
-                header = flask_request.args.get('header', '')
-                footer = flask_request.args.get('footer', '')
-                qrcode_val = flask_request.args.get('qrcode', '')
-                
-                send_log(
-                    f"Nova impressão com QR recebida - Código: {code}",
-                    "INFO",
-                    "📩 Nova solicitação de impressão (QR Code)",
-                    "info"
-                )
+                return float(value)
+            except ValueError:
+                return datetime.fromisoformat(value).timestamp()
 
-                # Gera imagem com QR Code
-                image_generator = ImageGenerator(IMAGE_SIZE=(300, 300))
-                image_generator.create_image(
-                    created_date=created_date, 
-                    code=code, 
-                    services=services, 
-                    header=header, 
-                    footer=footer
-                )
-                image_generator.create_qrcode(qrcode_val)
-                image_path = image_generator.combine()
-                
-                send_log(
-                    f"Ticket com QR gerado: {code}",
-                    "INFO",
-                    "🖼️ Ticket com QR Code gerado",
-                    "info"
-                )
+        def local_or_token():
+            """Histórico, reimpressão e encerramento: apenas localhost ou com o token de "admin"
 
-                # Carrega configuração da impressora
-                config = load_config()
-                impressora = config.get("selected_printer")
-                
-                send_log(f"Configuração carregada no Flask QR: {config}", "INFO")
-                send_log(
-                    f"Impressora selecionada QR: '{impressora}'",
-                    "INFO",
-                    f"🖨️ Impressora: {impressora}",
-                    "info"
-                )
-                
-                if not impressora or impressora == "null" or (isinstance(impressora, str) and impressora.strip() == ""):
-                    send_log(
-                        f"Nenhuma impressora configurada! Valor QR: {repr(impressora)}",
-                        "ERROR",
-                        "❌ Impressora não configurada",
-                        "error"
-                    )
-                    return "Erro: Configure uma impressora nas Configurações", 500
-                
-                # Prepara comando de impressão
-                command = ['mspaint', '/pt', image_path, impressora]
-                
-                # Inicia processo assíncrono
-                try:
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                    startupinfo.wShowWindow = subprocess.SW_HIDE
-                    
-                    subprocess.Popen(
-                        command, 
-                        stdout=subprocess.DEVNULL, 
-                        stderr=subprocess.DEVNULL,
-                        creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
-                        startupinfo=startupinfo if os.name == 'nt' else None
-                    )
-                    
-                    send_log(
-                        f"Impressão QR enviada com sucesso - {code}",
-                        "INFO",
-                        "✅ Senha com QR Code impressa",
-                        "success"
-                    )
-                    return "Impressão com QRCode realizada com sucesso", 200
-                    
-                except Exception as e:
-                    send_log(
-                        f"Erro ao enviar para impressão QR: {e}",
-                        "ERROR",
-                        "❌ Falha ao imprimir QR Code",
-                        "error"
-                    )
-                    return f"Erro ao imprimir QR: {e}", 500
+            Com server_host 0.0.0.0 os quiosques da rede só precisam de /imprimir; de
+            outra máquina esses pontos exigem o X-Admin-Token configurado em "admin".
+            """
+            if flask_request.remote_addr in LOOPBACK_ADDRESSES:
+                return True
+            token = (load_config().get("admin") or {}).get("token")
+            return bool(token) and flask_request.headers.get("X-Admin-Token") == token
 
-            except Exception as e:
-                send_log(
-                    f"Erro geral no endpoint /imprimir/qrcode: {e}",
-                    "ERROR",
-                    "⚠️ Erro interno (QR Code)",
-                    "error"
+        @app.route('/historico')
+        def historico():
+            """Consulta paginada do histórico: ?code=&services=&created_date=&desde=&ate=&limite=&cursor="""
+            from flask import jsonify
+
+            if not local_or_token():
+                return jsonify({"erro": "acesso permitido apenas localmente ou com X-Admin-Token"}), 403
+            args = flask_request.args
+            try:
+                rows, next_cursor = self.query_history(
+                    code=args.get('code'),
+                    services=args.get('services'),
+                    created_date=args.get('created_date'),
+                    since=parse_history_time(args.get('desde')),
+                    until=parse_history_time(args.get('ate')),
+                    cursor=args.get('cursor'),
+                    limit=max(1, min(int(args.get('limite', 50)), 200)),
                 )
-                return f"Erro ao imprimir QR: {e}", 500
+            except LookupError:
+                return jsonify({"erro": "histórico desativado"}), 404
+            except ValueError as e:
+                return jsonify({"erro": f"parâmetro inválido: {e}"}), 400
+            return jsonify({"itens": rows, "proximo_cursor": next_cursor})
+
+        def handle_reprint(ticket_id):
+            """Reenvia o ticket já renderizado guardado no histórico (sem renderizar de novo)"""
+            try:
+                job = self.reprint_ticket(ticket_id, flask_request.args.get('priority'))
+            except LookupError:
+                return "Erro: ticket não encontrado no histórico", 404
+            except OSError:
+                return "Erro: arquivo do ticket não está mais disponível", 410
+            except ValueError as e:
+                return f"Erro: {e}", 400
+            if not job.wait(timeout=load_config().get("print_job_timeout", 30)):
+                send_log(f"Erro ao reimprimir ticket {job.code}: {job.error}", "ERROR",
+                         "❌ Erro na reimpressão", "error")
+                return f"Erro na reimpressão: {job.error}", 500
+            send_log(f"Ticket {job.code} reimpresso (histórico #{ticket_id})", "INFO",
+                     "🔁 Senha reimpressa", "success")
+            return "Reimpressão realizada com sucesso", 200, {"X-Job-Id": job.id}
+
+        @app.route('/reprint/<int:ticket_id>', methods=['GET', 'POST'])
+        def reprint(ticket_id):
+            if not local_or_token():
+                return "Erro: reimpressão permitida apenas localmente ou com X-Admin-Token", 403
+            return admit_print(handle_reprint, ticket_id)
+
+        @app.route('/metricas')
+        def metricas():
+            """Profundidade das faixas de prioridade, processos de impressão e admissão"""
+            from flask import jsonify
+
+            metrics = self.queue_metrics()
+            if metrics is None:
+                return jsonify({"erro": "servidor iniciando"}), 503
+            metrics["admissao"] = self.admission_stats()
+            metrics["pronto"] = self.readiness()[0]
+            if self.federation:
+                metrics["federacao"] = self.federation.status()
+            return jsonify(metrics)
+
+        @app.route('/trabalho/<job_id>')
+        def trabalho(job_id):
+            """Status de um ticket recente (id devolvido no cabeçalho X-Job-Id)"""
+            from flask import jsonify
+
+            job = self.find_job(job_id)
+            if job is None:
+                return jsonify({"erro": "trabalho não encontrado"}), 404
+            return jsonify(job)
+
+        def admin_allowed():
+            """Endpoints administrativos: desligados por padrão e apenas via localhost
+
+            A configuração é lida a cada chamada, então podem ser ligados no campo
+            editando "admin" no printer_config.json, sem reiniciar o serviço.
+            """
+            admin = load_config().get("admin") or {}
+            if not admin.get("enabled"):
+                return False
+            if flask_request.remote_addr not in LOOPBACK_ADDRESSES:
+                return False
+            token = admin.get("token")
+            return not token or flask_request.headers.get("X-Admin-Token") == token
+
+        @app.route('/admin/profile', methods=['GET', 'POST'])
+        def admin_profile():
+            """Inicia (POST) ou consulta (GET) um profiling do backend em execução
+
+            POST ?seconds=N[&interval_ms=5]  amostragem de todas as threads por N segundos
+            POST ?requests=N                 cProfile das próximas N requisições de impressão
+            """
+            from flask import jsonify
+
+            if not admin_allowed():
+                return "Não encontrado", 404
+            if flask_request.method == 'GET':
+                return jsonify(self.profiler.status())
+            try:
+                if flask_request.args.get('requests'):
+                    count = max(1, min(int(flask_request.args['requests']), 10000))
+                    self.profiler.profile_requests(count)
+                    send_log(f"Profiling ativado para as próximas {count} requisições", "INFO")
+                    return jsonify({"requisicoes": count}), 202
+                seconds = max(1.0, min(float(flask_request.args.get('seconds', 10)), 600.0))
+                interval_ms = max(1.0, float(flask_request.args.get('interval_ms', 5)))
+                path = self.profiler.start_sampling(seconds, interval_ms)
+                send_log(f"Amostragem de {seconds:.0f}s iniciada: {path}", "INFO")
+                return jsonify({"segundos": seconds, "arquivo": path}), 202
+            except (ValueError, RuntimeError) as e:
+                return jsonify({"erro": str(e)}), 400
 
         @app.route('/status')
         def status():
             """Endpoint para verificar status do servidor"""
             return "Servidor de impressão online", 200
 
+        @app.route('/health')
+        def health():
+            """Vivacidade: o processo responde e as verificações em segundo plano seguem rodando"""
+            from flask import jsonify
+
+            snapshot = self.health.snapshot() if self.health else {"vivo": True, "verificado_ha_s": None}
+            body = {"status": "ok" if snapshot["vivo"] else "travado", "verificado_ha_s": snapshot["verificado_ha_s"]}
+            return jsonify(body), 200 if snapshot["vivo"] else 503
+
+        @app.route('/ready')
+        def ready():
+            """Prontidão: 200 só quando todos os componentes estão saudáveis (senão 503 com os motivos)"""
+            from flask import jsonify
+
+            is_ready, reasons, snapshot = self.readiness()
+            body = {"status": "pronto" if is_ready else "indisponivel", "motivos": reasons,
+                    "verificado_ha_s": snapshot.get("verificado_ha_s"), "componentes": snapshot["componentes"]}
+            return jsonify(body), 200 if is_ready else 503
+
         @app.route('/shutdown', methods=['POST'])
         def shutdown():
-            """Endpoint para desligar o servidor"""
-            self.running = False
-            # Usa threading para encerrar o servidor de forma segura
-            def shutdown_server():
-                time.sleep(0.1)  # Pequeno delay para enviar resposta
-                os._exit(0)
-            
-            threading.Thread(target=shutdown_server, daemon=True).start()
+            """Endpoint para desligar o servidor (drena os tickets em andamento antes de sair)"""
+            if not local_or_token():
+                return "Erro: encerramento permitido apenas localmente ou com X-Admin-Token", 403
+            # Em outra thread: a resposta é enviada enquanto o encerramento acontece
+            threading.Thread(target=self.request_shutdown, name="shutdown", daemon=True).start()
             return 'Server shutting down...', 200
             
         return app
@@ -391,51 +3877,271 @@ class PrintingBackend:
         if self.running:
             return
             
-        self.app = self.create_flask_app()
         self.running = True
+        self.accepting = True
+        self.ready.clear()
+        self.start_error = None
+        
+        config = load_config()
+        host, port = server_address(config)
+        if not self.coordinator:
+            self.worker_count = max(1, int(config.get("server_workers", 1) or 1))
+            if self.worker_count > 1 and not supports_shared_port():
+                print("⚠️ server_workers > 1 requer SO_REUSEPORT (Linux); usando um único processo")
+                self.worker_count = 1
+        shared_port = self.worker_count > 1
+        tracer.configure(config)
+        traffic_recorder.configure(config)
+        self.admission = AdmissionController.from_config(config)
+        if self.coordinator:
+            # Worker: taxa, carga e fila são verificadas no coordenador (valem para a porta toda);
+            # o controle local só confere os campos e conta as próprias requisições em andamento
+            self.admission.enabled = False
+        if config.get("peers") and self.federation is None:
+            import socket
+            self.federation = PeerFederation.from_config(config, f"{socket.gethostname()}:{port}")
+        
+        # A fila da impressora, o histórico e o arquivo ficam só no processo coordenador
+        if self.pipeline is None and not self.coordinator:
+            if config.get("ticket_archive"):
+                self.archive = TicketArchive()
+                if os.path.exists(SPOOL_DIR):
+                    # Sobras do spool de uma execução anterior: os tickets já estão no arquivo
+                    remove_files([os.path.join(SPOOL_DIR, name) for name in os.listdir(SPOOL_DIR)])
+                threading.Thread(target=self.archive.maintenance, args=(config.get("archive_retention_days", 0),),
+                                 name="ticket-archive", daemon=True).start()
+            if config.get("history_enabled", True):
+                try:
+                    self.history = TicketHistory(config.get("history_db", "historico.db"))
+                except Exception as e:
+                    print(f"⚠️ Histórico de tickets desativado: {e}")
+            self.pipeline = PrintPipeline(
+                self.send_log,
+                batch_window_ms=config.get("print_batch_window_ms", 0),
+                batch_max=config.get("print_batch_max", 10),
+                aging_ms=config.get("print_priority_aging_ms", 10000),
+                supervisor=ProcessSupervisor(
+                    self.send_log,
+                    max_processes=config.get("print_max_processes", 2),
+                    timeout=config.get("print_process_timeout", 60),
+                ),
+            )
+            self.resume_pending(config)
+        # Depois da fila: a primeira rodada de verificações já a encontra pronta
+        if self.health is None:
+            self.health = HealthMonitor.from_config(self, config)
         
         def run_server():
             try:
-                print("🚀 Iniciando servidor de impressão na porta 5000...")
+                print(f"🚀 Iniciando servidor de impressão na porta {port} ({host})...")
                 if not os.path.exists('ticket'):
                     os.makedirs('ticket')
                     
                 # Configura logging para ser mais silencioso
                 log = logging.getLogger('werkzeug')
                 log.setLevel(logging.ERROR)
-                    
-                self.app.run(host='127.0.0.1', port=5000, debug=False, threaded=True, use_reloader=False)
+
+                # Flask é importado na thread do servidor para não atrasar tray/interface
+                with startup_report.phase("importar Flask e criar app"):
+                    from werkzeug.serving import make_server
+                    self.app = self.create_flask_app()
+
+                # Cria o socket antes de sinalizar prontidão: a partir daqui aceita tickets
+                with startup_report.phase(f"abrir porta {port}"):
+                    if shared_port:
+                        sock = open_shared_socket(host, port)
+                        self.server = make_server(host, port, self.app, threaded=True, fd=sock.fileno())
+                        sock.close()  # O servidor usa uma cópia do descritor
+                    else:
+                        self.server = make_server(host, port, self.app, threaded=True)
+                self.ready.set()
+                startup_report.mark("backend pronto")
+                print(f"✅ Servidor de impressão pronto em {backend_url(config=config)}")
+                
+                # Workers adicionais na mesma porta; a fila continua neste processo
+                if shared_port and not self.coordinator:
+                    threading.Thread(target=self.start_workers, args=(self.worker_count,), daemon=True).start()
+
+                # Aquece o renderizador em segundo plano (PIL e fontes) sem bloquear a porta
+                threading.Thread(target=self.warm_up, daemon=True).start()
+
+                self.server.serve_forever()
                 
             except Exception as e:
+                self.start_error = e
                 print(f"Erro no servidor de impressão: {e}")
             finally:
                 self.running = False
+                self.ready.set()  # Libera quem estiver aguardando, mesmo em caso de erro
         
         self.thread = threading.Thread(target=run_server, daemon=True)
         self.thread.start()
         print("✅ Servidor backend iniciado em thread separada")
+
+    def start_workers(self, count):
+        """Inicia count - 1 processos HTTP que compartilham a porta e enviam os tickets para cá"""
+        import multiprocessing
+
+        try:
+            address, authkey = start_coordinator(self)
+            context = multiprocessing.get_context("spawn")
+            for index in range(1, count):
+                process = context.Process(target=_serve_worker, args=(index, count, address, authkey),
+                                          name=f"http-worker-{index}")
+                process.start()
+                self.workers.append(process)
+            print(f"✅ {count - 1} worker(s) HTTP adicionais na porta compartilhada")
+        except Exception as e:
+            print(f"⚠️ Erro ao iniciar workers HTTP: {e}")
+
+    def stop_workers(self, timeout):
+        """Encerra os workers HTTP (cada um termina as próprias requisições em andamento)"""
+        for process in self.workers:
+            if process.is_alive():
+                process.terminate()  # SIGTERM: o worker drena e sai
+        deadline = time.monotonic() + timeout
+        for process in self.workers:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+        self.workers = []
+
+    def warm_up(self):
+        """Pré-carrega PIL e fontes para que o primeiro ticket não pague esse custo"""
+        config = load_config()
+        # Um perfil inválido é só ignorado: os demais continuam sendo aquecidos
+        profiles = [PrinterProfile()]
+        for name, data in (config.get("printer_profiles") or {}).items():
+            try:
+                profiles.append(PrinterProfile.from_dict(name, data))
+            except Exception as e:
+                print(f"⚠️ Perfil de impressora '{name}' inválido: {e}")
+        layouts = []
+        try:
+            with startup_report.phase("aquecer renderizador (PIL + fontes)"):
+                from PIL import Image, ImageDraw
+                ImageGenerator.load_fonts()
+                # Layouts prontos (fontes, atlas, logos, medidas) para cada perfil x template
+                plans = [DEFAULT_PLAN] + [plan for plan in map(self.templates.get, self.templates.names()) if plan]
+                layouts = [(plan, profile) for profile in profiles for plan in plans]
+                for plan, profile in layouts:
+                    PreparedLayout.get(plan, profile)
+        except Exception as e:
+            print(f"⚠️ Erro ao pré-carregar renderizador: {e}")
+        
+        # Pool de processos de renderização (render_workers > 0 no arquivo de configuração).
+        # Com server_workers > 1 o total é dividido entre os processos HTTP, em vez de multiplicado
+        total = int(config.get("render_workers", 0) or 0)
+        workers = total // self.worker_count + (1 if self.worker_index < total % self.worker_count else 0)
+        if workers > 0:
+            try:
+                with startup_report.phase(f"iniciar {workers} worker(s) de renderização"):
+                    executor = RenderExecutor(
+                        workers,
+                        max_jobs_per_worker=config.get("render_max_jobs_per_worker", 500),
+                        max_worker_memory_mb=config.get("render_max_worker_memory_mb", 300),
+                        layouts=layouts,
+                    )
+                    executor.start()
+                self.render_executor = executor
+                print(f"✅ Pool de renderização com {workers} worker(s) pronto")
+            except Exception as e:
+                print(f"⚠️ Erro ao iniciar pool de renderização: {e}")
     
-    def stop(self):
-        """Para o servidor backend"""
+    def resume_pending(self, config):
+        """Reenvia os tickets guardados no último encerramento, antes de aceitar novos"""
+        records = self.journal.take()
+        if not records:
+            return
+        self.send_log(f"Retomando {len(records)} ticket(s) pendente(s) do último encerramento", "INFO",
+                      "🔁 Retomando senhas pendentes", "info")
+        for record in records:
+            try:
+                if record.get("locator"):
+                    payload = (self.archive or TicketArchive()).read(record["locator"])
+                    image_path = spool_copy(payload, guess_ticket_extension(payload), config)
+                else:
+                    image_path = record["path"]
+                    with open(image_path, 'rb') as f:
+                        payload = f.read()
+                job = PrintJob(
+                    record["code"], payload, image_path, record["impressora"],
+                    resolve_printer_profile(config, record["impressora"]), config,
+                    record.get("priority", "normal"), fields=record.get("fields"),
+                    template=record.get("template"), locator=record.get("locator"),
+                    on_complete=self.history.record if self.history else None)
+                job.created = record.get("created", job.created)  # Mantém a antiguidade (aging)
+                self.pipeline.submit(job)
+            except Exception as e:
+                self.send_log(f"Não foi possível retomar o ticket {record.get('code')}: {e}", "ERROR",
+                              "❌ Senha pendente perdida", "error")
+
+    def drain(self, timeout=20):
+        """Encerramento sem perda: recusa novos tickets, espera os em andamento até o prazo
+        e guarda no diário de pendentes o que não chegou à impressora"""
+        self.accepting = False
+        deadline = time.monotonic() + timeout
+        if not self.pipeline:
+            # Worker (ou fila ainda não criada): só espera as próprias requisições
+            while self.admission.in_flight and time.monotonic() < deadline:
+                time.sleep(0.05)
+            return
+        self.send_log("Encerrando: novos tickets recusados, aguardando os em andamento", "INFO",
+                      "⏳ Finalizando impressões...", "warning")
+        while time.monotonic() < deadline:
+            if (self.admission.in_flight == 0 and self.pipeline.idle()
+                    and self.pipeline.supervisor.active() == 0):
+                break
+            time.sleep(0.05)
+        persisted = self.pipeline.close(self.journal)
+        # Requisições que ainda estavam renderizando caem direto no diário ao chegar à fila
+        grace = time.monotonic() + 5
+        while self.admission.in_flight and time.monotonic() < grace:
+            time.sleep(0.05)
+        if persisted or self.pipeline.supervisor.active():
+            self.send_log(f"Encerramento: {persisted} ticket(s) guardado(s) para o próximo início, "
+                          f"{self.pipeline.supervisor.active()} processo(s) de impressão ainda em andamento",
+                          "WARNING")
+        self.send_log(f"Métricas finais da fila: {json.dumps(self.pipeline.metrics(), ensure_ascii=False)}", "INFO")
+
+    def stop(self, drain_timeout=None):
+        """Para o servidor backend drenando os tickets em andamento"""
         if not self.running:
             return
-            
+        
+        print("🔴 Parando servidor backend...")
+        if drain_timeout is None:
+            drain_timeout = load_config().get("shutdown_drain_timeout", 20)
+        # Workers param de aceitar junto com este processo; seus tickets ainda chegam à fila
+        workers = threading.Thread(target=self.stop_workers, args=(drain_timeout + 5,), daemon=True)
+        workers.start()
         try:
-            print("🔴 Parando servidor backend...")
-            self.running = False
-            
-            # Tenta parar graciosamente primeiro
-            try:
-                requests.post("http://localhost:5000/shutdown", timeout=1)
+            self.drain(drain_timeout)
+        except Exception as e:
+            print(f"⚠️ Erro ao drenar a fila de impressão: {e}")
+        workers.join()
+        self.running = False
+        
+        try:
+            if self.server:
+                self.server.shutdown()
                 print("✅ Servidor backend parado graciosamente")
-            except:
-                # Se não conseguir parar graciosamente, força o encerramento
-                print("⚠️ Forçando encerramento do servidor backend")
-                
         except Exception as e:
             print(f"⚠️ Erro ao parar servidor: {e}")
         
-        self.running = False
+        if self.render_executor:
+            self.render_executor.shutdown()
+            self.render_executor = None
+        
+        # Coleta o resultado dos processos de impressão ainda em andamento
+        if self.pipeline:
+            self.pipeline.supervisor.shutdown(timeout=5)
+        if self.history:
+            self.history.flush()
+        
+        tracer.flush()
+        traffic_recorder.flush()
+        sys.stdout.flush()
 
 
 class DesktopApp:
@@ -443,6 +4149,8 @@ class DesktopApp:
     def __init__(self):
         self.message_queue = queue.Queue()
         self.backend = PrintingBackend(log_queue=self.message_queue)
+        self.backend.on_shutdown_request = self.quit_application  # /shutdown encerra o aplicativo
+        self.quit_lock = threading.Lock()  # Um único encerramento (tray, janela ou /shutdown)
         self.tray_app = None
         self.flet_process = None
         self.gui_visible = False
@@ -466,13 +4174,15 @@ class DesktopApp:
         
         # Executa Flet na thread principal
         try:
+            with startup_report.phase("importar Flet"):
+                import flet as ft
             ft.app(target=self.create_flet_app, port=0)
         except Exception as e:
             print(f"Erro na interface: {e}")
         finally:
             self.gui_visible = False
         
-    def create_flet_app(self, page: ft.Page):
+    def create_flet_app(self, page):
         """Cria a aplicação Flet"""
         # Chama a função main_gui passando a referência para este desktop_app
         main_gui(page, self)
@@ -513,6 +4223,8 @@ class DesktopApp:
         # Marca para encerrar
         self.should_quit = True
         
+        # Um segundo pedido aguarda o primeiro (que termina o processo) em vez de sair no meio da drenagem
+        self.quit_lock.acquire()
         try:
             # Para o tray primeiro
             if self.tray_app and self.tray_app.tray_icon:
@@ -522,18 +4234,17 @@ class DesktopApp:
                 except Exception as e:
                     print(f"⚠️ Erro ao parar tray: {e}")
             
-            # Para o backend
+            # Para o backend: drena a fila (tickets impressos ou guardados para o próximo início)
             print("🔴 Parando backend...")
             self.stop_backend()
             
-            # Pequeno delay para permitir cleanup
-            time.sleep(0.5)
-            
         except Exception as e:
             print(f"⚠️ Erro durante encerramento: {e}")
         finally:
-            # Força o encerramento
-            print("🔴 Encerramento forçado")
+            # Com a fila drenada não há ticket a perder; Flet e pystray mantêm threads
+            # próprias que impediriam o processo de terminar sozinho
+            print("🏁 Aplicação encerrada")
+            sys.stdout.flush()
             os._exit(0)
 
 
@@ -541,19 +4252,23 @@ class TrayApp:
     def __init__(self, desktop_app):
         self.desktop_app = desktop_app
         self.tray_icon = None
-        self.create_tray_icon()
+        self.ready = threading.Event()  # Sinalizado quando o ícone está na bandeja (ou falhou)
+        with startup_report.phase("criar ícone da bandeja"):
+            self.create_tray_icon()
         
     def create_tray_icon(self):
         """Cria o ícone da bandeja do sistema"""
         try:
+            import pystray
+            from PIL import Image
+
             # Usa o logo PNG para o ícone da bandeja
             if os.path.exists("assets/logo.png"):
                 try:
-                    image = Image.open("assets/logo.png")
-                    # Converte para RGB se necessário e redimensiona para 64x64
-                    if image.mode != 'RGB':
-                        image = image.convert('RGB')
-                    image = image.resize((64, 64), Image.Resampling.LANCZOS)
+                    with Image.open("assets/logo.png") as logo:
+                        # Converte para RGB se necessário e redimensiona para 64x64
+                        image = logo.convert('RGB') if logo.mode != 'RGB' else logo
+                        image = image.resize((64, 64), Image.Resampling.LANCZOS)
                     print("✅ Ícone da bandeja carregado de assets/logo.png")
                 except Exception as png_error:
                     print(f"⚠️ Erro ao carregar assets/logo.png: {png_error}")
@@ -593,7 +4308,8 @@ class TrayApp:
             try:
                 if self.tray_icon:
                     print(f"Iniciando ícone da bandeja (tentativa {retry_count + 1})")
-                    self.tray_icon.run_detached()
+                    with startup_report.phase("iniciar ícone da bandeja"):
+                        self.tray_icon.run_detached()
                     print("Ícone da bandeja iniciado com sucesso")
                     break
                 else:
@@ -610,6 +4326,7 @@ class TrayApp:
                         self.create_tray_icon()
                     except:
                         pass
+        self.ready.set()
     
     def show_window(self, icon=None, item=None):
         """Solicita abertura da interface gráfica via message queue"""
@@ -627,11 +4344,17 @@ class TrayApp:
     def check_status(self, icon=None, item=None):
         """Verifica status do servidor"""
         try:
-            response = requests.get("http://localhost:5000/status", timeout=5)
+            import requests
+            response = requests.get(backend_url("/ready"), timeout=5)
             if response.status_code == 200:
                 self.show_notification("Servidor Online", "Serviço de impressão está rodando normalmente")
             else:
-                self.show_notification("Servidor com Problemas", f"Status: {response.status_code}")
+                try:
+                    reasons = response.json().get("motivos") or []
+                except ValueError:
+                    reasons = []
+                self.show_notification("Servidor com Problemas",
+                                       "\n".join(reasons) or f"Status: {response.status_code}")
         except Exception as e:
             self.show_notification("Erro de Conexão", f"Não foi possível conectar ao servidor: {e}")
     
@@ -660,7 +4383,9 @@ class TrayApp:
             os._exit(0)
 
 
-def main_gui(page: ft.Page, desktop_app):
+def main_gui(page, desktop_app):
+    import flet as ft
+
     page.title = "Cliente de Impressão - Monitor"
     page.horizontal_alignment = ft.CrossAxisAlignment.STRETCH
     page.vertical_alignment = ft.MainAxisAlignment.START
@@ -686,6 +4411,7 @@ def main_gui(page: ft.Page, desktop_app):
     # Carrega configurações salvas
     config = load_config()
     
+    MAX_LOG_LINES = 300  # Linhas mantidas em cada visão de log
     log_view = ft.ListView(expand=True, spacing=4, auto_scroll=True)
     advanced_log_view = ft.ListView(expand=True, spacing=4, auto_scroll=True)
     
@@ -741,8 +4467,15 @@ def main_gui(page: ft.Page, desktop_app):
                 vertical_alignment=ft.CrossAxisAlignment.CENTER,
             )
         )
+        trim_log(log_view)
         page.update()
 
+    def trim_log(view):
+        """Mantém só as últimas MAX_LOG_LINES linhas (o app fica semanas aberto na bandeja)"""
+        excess = len(view.controls) - MAX_LOG_LINES
+        if excess > 0:
+            del view.controls[:excess]
+
     def append_advanced_log(line, level="INFO"):
         """Adiciona log técnico detalhado"""
         timestamp = time.strftime("%H:%M:%S")
@@ -764,6 +4497,7 @@ def main_gui(page: ft.Page, desktop_app):
                 vertical_alignment=ft.CrossAxisAlignment.CENTER,
             )
         )
+        trim_log(advanced_log_view)
         page.update()
 
     def append_log(line, level="INFO"):
@@ -802,9 +4536,9 @@ def main_gui(page: ft.Page, desktop_app):
         if "printing server stopped" in l:
             append_simple_log("⏹️ Servidor parado", "error")
             return
-        if ("servidor flask iniciado" in l or "servidor de impressão na porta 5000" in l or 
+        if ("servidor flask iniciado" in l or "servidor de impressão na porta" in l or 
             "servidor backend iniciado" in l or "serving flask app" in l or 
-            "running on http://127.0.0.1:5000" in l):
+            "running on http://" in l):
             append_simple_log("🚀 Servidor iniciado", "success")
             update_server_status(True)
             return
@@ -890,17 +4624,11 @@ def main_gui(page: ft.Page, desktop_app):
                 os.makedirs('ticket')
             img.save(test_image_path)
             
-            # Configurações para ocultar janela do console
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-            
             # Tenta imprimir
-            command = ['mspaint', '/pt', test_image_path, printer_name]
+            command = build_print_command(test_image_path, printer_name)
             result = subprocess.run(
                 command,
-                startupinfo=startupinfo,
-                creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
+                **hidden_process_kwargs(),
                 timeout=10,
                 capture_output=True
             )
@@ -941,18 +4669,12 @@ def main_gui(page: ft.Page, desktop_app):
         
         print("🔄 Carregando impressoras do sistema...")
         try:
-            # Configurações para ocultar janela do console
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-            
             # Comando PowerShell otimizado com timeout reduzido
             result = subprocess.run([
                 "powershell", "-NoProfile", "-NonInteractive", "-Command", 
                 "Get-Printer | Select-Object -ExpandProperty Name"
             ], capture_output=True, text=True, timeout=5,
-            startupinfo=startupinfo,
-            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0)
+            **hidden_process_kwargs())
             
             if result.returncode == 0:
                 printers = [p.strip() for p in result.stdout.splitlines() if p.strip()]
@@ -1150,18 +4872,12 @@ def main_gui(page: ft.Page, desktop_app):
     def limpar_fila_impressora(impressora):
         """Limpa a fila da impressora de forma tolerante a erros"""
         try:
-            # Configurações para ocultar janela do console
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-            
             # Tenta primeiro com PowerShell
             result = subprocess.run([
                 "powershell", "-Command", 
                 f"Get-PrintJob -PrinterName '{impressora}' | Remove-PrintJob"
             ], capture_output=True, text=True, timeout=10,
-            startupinfo=startupinfo,
-            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0)
+            **hidden_process_kwargs())
             
             if result.returncode == 0:
                 append_log(f"Fila da impressora '{impressora}' limpa com sucesso", "INFO")
@@ -1187,17 +4903,11 @@ def main_gui(page: ft.Page, desktop_app):
     def find_installed_printers():
         """Lista todas as impressoras instaladas no sistema"""
         try:
-            # Configurações para ocultar janela do console
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-            
             result = subprocess.run([
                 "powershell", "-Command", 
                 "Get-Printer | Select-Object -ExpandProperty Name"
             ], capture_output=True, text=True, timeout=10,
-            startupinfo=startupinfo,
-            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0)
+            **hidden_process_kwargs())
             
             if result.returncode == 0:
                 printers = [p.strip() for p in result.stdout.splitlines() if p.strip()]
@@ -1275,10 +4985,6 @@ def main_gui(page: ft.Page, desktop_app):
                 append_log(f"Impressora '{impressora}' não encontrada nas impressoras instaladas", "WARNING")
                 return False
             
-            # Configurações para ocultar janela do console
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
             
             # Verifica múltiplos aspectos da impressora usando PowerShell
             result = subprocess.run([
@@ -1290,8 +4996,7 @@ def main_gui(page: ft.Page, desktop_app):
                 f"if ($jobs) {{ $errorJobs = ($jobs | Where-Object {{ $_.JobStatus -like '*Error*' -or $_.JobStatus -like '*Offline*' }}); "
                 f"Write-Output \"ErrorJobs:$($errorJobs.Count)\" }} else {{ Write-Output 'ErrorJobs:0' }}"
             ], capture_output=True, text=True, timeout=8,
-            startupinfo=startupinfo,
-            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0)
+            **hidden_process_kwargs())
             
             if result.returncode == 0:
                 output = result.stdout.strip().lower()
@@ -1321,8 +5026,7 @@ def main_gui(page: ft.Page, desktop_app):
                     "powershell", "-NoProfile", "-Command",
                     f"Get-Printer -Name '{impressora_encontrada}' | Select-Object -ExpandProperty PrinterStatus"
                 ], capture_output=True, text=True, timeout=5,
-                startupinfo=startupinfo,
-                creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0)
+                **hidden_process_kwargs())
                 
                 if result_basic.returncode == 0:
                     status = result_basic.stdout.strip().lower()
@@ -1357,12 +5061,13 @@ def main_gui(page: ft.Page, desktop_app):
 
     def call_endpoint(path, params=None):
         """Função para testar endpoints"""
-        url = f"http://localhost:5000{path}"
+        url = backend_url(path)
         append_log(f"Testando endpoint: {url}", "INFO")
         if params:
             append_log(f"Parâmetros: {params}", "INFO")
         
         try:
+            import requests
             response = requests.get(url, params=params or {}, timeout=10)
             append_log(f"Resposta: {response.status_code} - {response.text}", "INFO")
             
@@ -1661,25 +5366,6 @@ def main_gui(page: ft.Page, desktop_app):
     page.on_window_event = on_window_event
     print("✅ Sistema configurado - Interface minimiza para bandeja ao fechar")
     
-    # Função para verificar e atualizar o status do servidor
-    def check_server_status():
-        time.sleep(2)
-        try:
-            response = requests.get("http://localhost:5000/status", timeout=5)
-            if response.status_code == 200:
-                append_simple_log("✅ Servidor de impressão online", "success")
-                # Atualiza o status badge para EXECUTANDO
-                status_badge.content = ft.Text("Executando", color=ft.Colors.WHITE, weight=ft.FontWeight.BOLD, size=14)
-                status_badge.bgcolor = ft.Colors.GREEN_600
-                page.update()
-                
-                if desktop_app.tray_app:
-                    desktop_app.tray_app.show_notification("Serviço Iniciado", "Servidor de impressão está online e pronto para uso")
-            else:
-                append_simple_log("⚠️ Servidor respondendo com erro", "warning")
-        except:
-            append_simple_log("⏳ Aguardando servidor inicializar...", "info")
-    
     # Função para atualizar status do servidor
     def update_server_status(online=True):
         """Atualiza o status badge do servidor"""
@@ -1691,95 +5377,442 @@ def main_gui(page: ft.Page, desktop_app):
             status_badge.bgcolor = ft.Colors.RED_600
         page.update()
     
-    # Função para verificação inicial imediata (caso o servidor já esteja rodando)
-    def check_initial_status():
-        try:
-            response = requests.get("http://localhost:5000/status", timeout=2)
-            if response.status_code == 200:
-                append_simple_log("✅ Servidor já estava online", "success")
-                update_server_status(True)
-                return True
-            else:
-                # Agenda a verificação normal com delay
-                threading.Thread(target=check_server_status, daemon=True).start()
-                return False
-        except:
-            # Servidor ainda não está pronto, agenda a verificação normal
-            threading.Thread(target=check_server_status, daemon=True).start()
-            return False
-    
-    # Função para verificação contínua do status
-    def monitor_server_status():
-        """Monitora o status do servidor continuamente"""
-        attempts = 0
-        max_attempts = 10
-        
-        while attempts < max_attempts:
-            try:
-                response = requests.get("http://localhost:5000/status", timeout=3)
-                if response.status_code == 200:
-                    append_simple_log("✅ Servidor de impressão online", "success")
-                    update_server_status(True)
-                    
-                    if desktop_app.tray_app:
-                        desktop_app.tray_app.show_notification("Serviço Iniciado", "Servidor de impressão está online e pronto para uso")
-                    
-                    return True
-                else:
-                    append_simple_log("⚠️ Servidor respondendo com erro", "warning")
-                    
-            except Exception as e:
-                append_simple_log(f"⏳ Tentativa {attempts + 1}/{max_attempts} - Aguardando servidor...", "info")
-                
-            attempts += 1
-            time.sleep(1)  # Espera 1 segundo entre tentativas
+    # Função que aguarda o sinal de prontidão do backend (sem esperas fixas)
+    def wait_server_ready():
+        """Aguarda o backend sinalizar que está aceitando conexões"""
+        if desktop_app.backend.wait_ready(timeout=30):
+            append_simple_log("✅ Servidor de impressão online", "success")
+            update_server_status(True)
+            
+            if desktop_app.tray_app:
+                desktop_app.tray_app.show_notification("Serviço Iniciado", "Servidor de impressão está online e pronto para uso")
+            return True
         
-        # Se chegou aqui, o servidor não respondeu após todas as tentativas
-        append_simple_log("❌ Servidor não respondeu após múltiplas tentativas", "error")
+        if desktop_app.backend.start_error:
+            append_log(f"Erro ao iniciar servidor: {desktop_app.backend.start_error}", "ERROR")
+        append_simple_log("❌ Servidor não respondeu ao iniciar", "error")
+        update_server_status(False)
         return False
     
     # Inicia o timer para processar logs do Flask
     start_log_timer()
     
-    # Executa verificação inicial e depois monitora
-    if not check_initial_status():
-        # Se a verificação inicial falhou, inicia monitoramento
-        threading.Thread(target=monitor_server_status, daemon=True).start()
+    # Verificação imediata (caso o servidor já esteja pronto); senão aguarda o sinal em background
+    if desktop_app.backend.ready.is_set():
+        wait_server_ready()
+    else:
+        append_simple_log("⏳ Aguardando servidor inicializar...", "info")
+        threading.Thread(target=wait_server_ready, daemon=True).start()
+
+
+def parse_args(argv=None):
+    """Interpreta os argumentos de linha de comando"""
+    parser = argparse.ArgumentParser(description="Sistema de Impressão de Senhas")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="mostra o tempo de importação e inicialização de cada fase")
+    parser.add_argument("--headless", action="store_true",
+                        help="executa apenas o servidor de impressão, sem interface e sem bandeja")
+    parser.add_argument("--printer-simulator", type=int, nargs="?", const=9100, metavar="PORTA",
+                        help="executa apenas uma impressora simulada escutando TCP (padrão: 9100)")
+    parser.add_argument("--replay", nargs="+", metavar="ARQUIVO",
+                        help="reproduz tráfego gravado (gravacoes/trafego-*.jsonl) contra um servidor")
+    parser.add_argument("--speed", default="1",
+                        help="velocidade da reprodução: 1, 10 (vezes o ritmo original) ou max")
+    parser.add_argument("--target", help="URL do servidor para a reprodução (padrão: o desta configuração)")
+    parser.add_argument("--replay-concurrency", type=int, default=32, metavar="N",
+                        help="máximo de requisições simultâneas na reprodução")
+    parser.add_argument("--replay-report", metavar="ARQUIVO", help="grava o relatório da reprodução em JSON")
+    parser.add_argument("--soak", type=int, metavar="TICKETS",
+                        help="teste de longa duração: imprime TICKETS tickets simulados e verifica vazamentos")
+    parser.add_argument("--soak-clients", type=int, default=8, metavar="N", help="clientes simultâneos no --soak")
+    parser.add_argument("--soak-interval", type=float, default=5.0, metavar="S", help="intervalo entre amostras do --soak")
+    parser.add_argument("--soak-dir", metavar="PASTA", help="pasta de trabalho do --soak (padrão: temporária)")
+    parser.add_argument("--soak-report", metavar="ARQUIVO", help="CSV com as amostras do --soak")
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def load_traffic(paths):
+    """Lê gravações de tráfego (vários arquivos/workers) em ordem de chegada"""
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue  # Linha incompleta (gravação interrompida)
+    records.sort(key=lambda record: record["t"])
+    return records
+
+
+def latency_summary(values_ms):
+    """p50/p90/p99/máximo de uma lista de latências em ms"""
+    if not values_ms:
+        return {}
+    ordered = sorted(values_ms)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(ordered[-1], 1)}
+
+
+def replay_traffic(records, target, speed=1.0, concurrency=32):
+    """Reenvia as requisições gravadas respeitando os intervalos originais divididos por `speed`
+
+    Com speed=None as requisições saem o mais rápido possível (limitadas por
+    `concurrency`). Devolve o relatório comparando com o ritmo e a latência originais.
+    """
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+
+    local = threading.local()
+    results = []
+    lock = threading.Lock()
+
+    def send(record, scheduled):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        sent = time.monotonic()
+        headers = {"X-Replay": "1"}  # Não é gravado de novo
+        try:
+            status = session.get(target + record["e"], params=record.get("p"), headers=headers, timeout=60).status_code
+        except requests.RequestException:
+            status = "falha de conexão"
+        with lock:
+            results.append((status, (time.monotonic() - sent) * 1000, (sent - scheduled) * 1000))
+
+    first = records[0]["t"]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in records:
+            scheduled = start + (record["t"] - first) / speed if speed else start
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, record, scheduled)
+    elapsed = time.monotonic() - start
+
+    original_span = records[-1]["t"] - first
+    report = {
+        "requisicoes": len(records),
+        "velocidade": speed or "max",
+        "duracao_original_s": round(original_span, 2),
+        "duracao_s": round(elapsed, 2),
+        "vazao_original_rps": round(len(records) / original_span, 2) if original_span else None,
+        "vazao_rps": round(len(records) / elapsed, 2) if elapsed else None,
+        "status_original": dict(collections.Counter(str(record.get("s")) for record in records)),
+        "status": dict(collections.Counter(str(status) for status, _, _ in results)),
+        "latencia_original_ms": latency_summary([record["ms"] for record in records if "ms" in record]),
+        "latencia_ms": latency_summary([latency for _, latency, _ in results]),
+    }
+    if speed:
+        # Atraso entre o instante programado e o envio: o cliente não acompanhou o ritmo
+        report["atraso_envio_ms"] = latency_summary([lag for _, _, lag in results])
+    return report
+
+
+def run_replay(args):
+    """Executa a reprodução de tráfego da linha de comando e mostra o relatório"""
+    records = load_traffic(args.replay)
+    if not records:
+        print("❌ Nenhuma requisição nas gravações informadas")
+        return 1
+    speed_text = args.speed.lower()
+    speed = None if speed_text == "max" else float(speed_text.rstrip("x"))
+    target = (args.target or backend_url()).rstrip("/")
+    print(f"▶️ Reproduzindo {len(records)} requisições em {target} (velocidade {args.speed})...")
+    report = replay_traffic(records, target, speed, args.replay_concurrency)
+    
+    print(f"⏱️ Duração: {report['duracao_s']}s (original {report['duracao_original_s']}s)")
+    print(f"📈 Vazão: {report['vazao_rps']} req/s (original {report['vazao_original_rps']} req/s)")
+    print(f"🕒 Latência: {report['latencia_ms']} (original {report['latencia_original_ms']})")
+    print(f"📋 Status: {report['status']} (original {report['status_original']})")
+    if "atraso_envio_ms" in report:
+        print(f"📤 Atraso de envio: {report['atraso_envio_ms']}")
+    if args.replay_report:
+        with open(args.replay_report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"💾 Relatório salvo em {args.replay_report}")
+    return 0
+
+
+def open_handle_count():
+    """Descritores de arquivo (Linux) ou handles (Windows) abertos pelo processo, ou None"""
+    try:
+        if os.name == 'nt':
+            import ctypes
+            from ctypes import wintypes
+
+            count = wintypes.DWORD()
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.kernel32.GetProcessHandleCount(handle, ctypes.byref(count)):
+                return count.value
+            return None
+        return len(os.listdir("/proc/self/fd"))
+    except Exception:
+        return None
+
+
+def directory_usage(path):
+    """(bytes, arquivos) de uma pasta e subpastas"""
+    total, files = 0, 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                pass  # Apagado durante a varredura (spool)
+    return total, files
+
+
+SOAK_LIMITS = {"rss_mb": 25, "handles": 10, "threads": 5, "spool_files": 20}
+
+
+def soak_growth(samples, key):
+    """Crescimento sustentado de uma métrica: mediana da metade final menos a da inicial
+
+    O primeiro quarto das amostras é descartado (aquecimento: caches, pools, conexões).
+    """
+    values = [sample[key] for sample in samples[len(samples) // 4:] if sample[key] is not None]
+    if len(values) < 4:
+        return None
+    half = len(values) // 2
+    median = lambda items: sorted(items)[len(items) // 2]
+    return median(values[half:]) - median(values[:half])
+
+
+def run_soak(args):
+    """Teste de longa duração: centenas de milhares de tickets pelo backend com impressora simulada
+
+    Roda numa pasta própria (ticket/, histórico e configuração não se misturam aos
+    reais) e amostra RSS, handles abertos, threads e o tamanho de ticket/ ao longo do
+    tempo, gravando um CSV. Falha (código 1) se alguma métrica cresce de forma
+    sustentada além de SOAK_LIMITS depois do aquecimento.
+    """
+    import csv
+    import socket
+    import tempfile
+    import requests
+
+    # Sem configuração na pasta atual, parte da padrão (load_config criaria o arquivo aqui)
+    base_config = load_config() if os.path.exists(CONFIG_FILE) else {}
+    templates_dir = os.path.abspath("templates")
+    directory = os.path.abspath(args.soak_dir or tempfile.mkdtemp(prefix="soak-"))
+    os.makedirs(directory, exist_ok=True)
+    report_path = os.path.abspath(args.soak_report) if args.soak_report else os.path.join(directory, "soak.csv")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    # Muitas vagas de envio: com a impressora instantânea, o limite seria o ciclo do supervisor
+    config = dict(base_config, server_host="127.0.0.1", server_port=port, server_workers=1, print_max_processes=64,
+                  print_sink={"type": "simulator", "name": "soak", "print_ms": 0, "buffer_tickets": 64},
+                  admission=dict(base_config.get("admission") or {}, rate_per_client=1e9, burst=1e9,
+                                 max_in_flight=args.soak_clients * 2, max_queue=100000),
+                  traffic_recording=None, tracing=None, peers=None)
+    if not config.get("selected_printer"):
+        config["selected_printer"] = "soak"  # Os tickets vão para a impressora simulada de qualquer forma
+    os.chdir(directory)
+    save_config(config)
+    print(f"🧪 Teste de longa duração: {args.soak} tickets, {args.soak_clients} clientes, pasta {directory}")
+
+    backend = PrintingBackend()
+    backend.templates = TemplateRegistry(templates_dir)
+    backend.start()
+    if not backend.wait_ready(timeout=60):
+        print(f"❌ Servidor não iniciou: {backend.start_error}")
+        return 1
+
+    url = backend_url(config=config)
+    counter = {"enviados": 0}
+    statuses = collections.Counter()
+    lock = threading.Lock()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with lock:
+                if counter["enviados"] >= args.soak:
+                    return
+                counter["enviados"] += 1
+                number = counter["enviados"]
+            # Mistura de tickets com e sem QR e nomes de serviço de tamanhos variados
+            path = "/imprimir/qrcode" if number % 3 == 0 else "/imprimir"
+            params = {"code": f"S{number % 1000:03d}", "created_date": time.strftime("%d/%m/%Y %H:%M"),
+                      "services": " ".join(["Atendimento"] * (1 + number % 4)), "qrcode": f"soak-{number}"}
+            try:
+                status = session.get(url + path, params=params, timeout=60).status_code
+            except requests.RequestException:
+                status = "falha de conexão"
+            with lock:
+                statuses[status] += 1
+
+    samples = []
+    fields = ["segundos", "tickets", "rss_mb", "handles", "threads", "ticket_mb", "spool_files"]
+    started = time.monotonic()
+
+    def sample():
+        rss = current_rss_bytes()
+        ticket_bytes, _ = directory_usage("ticket")
+        _, spool_files = directory_usage(SPOOL_DIR)
+        with lock:
+            done = sum(statuses.values())
+        row = {"segundos": round(time.monotonic() - started, 1), "tickets": done,
+               "rss_mb": round(rss / 1024 / 1024, 1) if rss else None, "handles": open_handle_count(),
+               "threads": threading.active_count(), "ticket_mb": round(ticket_bytes / 1024 / 1024, 2),
+               "spool_files": spool_files}
+        samples.append(row)
+        writer.writerow(row)
+        report.flush()
+        print(f"📊 {row['tickets']} tickets | RSS {row['rss_mb']} MB | handles {row['handles']} | "
+              f"threads {row['threads']} | ticket/ {row['ticket_mb']} MB")
+
+    with open(report_path, "w", newline="", encoding="utf-8") as report:
+        writer = csv.DictWriter(report, fieldnames=fields)
+        writer.writeheader()
+        clients = [threading.Thread(target=client, name=f"soak-{index}", daemon=True)
+                   for index in range(args.soak_clients)]
+        for thread in clients:
+            thread.start()
+        sample()
+        while any(thread.is_alive() for thread in clients):
+            time.sleep(args.soak_interval)
+            sample()
+        # Espera a fila e os envios terminarem para a amostra final
+        deadline = time.monotonic() + 60
+        while (not backend.pipeline.idle() or backend.pipeline.supervisor.active()) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        sample()
+
+    backend.stop()
+    tickets = max(1, samples[-1]["tickets"])
+    print(f"📋 Status: {dict(statuses)}")
+    print(f"📦 ticket/: {samples[-1]['ticket_mb']} MB ({samples[-1]['ticket_mb'] * 1024 * 1024 / tickets:.0f} bytes por ticket)")
+    failed = []
+    for key, limit in SOAK_LIMITS.items():
+        growth = soak_growth(samples, key)
+        if growth is None:
+            continue
+        ok = growth <= limit
+        print(f"{'✅' if ok else '❌'} {key}: crescimento {growth:+g} (limite {limit})")
+        if not ok:
+            failed.append(key)
+    errors = sum(count for status, count in statuses.items() if status != 200)
+    if errors:
+        print(f"❌ {errors} requisições sem sucesso")
+    print(f"💾 Amostras em {report_path}")
+    return 1 if failed or errors else 0
+
+
+def run_printer_simulator(port):
+    """Executa uma impressora simulada como impressora de rede, para testes de carga
+
+    Usa as opções de "print_sink" do arquivo de configuração (tempo de impressão,
+    buffer, janelas offline...), e mostra o resumo do que foi recebido ao encerrar.
+    """
+    settings = dict(load_config().get("print_sink") or {})
+    settings.setdefault("name", f"simulador-{port}")
+    simulator = PrinterSimulator.from_settings(settings)
+    server = PrinterSimulatorServer(simulator, settings.get("listen_host", "127.0.0.1"), port).start()
+    print(f"🖨️ Impressora simulada escutando em {server.address[0]}:{server.address[1]} (Ctrl+C para encerrar)")
+    stop_event = threading.Event()
+    for name in ("SIGTERM", "SIGINT", "SIGBREAK"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), lambda signum, frame: stop_event.set())
+    while not stop_event.is_set():
+        stop_event.wait(1)
+    server.stop()
+    print(f"📊 Impressora simulada: {json.dumps(simulator.stats(), ensure_ascii=False)}")
+    return 0
+
+
+def run_headless():
+    """Executa somente o backend de impressão como serviço (sem Flet e sem pystray)"""
+    print("🚀 Iniciando servidor de impressão em modo headless...")
+    
+    backend = PrintingBackend()
+    stop_event = threading.Event()
+    backend.on_shutdown_request = stop_event.set  # /shutdown segue o mesmo encerramento dos sinais
+    
+    def handle_signal(signum, frame):
+        print(f"🔴 Sinal {signum} recebido, encerrando servidor...")
+        stop_event.set()
+    
+    # SIGTERM (systemd/docker), SIGINT (Ctrl+C) e SIGBREAK (console do Windows)
+    for name in ("SIGTERM", "SIGINT", "SIGBREAK"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), handle_signal)
+    
+    backend.start()
+    if not backend.wait_ready(timeout=60):
+        print(f"❌ Servidor não iniciou: {backend.start_error}")
+        startup_report.report()
+        return 1
+    startup_report.report()
+    
+    # Espera em intervalos curtos para que os sinais sejam tratados também no Windows
+    while not stop_event.is_set() and backend.running:
+        stop_event.wait(1)
+    
+    backend.stop()
+    print("🏁 Servidor de impressão encerrado")
+    return 0
 
 
 def main():
     """Função principal que inicializa o aplicativo desktop"""
+    args = parse_args()
+    if args.startup_report:
+        startup_report.enabled = True
+    
+    if args.soak:
+        sys.exit(run_soak(args))
+    
+    if args.replay:
+        sys.exit(run_replay(args))
+    
+    if args.printer_simulator:
+        sys.exit(run_printer_simulator(args.printer_simulator))
+    
+    if args.headless:
+        sys.exit(run_headless())
+    
     print("🚀 Iniciando Sistema de Impressão de Senhas...")
     
     # Cria a instância principal do aplicativo
     desktop_app = DesktopApp()
     
-    # Inicializa o backend (servidor Flask)
+    # Inicializa o backend (servidor Flask) - sinaliza backend.ready quando aceitar conexões
     desktop_app.start_backend()
     
-    # Aguarda um pouco para o backend inicializar
-    time.sleep(1)
-    
-    # Cria o tray app
-    desktop_app.tray_app = TrayApp(desktop_app)
+    # Cria e inicia o tray em thread separada, em paralelo com o backend e a interface
+    def start_tray():
+        try:
+            desktop_app.tray_app = TrayApp(desktop_app)
+            if desktop_app.tray_app.tray_icon:
+                desktop_app.tray_app.run_tray()
+                print("✅ Ícone da bandeja iniciado")
+            else:
+                print("⚠️ Falha ao criar ícone da bandeja")
+                desktop_app.tray_app.ready.set()
+        except Exception as e:
+            print(f"❌ Erro ao iniciar ícone da bandeja: {e}")
+        finally:
+            tray_ready.set()
     
-    # Inicia o tray em thread separada
-    try:
-        if desktop_app.tray_app.tray_icon:
-            tray_thread = threading.Thread(target=desktop_app.tray_app.run_tray, daemon=True)
-            tray_thread.start()
-            print("✅ Ícone da bandeja iniciado")
-        else:
-            print("⚠️ Falha ao criar ícone da bandeja")
-    except Exception as e:
-        print(f"❌ Erro ao iniciar ícone da bandeja: {e}")
+    tray_ready = threading.Event()
+    threading.Thread(target=start_tray, daemon=True).start()
     
-    # Aguarda mais um pouco para tudo inicializar
-    time.sleep(0.5)
+    # Relatório de inicialização quando backend e tray estiverem prontos
+    if startup_report.enabled:
+        def report_when_ready():
+            desktop_app.backend.wait_ready(timeout=60)
+            tray_ready.wait(timeout=60)
+            startup_report.report()
+        threading.Thread(target=report_when_ready, daemon=True).start()
     
-    print("✅ Backend e tray inicializados com sucesso!")
-    print("🔄 Backend rodando em background")
-    print("📍 Ícone disponível na bandeja do sistema")
+    print("🔄 Backend inicializando em background")
+    print("📍 Ícone sendo criado na bandeja do sistema")
     
     # Inicia a interface gráfica na thread principal
     print("🎨 Iniciando interface gráfica...")
@@ -1794,6 +5827,9 @@ def main():
     print("📱 Interface fechada - aplicativo continua na bandeja")
     print("🔍 Monitorando mensagens do tray...")
     
+    # Garante que o tray terminou de inicializar antes de decidir se o app continua vivo
+    tray_ready.wait()
+    
     # Loop principal que mantém o aplicativo vivo e processa mensagens
     try:
         while desktop_app.tray_app and desktop_app.tray_app.tray_icon and not desktop_app.should_quit:
@@ -1823,4 +5859,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Necessário para o pool de renderização no executável do PyInstaller
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flet_app  # noqa: E402
+
+
+FINAL_STATUSES = ("impresso", "erro", "cancelado", "pendente")
+
+
+def silent_log(*args, **kwargs):
+    pass
+
+
+def wait_final(job, timeout=10):
+    """Aguarda o resultado final do ticket (o wait() do PrintJob só cobre a entrega)"""
+    deadline = time.monotonic() + timeout
+    while job.status not in FINAL_STATUSES and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return job.status
+
+
+@pytest.fixture
+def simulator_config():
+    """Configuração com uma impressora simulada exclusiva do teste"""
+    def build(**settings):
+        settings = dict({"type": "simulator", "name": f"teste-{uuid.uuid4().hex[:8]}"}, **settings)
+        return {"print_sink": settings}
+    return build
+
+
+@pytest.fixture
+def make_job(tmp_path):
+    """Cria tickets com o arquivo entregue ao destino de impressão"""
+    def build(code, config, payload=None):
+        payload = payload or f"ticket {code}".encode()
+        path = tmp_path / f"{code}.bin"
+        path.write_bytes(payload)
+        return flet_app.PrintJob(code, payload, str(path), "Simulada", flet_app.PrinterProfile(), config)
+    return build
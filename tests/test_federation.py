@@ -0,0 +1,88 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+requests = pytest.importorskip("requests")
+pytest.importorskip("flask")
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flet_app.py")
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_until(condition, timeout=20, interval=0.1):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+    return False
+
+
+@pytest.fixture
+def start_instance(tmp_path):
+    """Sobe uma instância headless numa pasta própria com a configuração dada"""
+    processes = []
+
+    def start(name, **config):
+        directory = tmp_path / name
+        directory.mkdir()
+        port = free_port()
+        config = dict({"selected_printer": "Simulada", "server_port": port,
+                       "health": {"interval": 0.2}}, **config)
+        (directory / "printer_config.json").write_text(json.dumps(config), encoding="utf-8")
+        with open(directory / "saida.log", "w") as log:
+            processes.append(subprocess.Popen([sys.executable, APP, "--headless"], cwd=directory,
+                                              stdout=log, stderr=subprocess.STDOUT))
+        url = f"http://127.0.0.1:{port}"
+        assert wait_until(lambda: requests.get(url + "/health", timeout=1).status_code == 200), \
+            (directory / "saida.log").read_text()
+        return url
+
+    yield start
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def test_impressora_local_parada_encaminha_para_o_par(start_instance):
+    peer = start_instance("b", print_sink={"type": "simulator", "name": "b", "print_ms": 5})
+    local = start_instance(
+        "a", peers=[peer], federation={"health_interval": 0.2, "failover_after": 3},
+        print_sink={"type": "simulator", "name": "a", "print_ms": 5, "failure_rate": 1.0})
+    assert wait_until(lambda: requests.get(local + "/ready", timeout=1).status_code == 200)
+
+    # Cada ticket é entregue à impressora local, que falha em seguida
+    for number in range(3):
+        response = requests.get(local + "/imprimir", params={"code": f"L{number}"}, timeout=10)
+        assert response.status_code == 200
+        assert "X-Encaminhado-Para" not in response.headers
+
+    def printer_down():
+        response = requests.get(local + "/ready", timeout=1)
+        return response.status_code == 503 and any(
+            reason.startswith("impressora:") for reason in response.json()["motivos"])
+
+    assert wait_until(printer_down)
+
+    response = requests.get(local + "/imprimir", params={"code": "P1"}, timeout=10)
+    assert response.status_code == 200
+    assert response.headers["X-Encaminhado-Para"] == peer
+    job = requests.get(peer + f"/trabalho/{response.headers['X-Job-Id']}", timeout=5).json()
+    assert job["code"] == "P1"
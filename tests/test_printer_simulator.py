@@ -0,0 +1,190 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import flet_app
+from conftest import silent_log, wait_final
+
+
+def make_pipeline(max_processes=2, timeout=10):
+    supervisor = flet_app.ProcessSupervisor(silent_log, max_processes=max_processes, timeout=timeout)
+    return flet_app.PrintPipeline(silent_log, supervisor=supervisor)
+
+
+def wait_for(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def simulator_for(config):
+    return flet_app.get_printer_simulator(config["print_sink"])
+
+
+def test_tickets_impressos_e_registrados(simulator_config, make_job):
+    config = simulator_config(print_ms=5)
+    pipeline = make_pipeline()
+    jobs = [pipeline.submit(make_job(f"A{i}", config)) for i in range(5)]
+
+    assert [wait_final(job) for job in jobs] == ["impresso"] * 5
+    simulator = simulator_for(config)
+    assert simulator.stats()["impressos"] == 5
+    assert [record["sha1"] for record in simulator.received] == [
+        hashlib.sha1(job.payload).hexdigest() for job in jobs]
+    assert pipeline.supervisor.health()["falhas_seguidas"] == 0
+
+
+def test_falhas_marcam_erro_e_contam_na_saude(simulator_config, make_job):
+    config = simulator_config(print_ms=5, failure_rate=1.0)
+    pipeline = make_pipeline()
+    jobs = [pipeline.submit(make_job(f"F{i}", config)) for i in range(3)]
+
+    assert [wait_final(job) for job in jobs] == ["erro"] * 3
+    assert "código 1" in str(jobs[0].error)
+    assert pipeline.supervisor.health()["falhas_seguidas"] == 3
+
+
+def test_falhas_aleatorias_sao_repetiveis(simulator_config, make_job):
+    def run():
+        config = simulator_config(print_ms=1, failure_rate=0.5, seed=7, buffer_tickets=1)
+        pipeline = make_pipeline(max_processes=1)
+        jobs = [pipeline.submit(make_job(f"R{i}", config)) for i in range(12)]
+        return [wait_final(job) for job in jobs]
+
+    first = run()
+    assert first == run()
+    assert "erro" in first and "impresso" in first
+
+
+def test_janela_offline_recusa_apenas_os_tickets_da_janela(simulator_config, make_job):
+    config = simulator_config(print_ms=5, offline=[[2, 3]])
+    pipeline = make_pipeline(max_processes=1)
+    jobs = [pipeline.submit(make_job(f"O{i}", config)) for i in range(4)]
+
+    assert [wait_final(job) for job in jobs] == ["impresso", "erro", "erro", "impresso"]
+    assert isinstance(jobs[1].error, ConnectionRefusedError)
+    assert simulator_for(config).stats()["offline"] == 2
+
+
+def test_buffer_cheio_recusa_apos_send_timeout():
+    simulator = flet_app.PrinterSimulator(name="buffer", print_ms=1000, buffer_tickets=1, send_timeout=0.1)
+    simulator.submit(b"primeiro")
+    with pytest.raises(TimeoutError):
+        simulator.submit(b"segundo")
+    assert simulator.stats()["buffer_cheio"] == 1
+
+
+def test_buffer_cheio_no_pipeline_marca_erro(simulator_config, make_job):
+    config = simulator_config(print_ms=1000, buffer_tickets=1, send_timeout=0.1)
+    pipeline = make_pipeline(max_processes=4)
+    first = pipeline.submit(make_job("B1", config))
+    second = pipeline.submit(make_job("B2", config))
+
+    assert wait_final(second) == "erro"
+    assert isinstance(second.error, TimeoutError)
+    assert wait_final(first) == "impresso"
+
+
+def test_impressora_travada_e_encerrada_pelo_supervisor(simulator_config, make_job):
+    # Sem papel por 5 s no primeiro ticket: o supervisor encerra após 0,3 s e libera a vaga
+    config = simulator_config(print_ms=5, paper_out=[[1, 5]])
+    pipeline = make_pipeline(max_processes=1, timeout=0.3)
+    jammed = pipeline.submit(make_job("J1", config))
+
+    assert wait_final(jammed, timeout=3) == "erro"
+    assert isinstance(jammed.error, TimeoutError)
+    assert simulator_for(config).stats()["cancelados"] == 1
+    assert pipeline.supervisor.active() == 0
+
+
+def test_servidor_tcp_simulado_reporta_sucesso_e_falha(make_job):
+    results = {}
+    for failure_rate in (0.0, 1.0):
+        simulator = flet_app.PrinterSimulator(name=f"tcp-{failure_rate}", print_ms=5, failure_rate=failure_rate)
+        server = flet_app.PrinterSimulatorServer(simulator, port=0).start()
+        try:
+            host, port = server.address
+            config = {"print_sink": {"type": "tcp", "host": host, "port": port}}
+            pipeline = make_pipeline()
+            job = pipeline.submit(make_job(f"T{int(failure_rate)}", config))
+            results[failure_rate] = wait_final(job)
+        finally:
+            server.stop()
+    assert results == {0.0: "impresso", 1.0: "erro"}
+
+
+def test_impressora_tcp_travada_nao_bloqueia_o_supervisor(make_job):
+    """Regressão: conexão aceita e nunca fechada travava o supervisor para sempre"""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    accepted = []
+    threading.Thread(target=lambda: accepted.extend(listener.accept() for _ in range(2)), daemon=True).start()
+    try:
+        config = {"print_sink": {"type": "tcp", "host": "127.0.0.1", "port": listener.getsockname()[1]}}
+        supervisor = flet_app.ProcessSupervisor(silent_log, max_processes=1, timeout=0.5)
+        sink = flet_app.create_print_sink(config)
+        first = make_job("TCP1", config)
+        supervisor.launch(lambda: sink.send(first.image_path, "Simulada"), [first])
+
+        # O segundo envio precisa da vaga presa pelo primeiro: roda numa thread para o teste não travar
+        second = make_job("TCP2", config)
+        launcher = threading.Thread(
+            target=supervisor.launch, args=(lambda: sink.send(second.image_path, "Simulada"), [second]), daemon=True)
+        launcher.start()
+        launcher.join(3)
+
+        assert not launcher.is_alive(), "a vaga do envio travado não foi liberada"
+        assert wait_final(first, timeout=3) == "erro"
+        assert isinstance(first.error, TimeoutError)
+    finally:
+        listener.close()
+
+
+def test_lote_interrompido_no_encerramento_nao_deixa_arquivo(simulator_config, tmp_path, monkeypatch):
+    """O arquivo agrupado (-lote) é apagado quando o encerramento devolve o lote ao diário"""
+    monkeypatch.chdir(tmp_path)
+    config = simulator_config(print_ms=5, paper_out=[[1, 1]])
+    profile = flet_app.PrinterProfile(encoder="raw")
+    supervisor = flet_app.ProcessSupervisor(silent_log, max_processes=1, timeout=10)
+    pipeline = flet_app.PrintPipeline(silent_log, batch_window_ms=100, supervisor=supervisor)
+
+    def job(code):
+        payload = f"ticket {code}".encode()
+        return flet_app.PrintJob(code, payload, flet_app.save_ticket(payload, profile.extension),
+                                 "Simulada", profile, config)
+
+    # O primeiro ticket ocupa a única vaga; os dois seguintes viram um lote esperando por ela
+    jammed = pipeline.submit(job("J1"))
+    assert wait_for(lambda: supervisor.active() == 1)
+    batch = [pipeline.submit(job(code)) for code in ("B1", "B2")]
+    assert wait_for(lambda: any("-lote" in name for name in os.listdir("ticket")))
+
+    pipeline.close(flet_app.PendingJournal())
+    assert [wait_final(queued, timeout=3) for queued in batch] == ["pendente"] * 2
+    assert not [name for name in os.listdir("ticket") if "-lote" in name]
+    assert wait_final(jammed) == "impresso"
+
+
+def test_tickets_arquivados_vao_ao_destino_sem_arquivo_no_spool(simulator_config, tmp_path, monkeypatch):
+    """Com o arquivo em pacotes, destinos que recebem bytes não precisam de cópia em ticket/spool/"""
+    monkeypatch.chdir(tmp_path)
+    config = simulator_config(print_ms=5)
+    assert flet_app.spool_copy(b"ticket", "bin", config) is None
+
+    profile = flet_app.PrinterProfile(encoder="raw")
+    pipeline = flet_app.PrintPipeline(silent_log, batch_window_ms=100, supervisor=flet_app.ProcessSupervisor(silent_log))
+    jobs = [pipeline.submit(flet_app.PrintJob(code, f"ticket {code}".encode(), None, "Simulada", profile, config,
+                                              locator=f"arquivo:{code}"))
+            for code in ("A1", "A2", "A3")]
+
+    assert [wait_final(job) for job in jobs] == ["impresso"] * 3
+    assert simulator_for(config).received[0]["bytes"] == len(b"".join(job.payload for job in jobs))
+    assert not os.path.exists(flet_app.SPOOL_DIR)